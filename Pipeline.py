@@ -302,9 +302,14 @@ class EQ_Pipeline:
     def do_lag_calc(self):
         min_cc = float(self.parameters.get('min_cc'))
         shift_len = float(self.parameters.get('shift_len'))
+        processes = int(self.parameters.get('lag_calc_processes', 1))
+        stream_cache_bytes = int(float(self.parameters.get('lag_calc_cache_gb', 4)) * 1024 ** 3)
+        schedule = self.parameters.get('lag_calc_schedule', 'family')
         bank = self.tribe_constructor.bank
 
-        self.party, cat = client_party_lag_calc(self.party, bank, pre_processed=False, shift_len=shift_len, min_cc=min_cc, interpolate=True, parallel= True, use_new_resamp_method=True)
+        self.party, cat = client_party_lag_calc(self.party, bank, pre_processed=False, shift_len=shift_len, min_cc=min_cc, interpolate=True, parallel= True, use_new_resamp_method=True,
+                                                processes=processes, max_tasks_per_worker=50, stream_cache_bytes=stream_cache_bytes,
+                                                schedule=schedule)
         self.export_party(name="Party_with-picks.pkl")
     
     def catalog_to_tribe(self, catalog, length, prepick):
@@ -342,7 +347,7 @@ class EQ_Pipeline:
 
         # Parent Catalog 
         og_tribe = self.tribe_constructor.tribe
-        og_catalog = self.tribe_constructor.catalog
+        og_catalog = self.tribe_constructor.obspy_catalog()
         og_augmented_tribe = self.catalog_to_tribe(og_catalog, (noise_window+ prepick+ length)*2, (noise_window+prepick)*2)
 
         # Detection Catalog
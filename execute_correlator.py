@@ -1,14 +1,17 @@
 import os
 import sys
-import pandas as pd
+import json
 import subprocess
 from datetime import datetime
 from obsplus import WaveBank
 from utils.slurmtaskwritter import write_slurm_script
 from utils.run_logger import update_completed_step
+from utils.dtcc import DtccSidecar, depurate_dtcc_file, refilter_dtcc
 from obspy.core.event.catalog import _read
 from modules.correlator import Correlator
 
+WEIGHT_BY_SQUARE = True
+
 def load_parameters(parameter_file):
     parameters = {}
     if os.path.exists(parameter_file):
@@ -34,8 +37,20 @@ def run_correlator(run_dir, parameters):
     max_sep = float(parameters.get('max_sep'))
     min_link = float(parameters.get('min_link'))
     min_cc = float(parameters.get('dt_min_cc'))
+    processes = int(parameters.get('correlation_processes', 1))
+    # Depurate while writing dt.cc, making the depuration step a no-op
+    inline_depuration = parameters.get('inline_depuration', 'True').lower() == 'true'
 
     dtcc_path = os.path.join(run_dir, "dt.cc")
+    depuration_file = os.path.join(run_dir, "dtcc.depurated")
+    if os.path.exists(depuration_file):
+        os.remove(depuration_file)
+    waveform_archive = os.path.join(run_dir, "dt_waveforms")
+    checkpoint = os.path.join(run_dir, "correlator.ckpt")
+    # Raw correlations kept for reruns, only new or re-picked events are correlated again
+    # The extension picks the store: h5, seg (packed segments) or csv
+    correlation_store = parameters.get('correlation_store', 'h5')
+    correlation_cache = os.path.join(run_dir, f"correlations.{correlation_store}")
     correlator = Correlator(
         minlink=min_link,
         min_cc=min_cc,
@@ -49,100 +64,73 @@ def run_correlator(run_dir, parameters):
         client=bank,  # Or any client-like object - if using a wavebank, the wavebank needs to exist
         max_event_links=None,  # Limit to correlate to only the n nearest events, can be set to None to run everything
         outfile=dtcc_path,
-        weight_by_square=True)
+        weight_by_square=WEIGHT_BY_SQUARE,
+        use_shared_memory=processes > 1,  # Let pool workers share the waveform store
+        waveform_archive=waveform_archive,  # One packed snippet file rather than one file per event
+        checkpoint=checkpoint,
+        resume=True,  # Pick up from the last checkpoint if a previous job timed out
+        correlation_cache=correlation_cache,
+        depurate=inline_depuration,
+        dtcc_sidecar=True,  # Unfiltered correlations so dt.cc can be re-filtered without correlating
+        background_write=True)  # Don't hold up correlation on dt.cc writes
+
+    # Read each archive file once for the whole catalog before correlating
+    correlator.prefetch_waveforms(catalog)
+    correlator.add_events(catalog, processes=processes)
+    correlator.clear_checkpoint()
 
-    correlator.add_events(catalog)
+    if inline_depuration:
+        # Record the rules dt.cc was depurated with for depurate_dtcc
+        with open(depuration_file, 'w') as f:
+            json.dump(dict(depuration_rules(parameters),
+                           rejections=correlator.depuration_rejections), f)
+        print(f"Observations rejected by depuration: {correlator.depuration_rejections}")
 
     print(f"Correlation completed successfully. Output saved to {dtcc_path}")
 
+def depuration_rules(params):
+    return {key: float(params.get(key)) for key in ('dt_min_cc', 'min_link', 'shift_len')}
+
 def depurate_dtcc(params, run_dir):
     dtcc_file = os.path.join(run_dir, 'dt.cc')
     backup_file = os.path.join(run_dir, 'dtcc.backup')
+    depuration_file = os.path.join(run_dir, 'dtcc.depurated')
+
+    if os.path.exists(depuration_file):
+        with open(depuration_file, 'r') as f:
+            depurated = json.load(f)
+        rules = depuration_rules(params)
+        if all(depurated.get(key) == value for key, value in rules.items()):
+            print(f"{dtcc_file} was depurated while correlating, nothing to do")
+            return
 
     dt_min_cc_sq = float(params.get("dt_min_cc"))**2
     min_link = float(params.get('min_link'))
     shift_len = float(params.get('shift_len'))
 
-    cleaned_data = []
-
     if not os.path.exists(backup_file):
         os.rename(dtcc_file,backup_file)
-    
-    with open(backup_file, 'r') as f:
-        lines = f.readlines()
-
-    current_event_pair = None
-    event_pair_data = []
-
-    for line in lines:
-        if line.startswith('#'):
-            # If there's an existing event pair, process and clean it
-            if current_event_pair:
-                cleaned_event_pair = process_event_pair(event_pair_data, dt_min_cc_sq, min_link, shift_len)
-                if cleaned_event_pair:
-                    cleaned_data.append(current_event_pair)
-                    cleaned_data.extend(cleaned_event_pair)
-            
-            # Start new event pair
-            current_event_pair = line.strip()
-            event_pair_data = []
-        else:
-            event_pair_data.append(line.strip())
-    
-    # Process last event pair
-    if current_event_pair:
-        cleaned_event_pair = process_event_pair(event_pair_data, dt_min_cc_sq, min_link, shift_len)
-        if cleaned_event_pair:
-            cleaned_data.append(current_event_pair)
-            cleaned_data.extend(cleaned_event_pair)
-    
-    # Write cleaned dt.cc file
-    with open(dtcc_file, 'w') as f:
-        f.write("\n".join(cleaned_data) + "\n")
-    
-    print(f"Depuration complete. Cleaned file saved as: {dtcc_file}, backup saved as: {backup_file}")
 
-def process_event_pair(event_data, dt_min_cc_sq, min_link, shift_len):
-    """
-    Cleans the individual event pair by filtering and deduplicating S-phases.
-    
-    :param event_data: List of lines containing station data
-    :param dt_min_cc: Minimum correlation threshold
-    :param min_link: Minimum required number of stations
-    :return: Cleaned event data list or None if the event pair should be removed
-    """
-    df = []
-    
-    for line in event_data:
-        parts = line.split()
-        if len(parts) != 4:
-            continue  # Skip malformed lines
-        
-        station, time_lag, corr, phase = parts
-        
-        try:
-            time_lag = float(time_lag)
-            corr = float(corr)
-        except ValueError:
-            continue  # Skip lines with invalid numeric values
-        
-        # Apply correlation threshold
-        if (corr >= dt_min_cc_sq) and (time_lag <= shift_len):
-            df.append((station, time_lag, corr, phase))
-    
-    # Convert to DataFrame for processing
-    df = pd.DataFrame(df, columns=['station', 'time_lag', 'corr', 'phase'])
-    
-    # Deduplicate S-phases per station, keeping the highest correlation
-    df = df.sort_values(by=['station', 'phase', 'corr'], ascending=[True, True, False])
-    df = df.drop_duplicates(subset=['station', 'phase'], keep='first')
-    
-    # Ensure min_link is respected
-    if len(df) < min_link:
-        return None  # Remove the event pair entirely
-    
-    # Convert back to list format
-    return [f"{row['station']} {row['time_lag']:.3f} {row['corr']:.4f} {row['phase']}" for _, row in df.iterrows()]
+    if DtccSidecar(dtcc_file).exists():
+        # Regenerate from the unfiltered correlations, thresholds may have been lowered
+        n_read, n_written = refilter_dtcc(
+            dtcc_file, dtcc_file, dt_min_cc=float(params.get("dt_min_cc")),
+            min_link=min_link, shift_len=shift_len,
+            weight_by_square=WEIGHT_BY_SQUARE)
+        with open(depuration_file, 'w') as f:
+            json.dump(depuration_rules(params), f)
+        print(f"Kept {n_written} of {n_read} event pairs")
+        print(f"Depuration complete. Cleaned file saved as: {dtcc_file}, backup saved as: {backup_file}")
+        return
+
+    # Streams the backup in chunks, filtering and deduplicating S-phases per
+    # station and dropping pairs with fewer than min_link stations
+    n_read, n_written = depurate_dtcc_file(
+        backup_file, dtcc_file, dt_min_cc_sq=dt_min_cc_sq, min_link=min_link,
+        shift_len=shift_len)
+
+    print(f"Kept {n_written} of {n_read} event pairs")
+    print(f"Depuration complete. Cleaned file saved as: {dtcc_file}, backup saved as: {backup_file}")
 
 def write_growclust_runfile(swarm_name, run_dir):
     file_text = f"""****  GrowClust Control File  *****
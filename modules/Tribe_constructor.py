@@ -1,7 +1,11 @@
 import os
 import sys
+import json
+import hashlib
 import logging
 import pickle
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from obspy.core.event import Catalog
 from obspy import UTCDateTime
 from eqcorrscan.core.match_filter import Tribe
@@ -11,9 +15,27 @@ current_dir = os.path.dirname(os.path.abspath(__file__))
 pipeline_root = os.path.abspath(os.path.join(current_dir, ".."))
 sys.path.append(pipeline_root)
 from utils.loader import read_catalog_from_csv, check_picks
+from utils.columnar_catalog import ColumnarCatalog, CODE_NAMES
+from utils.catalog_cache import CatalogCache, catalog_fingerprint
 
 archive_path="/hpceliasrafn/haa53/EQcorrscan_pipeline/Swarm_data/ARCHIVE"
 
+# Client and Tribe.construct settings of a template construction worker
+_WORKER_CONSTRUCT = None
+
+def _init_construct_worker(client, settings):
+    global _WORKER_CONSTRUCT
+    _WORKER_CONSTRUCT = (client, settings)
+
+def _construct_batch(catalog, client=None, settings=None):
+    """ Construct the templates of one batch of the catalog. """
+    if client is None:
+        client, settings = _WORKER_CONSTRUCT
+    if isinstance(catalog, ColumnarCatalog):
+        catalog = catalog.to_obspy()
+    return Tribe().construct(
+        method="from_client", client_id=client, catalog=catalog, **settings)
+
 class TribeConstructor:
     def __init__(self, params, run_dir, bad_station_list=None):
         self.run_dir = run_dir
@@ -27,16 +49,24 @@ class TribeConstructor:
         self.catalog = None
         self.tribe = None
         self.stations = set()
+        self.picks_checked = False
+        self.catalog_cache = CatalogCache.for_csv(
+            self.params.get('catalog_csv'), self.params.get('catalog_cache_dir'))
+        self.catalog_key = None
 
     def load_catalog(self):
         logging.info("Loading catalog...")
-        self.catalog = read_catalog_from_csv(self.params.get('catalog_csv'))
-        self.catalog = self.catalog.filter(f"time >= {self.starttime}", f"time <= {self.endtime}")
-        
-        for event in self.catalog:
-            for pick in event.picks:
-                self.stations.add(pick.waveform_id.station_code)
-        
+        # Checked catalogs are cached by the CSV, pick files and availability
+        self.catalog_key = catalog_fingerprint(
+            self.params.get('catalog_csv'), self.bank, starttime=self.starttime,
+            endtime=self.endtime)
+        self.catalog = self.catalog_cache.get(self.catalog_key)
+        self.picks_checked = self.catalog is not None
+        if self.catalog is None:
+            # Kept columnar until eqcorrscan needs obspy events
+            self.catalog = read_catalog_from_csv(self.params.get('catalog_csv'), columnar=True)
+            self.catalog = self.catalog.filter_time(self.starttime, self.endtime)
+        self.stations |= self.catalog.stations
         self.stations -= set(self.bad_station_list)
         logging.info(f"Catalog loaded with {len(self.catalog)} events and {len(self.stations)} stations.")
 
@@ -53,16 +83,24 @@ class TribeConstructor:
         return self.catalog
 
     def update_picks(self):
+        if self.picks_checked:
+            logging.info("Pick codes already checked in the cached catalog")
+            return
         logging.info("Updating pick codes...")
         av = self.bank.get_availability_df()
         self.catalog = check_picks(self.catalog, av, send_warning=False)
+        self.picks_checked = True
+        if isinstance(self.catalog, ColumnarCatalog):
+            self.catalog_cache.put(self.catalog_key, self.catalog)
 
-    def construct_tribe(self):
-        logging.info("Constructing tribe templates...")
-        self.tribe = Tribe().construct(
-            method="from_client",
-            client_id=self.bank,
-            catalog=self.catalog,
+    def obspy_catalog(self):
+        """ The catalog as an obspy Catalog. """
+        if isinstance(self.catalog, ColumnarCatalog):
+            return self.catalog.to_obspy()
+        return self.catalog
+
+    def _construct_settings(self):
+        return dict(
             lowcut=float(self.params.get('lowcut')),
             highcut=float(self.params.get('highcut')),
             samp_rate=int(self.params.get('samp_rate')),
@@ -74,6 +112,133 @@ class TribeConstructor:
             min_snr=float(self.params.get('min_snr')),
             parallel=True
         )
+
+    def construct_tribe(self):
+        batch_days = float(self.params.get('tribe_batch_days', 0))
+        if batch_days > 0:
+            self.construct_tribe_batched(
+                batch_days * 86400, processes=int(self.params.get('tribe_processes', 1)))
+            return
+        logging.info("Constructing tribe templates...")
+        self.tribe = Tribe().construct(
+            method="from_client",
+            client_id=self.bank,
+            catalog=self.obspy_catalog(),
+            **self._construct_settings()
+        )
+        logging.info(f"Tribe created with {len(self.tribe)} templates.")
+
+    def _catalog_batches(self, batch_length):
+        """ Split the catalog into batches of batch_length seconds from starttime. """
+        if isinstance(self.catalog, ColumnarCatalog):
+            times = self.catalog.events["time"] / 1e9
+        else:
+            times = np.array([(event.preferred_origin() or event.origins[0]).time.timestamp
+                              for event in self.catalog])
+        batch_index = np.floor((times - self.starttime.timestamp) / batch_length).astype(int)
+        batches = []
+        for index in np.unique(batch_index):
+            positions = np.flatnonzero(batch_index == index)
+            if isinstance(self.catalog, ColumnarCatalog):
+                catalog = self.catalog.select(positions)
+            else:
+                catalog = Catalog([self.catalog[i] for i in positions])
+            batches.append((self.starttime + index * batch_length, catalog))
+        return batches
+
+    @staticmethod
+    def _pick_lines(catalog):
+        """ One line per pick of catalog: event id, seed id, phase and time. """
+        if isinstance(catalog, ColumnarCatalog):
+            picks = catalog.picks[catalog.pick_positions()]
+            event_ids = np.repeat(catalog.event_ids, catalog.events["n_picks"])
+            codes = {name: catalog.decode(name, picks[name])
+                     for name in CODE_NAMES}
+            return [f"{event_ids[i]} {codes['network'][i]}.{codes['station'][i]}."
+                    f"{codes['location'][i] or ''}.{codes['channel'][i]} "
+                    f"{codes['phase'][i]} {picks['time'][i]}"
+                    for i in range(len(picks))]
+        return [f"{event.resource_id} {pick.waveform_id.get_seed_string()} "
+                f"{pick.phase_hint} {pick.time.ns}"
+                for event in catalog for pick in event.picks]
+
+    def _batch_file(self, batch_dir, batch_start, catalog, settings):
+        """ File of a batch, named by its start, events, picks and settings. """
+        if isinstance(catalog, ColumnarCatalog):
+            event_ids = catalog.event_ids.tolist()
+        else:
+            event_ids = [str(event.resource_id) for event in catalog]
+        # Only settings that change the templates, so runs with other
+        # process counts reuse the batches
+        settings = {k: str(v) for k, v in sorted(settings.items()) if k != "parallel"}
+        description = json.dumps([sorted(event_ids), settings])
+        digest = hashlib.sha1(description.encode())
+        # Templates are cut around the picks, re-picked batches are rebuilt
+        for line in sorted(self._pick_lines(catalog)):
+            digest.update(f"{line}\n".encode())
+        digest = digest.hexdigest()[:12]
+        return os.path.join(batch_dir, f"batch_{batch_start.strftime('%Y%m%dT%H%M%S')}_{digest}.pkl")
+
+    def construct_tribe_batched(self, batch_length, processes=1):
+        """
+        Construct templates in time batches of batch_length seconds.
+
+        Each batch's templates are pickled to run_dir/tribe_batches as soon
+        as they are built, and batches already there are not built again,
+        so an interrupted construction resumes where it stopped. Batches
+        are built in a pool of processes if processes > 1.
+        """
+        batch_dir = os.path.join(self.run_dir, "tribe_batches")
+        if not os.path.isdir(batch_dir):
+            os.makedirs(batch_dir)
+        settings = self._construct_settings()
+        if processes > 1:
+            # Workers already run in parallel
+            settings["parallel"] = False
+        batches = self._catalog_batches(batch_length)
+
+        tribes, pending = dict(), []
+        for i, (batch_start, catalog) in enumerate(batches):
+            filename = self._batch_file(batch_dir, batch_start, catalog, settings)
+            if os.path.isfile(filename):
+                with open(filename, "rb") as f:
+                    tribes[i] = pickle.load(f)
+            else:
+                pending.append((i, filename, catalog))
+        logging.info(f"Constructing templates in {len(batches)} batches, "
+                     f"{len(batches) - len(pending)} already constructed")
+
+        def _save(i, filename, tribe):
+            # Write then rename, so that a batch file is always complete
+            with open(filename + ".part", "wb") as f:
+                pickle.dump(tribe, f)
+            os.replace(filename + ".part", filename)
+            tribes[i] = tribe
+            logging.info(f"Batch {i + 1} of {len(batches)}: {len(tribe)} templates")
+
+        failed = []
+        if processes > 1:
+            with ProcessPoolExecutor(
+                    max_workers=processes, initializer=_init_construct_worker,
+                    initargs=(self.bank, settings)) as executor:
+                futures = {executor.submit(_construct_batch, catalog): (i, filename)
+                           for i, filename, catalog in pending}
+                for future in as_completed(futures):
+                    i, filename = futures[future]
+                    try:
+                        _save(i, filename, future.result())
+                    except Exception as e:
+                        logging.error(f"Batch {i + 1} failed: {e}")
+                        failed.append(i)
+        else:
+            for i, filename, catalog in pending:
+                _save(i, filename, _construct_batch(catalog, self.bank, settings))
+        if failed:
+            raise RuntimeError(
+                f"{len(failed)} of {len(batches)} template batches failed, "
+                f"run again to resume from the completed batches")
+
+        self.tribe = Tribe(templates=[template for i in sorted(tribes) for template in tribes[i]])
         logging.info(f"Tribe created with {len(self.tribe)} templates.")
 
     def filter_templates(self):
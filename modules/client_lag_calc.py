@@ -1,14 +1,20 @@
 import logging
 import pickle
 import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from obsplus import WaveBank
 from obspy import Stream, UTCDateTime, Catalog
 from eqcorrscan.utils import pre_processing
 from eqcorrscan.core.match_filter.family import Family
 from eqcorrscan.core.match_filter.party import Party
 
+from modules.waveform_store import WaveformStore
+
 Logger = logging.getLogger(__name__)
 
+DAY = 86400
+
 class LagcalcLoad(Exception):
     """
     Default error for template generation errors.
@@ -57,7 +63,109 @@ def _group_detections(family, data_pad):
     sub_families.append(sub_family)
     return sub_families
 
-def load_from_client(client, family, data_pad, available_stations=[]):
+def _get_waveforms_bulk(client, bulk):
+    """
+    Read (network, station, location, channel, starttime, endtime) requests
+    with one get_waveforms_bulk call, falling back to one get_waveforms call
+    per request if the bulk request fails.
+
+    :return: A Stream per request, None for requests that failed.
+    """
+    try:
+        st = client.get_waveforms_bulk(bulk)
+    except Exception as e:
+        Logger.error(e)
+        Logger.debug("Trying per channel")
+        out = []
+        for request in bulk:
+            try:
+                out.append(client.get_waveforms(*request))
+            except Exception as e:
+                Logger.error(e)
+                out.append(None)
+        return out
+    return [st.select(network=net, station=sta, location=loc,
+                      channel=chan).slice(starttime, endtime)
+            for net, sta, loc, chan, starttime, endtime in bulk]
+
+def _cached_waveforms_bulk(client, stream_cache, bulk):
+    """
+    Get waveforms for bulk requests from whole station-days held in
+    stream_cache, reading all days that are not cached in one bulk request.
+
+    :return: A Stream per request, None for requests that failed.
+    """
+    day_streams, to_read = dict(), dict()
+    for net, sta, loc, chan, starttime, endtime in bulk:
+        day = UTCDateTime(starttime.date)
+        while day < endtime:
+            key = f"raw/{net}.{sta}.{loc}.{chan}/{day.date}"
+            if key not in day_streams and key not in to_read:
+                day_st = stream_cache.get(key)
+                if day_st is None:
+                    to_read[key] = (net, sta, loc, chan, day, day + DAY)
+                else:
+                    day_streams[key] = day_st
+            day += DAY
+    if len(to_read):
+        Logger.debug(f"Reading {len(to_read)} station-days")
+        for key, day_st in zip(to_read, _get_waveforms_bulk(
+                client, list(to_read.values()))):
+            if day_st is None:
+                day_streams[key] = None
+                continue
+            # Split to remove masks, the store keeps plain arrays
+            day_streams[key] = day_st.split()
+            stream_cache.put(key, day_streams[key])
+    out = []
+    for net, sta, loc, chan, starttime, endtime in bulk:
+        st, day = Stream(), UTCDateTime(starttime.date)
+        while st is not None and day < endtime:
+            day_st = day_streams[f"raw/{net}.{sta}.{loc}.{chan}/{day.date}"]
+            if day_st is None:
+                st = None
+                continue
+            # Copy so that processing does not change the cached data
+            st += day_st.slice(starttime, endtime).copy()
+            day += DAY
+        out.append(st)
+    return out
+
+def _processing_key(template):
+    return "/".join(str(p) for p in (
+        template.lowcut, template.highcut, template.filt_order,
+        template.samp_rate, template.process_length))
+
+def _process_cached(sub_family, st, stream_cache, **kwargs):
+    """
+    Process st for sub_family, reusing traces processed before with the same
+    raw window and processing parameters.
+    """
+    processing_key = _processing_key(sub_family.template)
+    processed_stream, to_process, keys = Stream(), Stream(), dict()
+    for tr in st:
+        key = (f"processed/{tr.id}/{tr.stats.starttime}/{tr.stats.endtime}/"
+               f"{processing_key}")
+        cached = stream_cache.get(key)
+        if cached is None:
+            to_process += tr
+            keys[tr.id] = key
+        else:
+            processed_stream += cached.copy()
+    Logger.info(f"{len(st) - len(to_process)} of {len(st)} traces already "
+                f"processed")
+    if len(to_process):
+        new_stream = sub_family._process_streams(
+            stream=to_process, pre_processed=False, **kwargs)
+        for tr in new_stream:
+            if tr.id in keys:
+                stream_cache.put(keys[tr.id], Stream([tr]).split())
+        processed_stream += new_stream
+    processed_stream.merge(method=1)
+    return processed_stream
+
+def load_from_client(client, family, data_pad, available_stations=[],
+                     stream_cache=None, starttime=None):
     process_len = family.template.process_length
     st = Stream()
     family = family.sort()
@@ -80,7 +188,8 @@ def load_from_client(client, family, data_pad, available_stations=[]):
                 pick.waveform_id.network_code or "*",
                 pick.waveform_id.station_code,
                 channel_code, pick.waveform_id.location_code or "*"))
-    starttime = UTCDateTime(family.detections[0].event.origins[0].time - data_pad)
+    if starttime is None:
+        starttime = UTCDateTime(family.detections[0].event.origins[0].time - data_pad)
     endtime = starttime + process_len
 
     # Error if the last detection is outside the window
@@ -89,22 +198,25 @@ def load_from_client(client, family, data_pad, available_stations=[]):
             'Events do not fit in processing window')
 
     all_waveform_info = sorted(list(set(all_waveform_info)))
+    Logger.info('Downloading for start-time: {0} end-time: {1}'.format(
+        starttime, endtime))
+    bulk = [(net, sta, loc, chan, starttime, endtime)
+            for net, sta, chan, loc in all_waveform_info]
+    if stream_cache is None:
+        bulk_streams = _get_waveforms_bulk(client, bulk)
+    else:
+        bulk_streams = _cached_waveforms_bulk(client, stream_cache, bulk)
     dropped_pick_stations = 0
-    for waveform_info in all_waveform_info:
-        net, sta, chan, loc = waveform_info
-        Logger.info('Downloading for start-time: {0} end-time: {1}'.format(
-            starttime, endtime))
+    for request, request_st in zip(bulk, bulk_streams):
+        net, sta, loc, chan = request[0:4]
         Logger.debug('.'.join([net, sta, loc, chan]))
-        query_params = dict(
-            network=net, station=sta, location=loc, channel=chan,
-            starttime=starttime, endtime=endtime)
-        try:
-            st += client.get_waveforms(**query_params)
-        except Exception as e:
-            Logger.error(e)
+        if request_st is None:
             Logger.error('Found no data for this station: {0}'.format(
-                query_params))
+                dict(network=net, station=sta, location=loc, channel=chan,
+                     starttime=starttime, endtime=endtime)))
             dropped_pick_stations += 1
+            continue
+        st += request_st
     if not st and dropped_pick_stations == len(event.picks):
         raise Exception('No data available, is the server down?')
     st.merge()
@@ -133,16 +245,90 @@ def load_from_client(client, family, data_pad, available_stations=[]):
     st.traces = final_channels
     return st
 
+def _load_processed(sub_family, client, pre_processed, data_pad,
+                    skip_short_chans=False, parallel=True, process_cores=None,
+                    ignore_length=False, ignore_bad_data=False,
+                    stream_cache=None, starttime=None):
+    """
+    Load and process the data for a sub-family, None if there are no data.
+
+    If stream_cache (a WaveformStore) is given raw station-days and
+    processed traces are kept in it for later sub-families.
+    """
+    process_len = sub_family.template.process_length
+    print(sub_family)
+    st = load_from_client(client, sub_family, data_pad, available_stations=[],
+                          stream_cache=stream_cache, starttime=starttime)
+    Logger.info('Pre-processing data')
+    st.merge()
+    if len(st) == 0:
+        Logger.info("No data")
+        return None
+
+
+    for tr in st:
+        if np.ma.is_masked(tr.data):
+            _len = np.ma.count(tr.data) * tr.stats.delta
+        else:
+            _len = tr.stats.npts * tr.stats.delta
+        if _len < process_len * .8:
+            Logger.info(
+                "Data for {0} are too short, skipping".format(
+                    tr.id))
+            if skip_short_chans:
+                continue
+        # Trim to enforce process-len
+        tr.data = tr.data[0:int(process_len * tr.stats.sampling_rate)]
+
+    if len(st) == 0:
+        Logger.warning("No data in stream of sub_family {0}".format(sub_family))
+
+    Logger.info('Pre-processing data')
+    if stream_cache is not None and not pre_processed:
+        processed_stream = _process_cached(
+            sub_family, st, stream_cache, process_cores=process_cores,
+            parallel=parallel, ignore_bad_data=ignore_bad_data,
+            ignore_length=ignore_length, select_used_chans=False)
+    else:
+        processed_stream = sub_family._process_streams(stream=st, pre_processed=pre_processed,
+            process_cores=process_cores, parallel=parallel, 
+            ignore_bad_data=ignore_bad_data, ignore_length=ignore_length,
+            select_used_chans = False)
+    return processed_stream
+
+def _sub_family_lag_calc(sub_family, client, pre_processed,
+                         skip_short_chans=False, parallel=True,
+                         process_cores=None, ignore_length=False,
+                         ignore_bad_data=False, stream_cache=None,
+                         **lag_calc_kwargs):
+    """
+    Load data for, and lag-calc, one sub-family.
+
+    :return: The sub-family and its catalog, or None if there are no data.
+    """
+    processed_stream = _load_processed(
+        sub_family, client, pre_processed=pre_processed,
+        data_pad=lag_calc_kwargs.get('data_pad', 90),
+        skip_short_chans=skip_short_chans, parallel=parallel,
+        process_cores=process_cores, ignore_length=ignore_length,
+        ignore_bad_data=ignore_bad_data, stream_cache=stream_cache)
+    if processed_stream is None:
+        return None
+    catalog = sub_family.lag_calc(
+                stream=processed_stream, pre_processed=True,
+                parallel=parallel, process_cores=process_cores,
+                ignore_bad_data=ignore_bad_data,
+                ignore_length=ignore_length, **lag_calc_kwargs)
+    return sub_family, catalog
+
 def client_family_lag_calc(family, client, pre_processed, shift_len =0.2, min_cc=0.4,
                     min_cc_from_mean_cc_factor= None, vertical_chans=['Z'],
                     horizontal_chans=['E', 'N', '1', '2'], cores=1, interpolate=False,
                     plot= False, plotdir=None, parallel=True, process_cores=None, ignore_length=False,
                     skip_short_chans=False, ignore_bad_data= False, export_cc = False, cc_dir=None,
-                    **kwargs):
+                    stream_cache=None, **kwargs):
     
     data_pad = kwargs.get('data_pad', 90)
-    template = family.template
-    process_len = template.process_length
     sub_families = _group_detections(family, data_pad)
 
     family_out = Family(template=family.template, detections = [])
@@ -150,62 +336,298 @@ def client_family_lag_calc(family, client, pre_processed, shift_len =0.2, min_cc
 
     counter = 1
     for sub_family in sub_families:
-        print(sub_family)
         Logger.info(f"Loading waveform data for detection of template {sub_family} {counter}")
-        st = load_from_client(client, sub_family, data_pad, available_stations=[])
-        Logger.info('Pre-processing data')
-        st.merge()
-        if len(st) == 0:
-            Logger.info("No data")
+        result = _sub_family_lag_calc(
+            sub_family, client, pre_processed=pre_processed,
+            skip_short_chans=skip_short_chans, parallel=parallel,
+            process_cores=process_cores, ignore_length=ignore_length,
+            ignore_bad_data=ignore_bad_data, shift_len=shift_len,
+            min_cc=min_cc, min_cc_from_mean_cc_factor=min_cc_from_mean_cc_factor,
+            horizontal_chans=horizontal_chans, vertical_chans=vertical_chans,
+            cores=cores, interpolate=interpolate, plot=plot, plotdir=plotdir,
+            export_cc=export_cc, cc_dir=cc_dir, stream_cache=stream_cache,
+            **kwargs)
+        if result is None:
             continue
-
-
-        for tr in st:
-            if np.ma.is_masked(tr.data):
-                _len = np.ma.count(tr.data) * tr.stats.delta
-            else:
-                _len = tr.stats.npts * tr.stats.delta
-            if _len < process_len * .8:
-                Logger.info(
-                    "Data for {0} are too short, skipping".format(
-                        tr.id))
-                if skip_short_chans:
-                    continue
-            # Trim to enforce process-len
-            tr.data = tr.data[0:int(process_len * tr.stats.sampling_rate)]
-
-        if len(st) == 0:
-            Logger.warning("No data in stream of sub_family {0}".format(sub_family))
-
-        Logger.info('Pre-processing data')
-        processed_stream = sub_family._process_streams(stream=st, pre_processed=pre_processed,
-            process_cores=process_cores, parallel=parallel, 
-            ignore_bad_data=ignore_bad_data, ignore_length=ignore_length,
-            select_used_chans = False)
-        
-        catalog += sub_family.lag_calc(
-                    stream=processed_stream, pre_processed=True,
-                    shift_len=shift_len, min_cc=min_cc,
-                    min_cc_from_mean_cc_factor=min_cc_from_mean_cc_factor,
-                    horizontal_chans=horizontal_chans,
-                    vertical_chans=vertical_chans, cores=cores,
-                    interpolate=interpolate, plot=plot, plotdir=plotdir,
-                    export_cc=export_cc, cc_dir=cc_dir,
-                    parallel=parallel, process_cores=process_cores,
-                    ignore_bad_data=ignore_bad_data,
-                    ignore_length=ignore_length, **kwargs)
-        
+        sub_family, sub_catalog = result
+        catalog += sub_catalog
         family_out += sub_family
     
     return family_out, catalog
 
+_WORKER_LAG_CALC = None  # (client, settings) of pool workers
+
+
+def _init_lag_calc_worker(client, settings, stream_cache_bytes):
+    global _WORKER_LAG_CALC
+    if stream_cache_bytes:
+        # Each worker keeps its own station-day cache
+        settings = dict(settings, stream_cache=WaveformStore(
+            max_bytes=stream_cache_bytes))
+    _WORKER_LAG_CALC = (client, settings)
+
+
+def _pool_settings(settings, processes, stream_cache_bytes):
+    """
+    Settings and stream cache budget for each of processes pool workers.
+
+    Workers already run in parallel, so eqcorrscan's own multiprocessing
+    is turned off, and the cache budget is shared between them.
+    """
+    return (dict(settings, parallel=False),
+            stream_cache_bytes // max(processes, 1))
+
+
+def _lag_calc_worker(sub_family):
+    client, settings = _WORKER_LAG_CALC
+    return _sub_family_lag_calc(sub_family, client, **settings)
+
+
+def _parallel_party_lag_calc(party, client, processes, max_tasks_per_worker=None,
+                             stream_cache_bytes=0, **settings):
+    """
+    Lag-calc the sub-families of a party across a process pool.
+
+    Sub-families are dispatched in party order with at most 2 * processes
+    in flight, so only that many streams are held at once, and results are
+    merged in dispatch order so the output matches a serial run. Workers
+    are replaced after max_tasks_per_worker sub-families if set, which
+    makes the pool use the spawn start method, so every new worker
+    re-imports this module and receives the client and settings pickled.
+
+    Workers lag-calc serially (parallel=False) and each keeps
+    stream_cache_bytes // processes of cache.
+    """
+    settings, stream_cache_bytes = _pool_settings(
+        settings, processes, stream_cache_bytes)
+    catalog = Catalog()
+    out_party = Party()
+    family_outs = dict()  # Family index -> merged Family
+    pending = deque()
+
+    def _merge(future, family_index):
+        result = future.result()
+        if result is None:
+            return
+        sub_family, sub_catalog = result
+        family_outs[family_index] += sub_family
+        catalog.extend(sub_catalog.events)
+
+    with ProcessPoolExecutor(
+            max_workers=processes, initializer=_init_lag_calc_worker,
+            initargs=(client, settings, stream_cache_bytes),
+            max_tasks_per_child=max_tasks_per_worker) as executor:
+        for family_index, family in enumerate(party):
+            family_outs[family_index] = Family(
+                template=family.template, detections=[])
+            for sub_family in _group_detections(
+                    family, settings.get('data_pad', 90)):
+                Logger.info(f"Dispatching sub-family {sub_family}")
+                pending.append((executor.submit(_lag_calc_worker, sub_family),
+                                family_index))
+                while len(pending) >= 2 * processes:
+                    _merge(*pending.popleft())
+        while len(pending):
+            _merge(*pending.popleft())
+    for family_index in range(len(family_outs)):
+        out_party += family_outs[family_index]
+    return out_party, catalog
+
+def _day_schedule(party, data_pad):
+    """
+    Regroup the detections of a party by processing day.
+
+    Detections that fit a window starting data_pad before the start of
+    their day join that day's shared window, grouped by template processing
+    parameters so families processed alike share one processed stream.
+    Detections too late in the day for it are grouped into sub-families
+    with their own windows by _group_detections.
+
+    :return:
+        Sorted list of (day, shared, own) where shared maps processing keys
+        to lists of (family index, Family) and own is a list of
+        (family index, Family).
+    """
+    schedule = dict()
+    for family_index, family in enumerate(party):
+        template = family.template
+        template_length = len(template.st[0]) / template.samp_rate
+        by_day, leftovers = dict(), []
+        for detection in sorted(family.detections, key=lambda d: d.detect_time):
+            event = detection.event
+            origin_time = (event.preferred_origin() or event.origins[0]).time
+            last_pick = max((p.time for p in event.picks), default=origin_time)
+            day = UTCDateTime(origin_time.date)
+            window_end = day - data_pad + template.process_length
+            if last_pick + template_length + data_pad < window_end:
+                by_day.setdefault(day, []).append(detection)
+            else:
+                leftovers.append(detection)
+        for day, detections in by_day.items():
+            _, shared, _ = schedule.setdefault(day, (day, dict(), []))
+            shared.setdefault(_processing_key(template), []).append(
+                (family_index, Family(template=template, detections=detections)))
+        if len(leftovers):
+            for sub_family in _group_detections(
+                    Family(template=template, detections=leftovers), data_pad):
+                day = UTCDateTime(sub_family[0].event.origins[0].time.date)
+                _, _, own = schedule.setdefault(day, (day, dict(), []))
+                own.append((family_index, sub_family))
+    return [schedule[day] for day in sorted(schedule)]
+
+def _lag_calc_day(work, client, pre_processed, skip_short_chans=False,
+                  parallel=True, process_cores=None, ignore_length=False,
+                  ignore_bad_data=False, stream_cache=None, **lag_calc_kwargs):
+    """
+    Lag-calc one day of a _day_schedule.
+
+    Each shared window is loaded and processed once and every family's
+    detections on that day are lag-calced against it.
+
+    :return: List of (family index, sub-family, catalog).
+    """
+    day, shared, own = work
+    data_pad = lag_calc_kwargs.get('data_pad', 90)
+    load_kwargs = dict(
+        pre_processed=pre_processed, skip_short_chans=skip_short_chans,
+        parallel=parallel, process_cores=process_cores,
+        ignore_length=ignore_length, ignore_bad_data=ignore_bad_data,
+        stream_cache=stream_cache)
+    results = []
+    for items in shared.values():
+        Logger.info(f"Lag-calc for {len(items)} families on {day.date}")
+        # All detections of the day, so every channel needed is loaded
+        day_family = Family(
+            template=items[0][1].template,
+            detections=[d for _, sub_family in items for d in sub_family])
+        processed_stream = _load_processed(
+            day_family, client, data_pad=data_pad, starttime=day - data_pad,
+            **load_kwargs)
+        if processed_stream is None:
+            continue
+        for family_index, sub_family in items:
+            catalog = sub_family.lag_calc(
+                stream=processed_stream, pre_processed=True,
+                parallel=parallel, process_cores=process_cores,
+                ignore_bad_data=ignore_bad_data,
+                ignore_length=ignore_length, **lag_calc_kwargs)
+            results.append((family_index, sub_family, catalog))
+        # Release the day's data before the next window
+        del processed_stream
+    for family_index, sub_family in own:
+        result = _sub_family_lag_calc(
+            sub_family, client, **load_kwargs, **lag_calc_kwargs)
+        if result is not None:
+            results.append((family_index, ) + result)
+    return results
+
+def _lag_calc_day_worker(work):
+    client, settings = _WORKER_LAG_CALC
+    return _lag_calc_day(work, client, **settings)
+
+def _day_major_party_lag_calc(party, client, processes=1,
+                              max_tasks_per_worker=None, stream_cache_bytes=0,
+                              **settings):
+    """
+    Lag-calc a party one processing day at a time.
+
+    Days are run in order, in a process pool if processes > 1, and results
+    are merged per family in party order, then by time.
+    """
+    schedule = _day_schedule(party, settings.get('data_pad', 90))
+    Logger.info(f"Lag-calc for {len(party)} families over {len(schedule)} days")
+    results = dict()  # family index -> [(sub-family, catalog)]
+
+    def _merge(day_results):
+        for family_index, sub_family, catalog in day_results:
+            results.setdefault(family_index, []).append((sub_family, catalog))
+
+    if processes > 1:
+        pending = deque()
+        worker_settings, worker_cache_bytes = _pool_settings(
+            settings, processes, stream_cache_bytes)
+        with ProcessPoolExecutor(
+                max_workers=processes, initializer=_init_lag_calc_worker,
+                initargs=(client, worker_settings, worker_cache_bytes),
+                max_tasks_per_child=max_tasks_per_worker) as executor:
+            for work in schedule:
+                pending.append(executor.submit(_lag_calc_day_worker, work))
+                while len(pending) >= 2 * processes:
+                    _merge(pending.popleft().result())
+            while len(pending):
+                _merge(pending.popleft().result())
+    else:
+        stream_cache = None
+        if stream_cache_bytes:
+            stream_cache = WaveformStore(max_bytes=stream_cache_bytes)
+        for work in schedule:
+            _merge(_lag_calc_day(work, client, stream_cache=stream_cache,
+                                 **settings))
+
+    catalog = Catalog()
+    out_party = Party()
+    for family_index, family in enumerate(party):
+        family_out = Family(template=family.template, detections=[])
+        for sub_family, sub_catalog in results.get(family_index, []):
+            family_out += sub_family
+            catalog += sub_catalog
+        out_party += family_out
+    return out_party, catalog
+
 def client_party_lag_calc(party, client, pre_processed, shift_len =0.2, min_cc=0.4,
                     min_cc_from_mean_cc_factor= None, vertical_chans=['Z'],
                     horizontal_chans=['E', 'N', '1', '2'], cores=1, interpolate=False,
                     plot= False, plotdir=None, parallel=True, process_cores=None, ignore_length=False,
                     skip_short_chans=False, ignore_bad_data= False, export_cc = False, cc_dir=None,
-                    **kwargs):
+                    processes=1, max_tasks_per_worker=None, stream_cache_bytes=0,
+                    schedule="family", **kwargs):
+    """
+    Lag-calc every family of a party using waveforms from client.
+
+    :param processes:
+        Number of worker processes to lag-calc sub-families in parallel,
+        results are merged in party order. Workers ignore parallel and
+        lag-calc serially.
+    :param max_tasks_per_worker:
+        Replace pool workers after this many sub-families to bound memory.
+        Setting it makes the pool start workers with the spawn method.
+    :param stream_cache_bytes:
+        Bytes of raw station-days and processed traces to keep for reuse by
+        later sub-families, split evenly between worker processes, 0 to
+        read each window directly.
+    :param schedule:
+        "family" to lag-calc family by family, or "day" to regroup all
+        detections by day so each day's data are loaded and processed once
+        for every family.
+    """
     process_cores = process_cores or cores
+    if schedule == "day":
+        return _day_major_party_lag_calc(
+            party, client, processes=processes,
+            max_tasks_per_worker=max_tasks_per_worker,
+            stream_cache_bytes=stream_cache_bytes, pre_processed=pre_processed,
+            skip_short_chans=skip_short_chans, parallel=parallel,
+            process_cores=process_cores, ignore_length=ignore_length,
+            ignore_bad_data=ignore_bad_data, shift_len=shift_len,
+            min_cc=min_cc, min_cc_from_mean_cc_factor=min_cc_from_mean_cc_factor,
+            horizontal_chans=horizontal_chans, vertical_chans=vertical_chans,
+            cores=cores, interpolate=interpolate, plot=plot, plotdir=plotdir,
+            export_cc=export_cc, cc_dir=cc_dir, **kwargs)
+    if processes > 1:
+        return _parallel_party_lag_calc(
+            party, client, processes=processes,
+            max_tasks_per_worker=max_tasks_per_worker,
+            stream_cache_bytes=stream_cache_bytes, pre_processed=pre_processed,
+            skip_short_chans=skip_short_chans, parallel=parallel,
+            process_cores=process_cores, ignore_length=ignore_length,
+            ignore_bad_data=ignore_bad_data, shift_len=shift_len,
+            min_cc=min_cc, min_cc_from_mean_cc_factor=min_cc_from_mean_cc_factor,
+            horizontal_chans=horizontal_chans, vertical_chans=vertical_chans,
+            cores=cores, interpolate=interpolate, plot=plot, plotdir=plotdir,
+            export_cc=export_cc, cc_dir=cc_dir, **kwargs)
+    stream_cache = None
+    if stream_cache_bytes:
+        stream_cache = WaveformStore(max_bytes=stream_cache_bytes)
     catalog = Catalog()
     out_party = Party()
     for family in party:
@@ -214,8 +636,11 @@ def client_party_lag_calc(party, client, pre_processed, shift_len =0.2, min_cc=0
                                           horizontal_chans=horizontal_chans, cores= cores, interpolate = interpolate,
                                           plot=plot, plotdir=plotdir, parallel=parallel, process_cores=process_cores, ignore_length=ignore_length,
                                           skip_short_chans=skip_short_chans, ignore_bad_data=ignore_bad_data, export_cc = export_cc, cc_dir = cc_dir,
-                                          **kwargs)
+                                          stream_cache=stream_cache, **kwargs)
         out_party += new_family
         catalog += family_catalog
+    if stream_cache is not None:
+        Logger.info(f"Stream cache: {stream_cache.hits} hits, "
+                    f"{stream_cache.misses} misses")
     
     return out_party, catalog
\ No newline at end of file
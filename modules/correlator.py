@@ -4,7 +4,16 @@ Class and methods to lazily compute correlations for new events.
 
 import fnmatch
 import glob
+import copy
+import hashlib
+import json
 import os
+import pickle
+import queue
+import shutil
+import sqlite3
+import threading
+import time
 import warnings
 import tqdm
 import csv
@@ -13,7 +22,11 @@ import h5py
 import numpy as np
 import logging
 
-from typing import Iterable, Union, Dict, List
+from typing import Iterable, Iterator, Union, Dict, List, Tuple
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from scipy.spatial import cKDTree
 
 from obspy import Catalog, Stream, read
 from obspy.core.event import Event
@@ -28,8 +41,24 @@ from eqcorrscan.utils.clustering import dist_array_km
 
 from rt_eqcorrscan.plugins.waveform_access import InMemoryWaveBank
 
+from modules.waveform_store import WaveformStore, attach_streams, detach_streams
+from modules.waveform_archive import WaveformArchive, pick_phases
+from utils.dtcc import DtccSidecar, depurate_observations
+
 Logger = logging.getLogger(__name__)
 
+_WARNED_STRING_EVENT_IDS = False
+
+
+def _warn_string_event_ids():
+    """ Warn, once per process, that a selection returns string event ids. """
+    global _WARNED_STRING_EVENT_IDS
+    if _WARNED_STRING_EVENT_IDS:
+        return
+    _WARNED_STRING_EVENT_IDS = True
+    Logger.warning("Returning event ids as strings - this may cause "
+                   "issues for formatting output strings")
+
 
 class Correlations:
     """
@@ -40,26 +69,61 @@ class Correlations:
     eid1
         eid2
             station1.csv - file of phase,tt1,tt2,weight
+
+    A sqlite manifest (.manifest.sqlite) in the top directory indexes the
+    (eid1, eid2, station) files that exist so that neither opening nor
+    selecting has to scan the directory tree.
     """
+    _manifest_name = ".manifest.sqlite"
+
     def __init__(self, correlation_directory: str = None):
         if correlation_directory is None:
             correlation_directory = ".correlations"
         self._correlation_directory = os.path.abspath(correlation_directory)
         if not os.path.isdir(self._correlation_directory):
             os.makedirs(self._correlation_directory)
-        # Work out what we have!
-        self.eventids = self._get_event_indexes()
-        # Getting stations has to happen after getting eventids
-        self.stations = self._get_stations()
+        manifest_file = os.path.join(
+            self._correlation_directory, self._manifest_name)
+        build = not os.path.isfile(manifest_file)
+        self._manifest = sqlite3.connect(manifest_file)
+        self._manifest.executescript(
+            "CREATE TABLE IF NOT EXISTS pairs ("
+            "eid1 TEXT, eid2 TEXT, station TEXT, "
+            "PRIMARY KEY (eid1, eid2, station));"
+            "CREATE TABLE IF NOT EXISTS events (eid TEXT PRIMARY KEY);"
+            "CREATE TABLE IF NOT EXISTS stations (station TEXT PRIMARY KEY);")
+        if build:
+            self._build_manifest()
 
     def __repr__(self):
         return f"Correlations(correlation_directory={self.correlation_directory})"
 
+    def __getstate__(self):
+        # The manifest connection is reopened rather than pickled
+        return {"correlation_directory": self.correlation_directory}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
     def _get_correlation_directory(self):
         return self._correlation_directory
 
     correlation_directory = property(fget=_get_correlation_directory)
 
+    def _get_event_indexes(self):
+        """ Event ids with correlations on disk. """
+        return {row[0] for row in self._manifest.execute(
+            "SELECT eid FROM events")}
+
+    eventids = property(fget=_get_event_indexes)
+
+    def _get_stations(self):
+        """ Stations with correlations on disk. """
+        return {row[0] for row in self._manifest.execute(
+            "SELECT station FROM stations")}
+
+    stations = property(fget=_get_stations)
+
     __csv_format = {
         "delimiter": ",", "lineterminator": "\r\n", "skipinitialspace": True}
 
@@ -69,22 +133,52 @@ class Correlations:
     def _correlation_file(self, eid1, eid2, station):
         return os.path.join(self._eid_dir(eid1, eid2), f"{station}.csv")
 
-    def _get_event_indexes(self):
-        """ Directories are named by event indexes. """
-        Logger.info("Scanning for event ids")
-        event_indexes = {
-            os.path.basename(thing[0])
-            for thing in os.walk(self.correlation_directory)}
-        return event_indexes
-
-    def _get_stations(self):
-        """ Files are named by station beneath event indexes. """
-        stations = set()
-        Logger.info("Scanning for stations")
+    def _build_manifest(self):
+        """ Index correlation files written before the manifest existed. """
         station_files = glob.glob(f"{self.correlation_directory}/*/*/*.csv")
-        stations = {os.path.splitext(os.path.basename(_))[0]
-                    for _ in station_files}
-        return stations
+        if len(station_files) == 0:
+            return
+        Logger.info(f"Indexing {len(station_files)} correlation files in "
+                    f"{self.correlation_directory}")
+        entries = []
+        for station_file in station_files:
+            eid_dir, station_file = os.path.split(station_file)
+            eid1_dir, eid2 = os.path.split(eid_dir)
+            entries.append((os.path.basename(eid1_dir), eid2,
+                            os.path.splitext(station_file)[0]))
+        self._index(entries)
+        return
+
+    def _index(self, entries: List[Tuple[str, str, str]]):
+        """ Add (eid1, eid2, station) entries to the manifest. """
+        with self._manifest:
+            self._manifest.executemany(
+                "INSERT OR IGNORE INTO pairs VALUES (?, ?, ?)", entries)
+            self._manifest.executemany(
+                "INSERT OR IGNORE INTO events VALUES (?)",
+                {(eid, ) for entry in entries for eid in entry[0:2]})
+            self._manifest.executemany(
+                "INSERT OR IGNORE INTO stations VALUES (?)",
+                {(entry[2], ) for entry in entries})
+        return
+
+    def _remove(self, eid1: str, eid2: str, station: str):
+        """ Remove a station file and its manifest entry. """
+        # The manifest never points at a missing file
+        with self._manifest:
+            self._manifest.execute(
+                "DELETE FROM pairs WHERE eid1 = ? AND eid2 = ? AND station = ?",
+                (eid1, eid2, station))
+        corr_file = self._correlation_file(
+            eid1=eid1, eid2=eid2, station=station)
+        if os.path.isfile(corr_file):
+            os.remove(corr_file)
+        return
+
+    def _indexed(self, eid1: str, eid2: str, station: str) -> bool:
+        return self._manifest.execute(
+            "SELECT 1 FROM pairs WHERE eid1 = ? AND eid2 = ? AND station = ?",
+            (eid1, eid2, station)).fetchone() is not None
 
     def _get_correlations(
         self,
@@ -95,13 +189,10 @@ class Correlations:
         min_weight: float = None
     ) -> Union[_EventPair, None]:
         """ Read correlations from a file. """
-        if eid1 not in self.eventids or eid2 not in self.eventids or station not in self.stations:
-            Logger.info(f"Unknown request")
-            return None
         corr_file = self._correlation_file(
             eid1=eid1, eid2=eid2, station=station)
         if not os.path.isfile(corr_file):
-            Logger.debug(f"No correlations on disk for {eid1}:{eid2}:{station}")
+            Logger.warning(f"{corr_file} is in the manifest but not on disk")
             return None
         event_pair = _EventPair(event_id_1=eid1, event_id_2=eid2, obs=[])
         with open(corr_file, newline='') as csvfile:
@@ -118,27 +209,39 @@ class Correlations:
     def _write_correlations(
         self,
         event_pair: _EventPair,
-        update: bool = False
-    ):
+        update: bool = False,
+        pending: set = None,
+    ) -> List[Tuple[str, str, str]]:
+        """
+        Write station files, returning the manifest entries written.
+
+        pending holds entries written but not yet in the manifest. With
+        update, existing files are replaced; a file stored in the other
+        orientation is removed so that each pair is held once.
+        """
+        pending = pending if pending is not None else set()
+        eid1, eid2 = str(event_pair.event_id_1), str(event_pair.event_id_2)
+        written = []
         # Split into stations to write individual station files
         stations = {obs.station for obs in event_pair.obs}
         for station in stations:
             # Check if eid1/eid2/station.csv or eid2/eid1/station.csv exists
+            reversed_exists = eid1 != eid2 and (
+                (eid2, eid1, station) in pending
+                or self._indexed(eid2, eid1, station))
+            exists = (reversed_exists or (eid1, eid2, station) in pending
+                      or self._indexed(eid1, eid2, station))
+            if exists and not update:
+                continue
+            if reversed_exists:
+                self._remove(eid2, eid1, station)
+                pending.discard((eid2, eid1, station))
             corr_file = self._correlation_file(
-                eid1=event_pair.event_id_1, eid2=event_pair.event_id_2,
-                station=station)
-            anti_corr_file = self._correlation_file(
-                eid2=event_pair.event_id_1, eid1=event_pair.event_id_2,
-                station=station)
-            if os.path.isfile(corr_file) or os.path.isfile(anti_corr_file):
-                if not update:
-                    continue
+                eid1=eid1, eid2=eid2, station=station)
             obs = [o for o in event_pair.obs if o.station == station]
             self._write_obs(filename=corr_file, obs=obs)
-        # Update the stations and event ids in use
-        self.eventids.update({event_pair.event_id_1, event_pair.event_id_2})
-        self.stations.update(stations)
-        return
+            written.append((eid1, eid2, station))
+        return written
 
     def _write_obs(self, filename: str, obs: List[_DTObs]):
         obs_dir = os.path.dirname(filename)
@@ -152,9 +255,17 @@ class Correlations:
                     str(_obs.weight)])
         return
 
+    def flush(self):
+        """ Nothing is buffered, files are written by update. """
+        return
+
     def update(self, other: List[_EventPair], update: bool = False):
+        written = set()
         for event_pair in tqdm.tqdm(other):
-            self._write_correlations(event_pair=event_pair, update=update)
+            written.update(self._write_correlations(
+                event_pair=event_pair, update=update, pending=written))
+        # Files are on disk before the manifest points at them
+        self._index(list(written))
         return
 
     def select(
@@ -183,60 +294,113 @@ class Correlations:
         eventid_2 = eventid_2 or "*"
 
         if not eid_ints:
-            Logger.warning("Returning event ids as strings - this may cause "
-                           "issues for formatting output strings")
-
-        # Work out indexes
-        stations = fnmatch.filter(self.stations, station)
-        if len(stations) == 0:
-            raise NotImplementedError(
-                f"{station} not found in correlations")
-
-        event1_ids = fnmatch.filter(self.eventids, eventid_1)
-        if len(event1_ids) == 0:
-            raise NotImplementedError(
-                f"{eventid_1} not found in correlations")
-
-        event2_ids = fnmatch.filter(self.eventids, eventid_2)
-        if len(event2_ids) == 0:
-            raise NotImplementedError(
-                f"{eventid_2} not found in correlations")
-        out = []
-        for eid1 in event1_ids:
-            if not os.path.isdir(os.path.join(self.correlation_directory, str(eid1))):
-                continue
-            for eid2 in event2_ids:
-                for station in stations:
-                    _out = self._get_correlations(
-                        eid1=eid1, eid2=eid2, station=station, phase=phase,
-                        min_weight=min_weight)
-                    if _out:
-                        out.append(_out)
+            _warn_string_event_ids()
+
+        # Check the patterns match something, sqlite GLOB follows fnmatch
+        for table, column, pattern in (("stations", "station", station),
+                                       ("events", "eid", eventid_1),
+                                       ("events", "eid", eventid_2)):
+            if self._manifest.execute(
+                    f"SELECT 1 FROM {table} WHERE {column} GLOB ? LIMIT 1",
+                    (pattern, )).fetchone() is None:
+                raise NotImplementedError(
+                    f"{pattern} not found in correlations")
+
+        entries = self._manifest.execute(
+            "SELECT eid1, eid2, station FROM pairs "
+            "WHERE eid1 GLOB ? AND eid2 GLOB ? AND station GLOB ? "
+            "ORDER BY eid1, eid2, station",
+            (eventid_1, eventid_2, station)).fetchall()
         # Group event_pairs
-        output_event_pairs = {} # dict keyed by eid1, eid2
-        for _out in out:
-            if _out.event_id_1 in output_event_pairs.keys():
-                if _out.event_id_2 in output_event_pairs[_out.event_id_1].keys():
-                    output_event_pairs[_out.event_id_1][_out.event_id_2].extend(_out.obs)
-                else:
-                    output_event_pairs[_out.event_id_1].update(
-                        {_out.event_id_2: _out.obs})
-            else:
-                output_event_pairs.update(
-                    {_out.event_id_1: {_out.event_id_2: _out.obs}})
+        output_event_pairs = {}  # dict keyed by eid1, eid2
+        for eid1, eid2, _station in entries:
+            _out = self._get_correlations(
+                eid1=eid1, eid2=eid2, station=_station, phase=phase,
+                min_weight=min_weight)
+            if _out is None:
+                continue
+            output_event_pairs.setdefault(
+                (eid1, eid2), []).extend(_out.obs)
         out = [_EventPair(event_id_1=eid1, event_id_2=eid2, obs=obs)
-               for eid1, value in output_event_pairs.items()
-               for eid2, obs in value.items()]
+               for (eid1, eid2), obs in output_event_pairs.items()]
         return out
 
 
+def _latest_columns(columns: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """
+    Keep the last written record of each pair, station and phase from
+    columns of mirrored correlation records, sorted by event1, event2 and
+    key.
+
+    columns holds equal length event1, event2, tt1, tt2, weight, key and row
+    arrays; row gives the write order: later rows replace earlier ones for
+    the same pair, station and phase.
+    """
+    order = np.lexsort((columns["row"], columns["key"],
+                        columns["event2"], columns["event1"]))
+    columns = {name: values[order] for name, values in columns.items()}
+    event1, event2, key = columns["event1"], columns["event2"], columns["key"]
+    last = np.ones(len(event1), dtype=bool)
+    last[:-1] = ((event1[1:] != event1[:-1]) | (event2[1:] != event2[:-1])
+                 | (key[1:] != key[:-1]))
+    return {name: values[last] for name, values in columns.items()}
+
+
+def _event_pairs_from_columns(
+    columns: Dict[str, np.ndarray],
+    eventids: List[str],
+    obs_names,
+    eid_ints: bool,
+) -> Iterator[_EventPair]:
+    """
+    Yield event pairs from columns of mirrored correlation records.
+
+    columns holds equal length event1, event2 (indexes into eventids), tt1,
+    tt2, weight, key and row arrays, see _latest_columns. obs_names maps
+    key to (station, phase).
+    """
+    columns = _latest_columns(columns)
+    event1, event2 = columns["event1"], columns["event2"]
+    pair_starts = np.flatnonzero(np.concatenate((
+        [True], (event1[1:] != event1[:-1]) | (event2[1:] != event2[:-1]))))
+    pair_ends = np.append(pair_starts[1:], len(event1))
+    for start, end in zip(pair_starts, pair_ends):
+        event1_id = eventids[event1[start]]
+        event2_id = eventids[event2[start]]
+        if eid_ints:
+            event1_id, event2_id = int(event1_id), int(event2_id)
+        obs = []
+        for i in range(start, end):
+            station, phase = obs_names[columns["key"][i]]
+            obs.append(_DTObs(
+                station=station, tt1=float(columns["tt1"][i]),
+                tt2=float(columns["tt2"][i]),
+                weight=float(columns["weight"][i]), phase=phase))
+        yield _EventPair(
+            event_id_1=event1_id, event_id_2=event2_id, obs=obs)
+
+
 class H5Correlations:
     """
     Object to hold correlations backed by an hdf5 file.
 
-    Correlations are stored as an m x n x n array where n is the number of
-    events and m is the number of channels.
+    Correlations are stored sparsely, one group per station and phase:
+
+    pairs
+        station
+            phase - chunked, resizable event1, event2, tt1, tt2 and weight
+                    datasets, one entry per event pair
+
+    event1 and event2 are indexes into the eventids table. Each pair is
+    stored once, in the orientation given, and is mirrored on selection.
+    Later entries for a pair replace earlier ones.
     """
+    _layout = "sparse-1"
+    _chunk_size = 4096
+    _read_block_size = 64 * _chunk_size  # Rows read at a time by select
+    _pair_fields = (("event1", "i4"), ("event2", "i4"), ("tt1", "f8"),
+                    ("tt2", "f8"), ("weight", "f8"))
+
     def __init__(self, correlation_file: str = None):
         self._string_encoding = 'utf-8'
         if correlation_file is None:
@@ -248,6 +412,7 @@ class H5Correlations:
         self.stations = self._get_station_indexes()
         self.eventids = self._get_event_indexes()
         self.phases = self._get_phase_indexes()
+        self._eventid_index = {eid: i for i, eid in enumerate(self.eventids)}
 
     def __repr__(self):
         return f"Correlations(correlation_file={self.correlation_file})"
@@ -285,152 +450,58 @@ class H5Correlations:
             return False
         # Check that the data structure is as expected
         with h5py.File(self.correlation_file, "r") as f:
-            assert "tt1" in f.keys(), f"Missing tt1 in {f.keys()}"
-            assert "tt2" in f.keys(), f"Missing tt2 in {f.keys()}"
-            assert "weight" in f.keys(), f"Missing weight in {f.keys()}"
-            assert "eventids" in f.keys(), f"Missing eventids in {f.keys()}"
-            assert "stations" in f.keys(), f"Missing stations in {f.keys()}"
-            assert "phases" in f.keys(), f"Missing stations in {f.keys()}"
-            assert f['eventids'].maxshape == (None, ), "eventids is not expandable"
-            assert f['stations'].maxshape == (None, ), "stations is not expandable"
-            assert f['phases'].maxshape == (None,), "phases is not expandable"
+            layout = f.attrs.get("layout")
+            if layout != self._layout:
+                raise ValueError(
+                    f"{self.correlation_file} uses the {layout} layout, not "
+                    f"{self._layout}: delete it, or migrate it by selecting "
+                    f"its correlations into a new file")
+            for name in ("pairs", "eventids", "stations", "phases"):
+                if name not in f.keys():
+                    raise ValueError(
+                        f"{self.correlation_file} is missing {name}")
+            for name in ("eventids", "stations", "phases"):
+                if f[name].maxshape != (None, ):
+                    raise ValueError(
+                        f"{name} in {self.correlation_file} is not expandable")
         return True
 
     def _make_correlation_file(self):
         with h5py.File(self.correlation_file, "w") as f:
-            # Top-level group - correlations which hosts len(seed_ids) groups
-            # of len(eventid) datasets of len(eventid)
-            _ = f.create_group(name="tt1")  # tt1 if travel-time for event1
-            _ = f.create_group(name="tt2")  # tt2 is travel time for event 2
-            _ = f.create_group(name="weight")  # Weight is correlation
-            _ = f.create_dataset(
-                name="eventids", data=[""], dtype=self._string_dtype,
-                maxshape=(None, ))
-            _ = f.create_dataset(
-                name="stations", data=[""], dtype=self._string_dtype,
-                maxshape=(None,))
-            _ = f.create_dataset(
-                name="phases", data=[""], dtype=self._string_dtype,
-                maxshape=(None,))
+            f.attrs["layout"] = self._layout
+            # Top-level group - pairs which hosts station/phase groups of
+            # sparse pair arrays
+            _ = f.create_group(name="pairs")
+            for name in ("eventids", "stations", "phases"):
+                _ = f.create_dataset(
+                    name=name, shape=(0, ), dtype=self._string_dtype,
+                    maxshape=(None, ), chunks=(self._chunk_size, ))
         return
 
-    def _get_correlation(
-        self,
-        station: str,
-        phase: str,
-        event1_id: str,
-        event2_index: int
-    ) -> _DTObs:
-        with h5py.File(self.correlation_file, "r") as f:
-            tt1 = f['tt1'][station][phase][event1_id][event2_index]
-            tt2 = f['tt2'][station][phase][event1_id][event2_index]
-            weight = f['weight'][station][phase][event1_id][event2_index]
-        dt = _DTObs(station=station, tt1=tt1, tt2=tt2,
-                    weight=weight, phase=phase)
-        return dt
-
-    def _empty_correlation_array(self):
-        if len(self.eventids) == 0:
-            return [np.nan]
-        return np.ones(len(self.eventids)) * np.nan
-
-    def _new_station(self, station: str, file_handle: h5py.File = None):
-        """ Add a new seed-id to the file. """
-        close_file = False
-        if file_handle is None:
-            file_handle = h5py.File(self.correlation_file, "r+")
-            close_file = True
-        # Cope with starting with an empty file
-        if len(self.stations) == 1 and self.stations[0] == '':
-            self.stations[0] = station
-        else:
-            # Resize seed-ids and add new seed-id in place
-            self.stations.append(station)
-        file_handle['stations'].resize((len(self.stations), ))
-        file_handle['stations'][-1] = station
-        # Add new groups as needed
-        for group in ('tt1', 'tt2', 'weight'):
-            file_handle[group].create_group(name=station)
-            for phase in self.phases:
-                if phase == "":
-                    continue
-                file_handle[group][station].create_group(name=phase)
-                for event1_id in self.eventids:
-                    if event1_id == '':
-                        continue
-                    Logger.info(f"Creating dataset for {event1_id} of "
-                                f"{len(self.eventids)} nans")
-                    file_handle[group][station][phase].create_dataset(
-                        name=event1_id, data=self._empty_correlation_array(),
-                        dtype=float, maxshape=(None, ))
-        if close_file:
-            file_handle.close()
-        return
-
-    def _new_event_id(self, event_id: str, file_handle: h5py.File = None):
-        """ Add a new event-id to the file. """
-        close_file = False
-        if file_handle is None:
-            file_handle = h5py.File(self.correlation_file, "r+")
-            close_file = True
-        if len(self.eventids) == 1 and self.eventids[0] == '':
-            self.eventids[0] = event_id
-        else:
-            # Resize and add new event-id in place
-            self.eventids.append(event_id)
-        file_handle['eventids'].resize((len(self.eventids), ))
-        file_handle['eventids'][-1] = event_id
-
-        # TODO: This is slow for large datasets
-        for group in ("tt1", "tt2", "weight"):
-            for station in self.stations:
-                if station == '':
-                    continue
-                for phase in self.phases:
-                    if phase == '':
-                        continue
-                    # Add new array for this eventid
-                    file_handle[group][station][phase].create_dataset(
-                        name=event_id, data=self._empty_correlation_array(),
-                        dtype=float, maxshape=(None, ))
-                    # Add a new entry to all the other arrays
-                    for event1_id in self.eventids:
-                        file_handle[group][station][phase][event1_id].resize(
-                            (len(self.eventids), ))
-                        file_handle[group][station][phase][event1_id][-1] = np.nan
-        if close_file:
-            file_handle.close()
-        return
-
-    def _new_phase(self, phase: str, file_handle: h5py.File = None):
-        """ Add a new event-id to the file. """
-        close_file = False
-        if file_handle is None:
-            file_handle = h5py.File(self.correlation_file, "r+")
-            close_file = True
-        if len(self.phases) == 1 and self.phases[0] == '':
-            self.phases[0] = phase
-        else:
-            # Resize and add new event-id in place
-            self.phases.append(phase)
-        file_handle['phases'].resize((len(self.phases), ))
-        file_handle['phases'][-1] = phase
-
-        for group in ("tt1", "tt2", "weight"):
-            for station in self.stations:
-                if station == '':
-                    continue
-                file_handle[group][station].create_group(name=phase)
-                for event1_id in self.eventids:
-                    if event1_id == '':
-                        continue
-                    Logger.info(f"Creating dataset for {event1_id} of "
-                                f"{len(self.eventids)} nans")
-                    file_handle[group][station][phase].create_dataset(
-                        name=event1_id, data=self._empty_correlation_array(),
-                        dtype=float, maxshape=(None, ))
-        if close_file:
-            file_handle.close()
+    @staticmethod
+    def _extend(dataset: h5py.Dataset, values: Iterable):
+        """ Append values to a 1-D dataset with one resize and one write. """
+        values = list(values)
+        if len(values) == 0:
+            return
+        n = dataset.shape[0]
+        dataset.resize((n + len(values), ))
+        dataset[n:] = values
+
+    def _pair_group(self, file_handle: h5py.File, station: str, phase: str):
+        """ Get, or make, the group of pair arrays for a station and phase. """
+        path = f"pairs/{station}/{phase}"
+        if path in file_handle:
+            return file_handle[path]
+        group = file_handle.create_group(path)
+        for name, dtype in self._pair_fields:
+            group.create_dataset(
+                name=name, shape=(0, ), dtype=dtype, maxshape=(None, ),
+                chunks=(self._chunk_size, ))
+        return group
+
+    def flush(self):
+        """ Nothing is buffered, the file is written by update. """
         return
 
     def update(self, other: List[_EventPair]):
@@ -453,41 +524,45 @@ class H5Correlations:
 
 
         Will assume that the correlation for event1 <-> event2 is equal
-        either way, so will set both correlations.
+        either way, so will store it once and mirror it on selection.
+
+        The whole batch is grouped by station and phase in memory and
+        written with one resize and one assignment per dataset.
         """
-        file_handle = h5py.File(self.correlation_file, "r+")
+        new_eventids, new_stations, new_phases = [], [], []
+        # (station, phase) -> columns of event1, event2, tt1, tt2, weight
+        batches = dict()
         for event_pair in tqdm.tqdm(other):
+            indexes = []
+            for eid in (str(event_pair.event_id_1), str(event_pair.event_id_2)):
+                if eid not in self._eventid_index:
+                    self._eventid_index[eid] = len(self.eventids)
+                    self.eventids.append(eid)
+                    new_eventids.append(eid)
+                indexes.append(self._eventid_index[eid])
             for obs in event_pair.obs:
-                # Make the necessary structural changes - heirachy is station/phase/eventids
                 if obs.station not in self.stations:
-                    self._new_station(obs.station, file_handle=file_handle)
+                    self.stations.append(obs.station)
+                    new_stations.append(obs.station)
                 if obs.phase not in self.phases:
-                    self._new_phase(obs.phase, file_handle=file_handle)
-                if str(event_pair.event_id_1) not in self.eventids:
-                    self._new_event_id(
-                        str(event_pair.event_id_1), file_handle=file_handle)
-                if str(event_pair.event_id_2) not in self.eventids:
-                    self._new_event_id(
-                        str(event_pair.event_id_2), file_handle=file_handle)
+                    self.phases.append(obs.phase)
+                    new_phases.append(obs.phase)
+                columns = batches.setdefault(
+                    (obs.station, obs.phase), ([], [], [], [], []))
+                for column, value in zip(
+                        columns,
+                        (indexes[0], indexes[1], obs.tt1, obs.tt2, obs.weight)):
+                    column.append(value)
+        with h5py.File(self.correlation_file, "r+") as f:
+            self._extend(f['eventids'], new_eventids)
+            self._extend(f['stations'], new_stations)
+            self._extend(f['phases'], new_phases)
+            for (station, phase), columns in batches.items():
                 Logger.debug(
-                    f"Updated values for {obs.station} {obs.phase} "
-                    f"{event_pair.event_id_1} -- {event_pair.event_id_2}")
-                # Mirror the changes
-                event_pairings = [
-                    (str(event_pair.event_id_1), str(event_pair.event_id_2)), # forward
-                    (str(event_pair.event_id_2), str(event_pair.event_id_1))  # reverse
-                ]
-                tt_pairings = [(obs.tt1, obs.tt2), (obs.tt2, obs.tt2)]
-
-                for (eid1, eid2), (tt1, tt2) in zip(event_pairings, tt_pairings):
-                    eid2_index = self.eventids.index(eid2)
-                    file_handle['tt1'][obs.station][obs.phase][eid1][
-                        eid2_index] = tt1
-                    file_handle['tt2'][obs.station][obs.phase][eid1][
-                        eid2_index] = tt2
-                    file_handle['weight'][obs.station][obs.phase][eid1][
-                        eid2_index] = obs.weight
-        file_handle.close()
+                    f"Writing {len(columns[0])} values for {station} {phase}")
+                group = self._pair_group(f, station, phase)
+                for (name, dtype), column in zip(self._pair_fields, columns):
+                    self._extend(group[name], np.asarray(column, dtype=dtype))
         return
 
     def select(
@@ -496,8 +571,13 @@ class H5Correlations:
         phase: str = None,
         eventid_1: Union[str, int] = None,
         eventid_2: Union[str, int] = None,
-    ) -> List[_EventPair]:
-        """ Supports glob patterns """
+    ) -> Iterator[_EventPair]:
+        """
+        Supports glob patterns
+
+        The file is read once; event pairs are yielded lazily, ordered by
+        the position of their event ids in the eventids table.
+        """
         station = station or "*"
         phase = phase or "*"
         eid_ints = True  # Should be ints by default because that is what we expect
@@ -515,8 +595,7 @@ class H5Correlations:
         eventid_2 = eventid_2 or "*"
 
         if not eid_ints:
-            Logger.warning("Returning event ids as strings - this may cause "
-                           "issues for formatting output strings")
+            _warn_string_event_ids()
 
         # Work out indexes
         sids = fnmatch.filter(self.stations, station)
@@ -538,41 +617,1091 @@ class H5Correlations:
         if len(event2_ids) == 0:
             raise NotImplementedError(
                 f"{eventid_2} not found in correlations")
+        event1_indexes = np.array(
+            [self._eventid_index[s] for s in event1_ids], dtype=np.int32)
+        event2_indexes = np.array(
+            [self._eventid_index[s] for s in event2_ids], dtype=np.int32)
+        groups = [(s, p) for s in sids for p in pids]
+        # Validate eagerly, read lazily
+        return self._iter_pairs(groups, event1_indexes, event2_indexes,
+                                eid_ints)
+
+    def _read_selection(
+        self,
+        groups: List[Tuple[str, str]],
+        event1_indexes: np.ndarray,
+        event2_indexes: np.ndarray,
+    ) -> Dict[str, np.ndarray]:
+        """
+        Read the mirrored pair rows of groups between the given events.
+
+        Datasets are read in blocks of whole chunks: event1, event2 and
+        weight are matched per block and the travel-times are only read for
+        blocks holding matching rows, so memory scales with the block size
+        and the selection rather than with the file.
+
+        Returns concatenated event1, event2, tt1, tt2, weight, key (index
+        into groups) and row (position in the file, used to let later
+        entries win) arrays.
+        """
+        columns = {name: [] for name in (
+            "event1", "event2", "tt1", "tt2", "weight", "key", "row")}
+        offset = 0
+        with h5py.File(self.correlation_file, "r") as f:
+            for group_index, (station, phase) in enumerate(groups):
+                path = f"pairs/{station}/{phase}"
+                if path not in f:
+                    continue
+                group = f[path]
+                n = group["event1"].shape[0]
+                for start in range(0, n, self._read_block_size):
+                    stop = min(start + self._read_block_size, n)
+                    event1 = group["event1"][start:stop]
+                    event2 = group["event2"][start:stop]
+                    weight = group["weight"][start:stop]
+                    valid = ~np.isnan(weight)
+                    # Mirror the pairs, the second orientation swaps the events
+                    forward = valid & np.isin(event1, event1_indexes) & \
+                        np.isin(event2, event2_indexes)
+                    backward = valid & np.isin(event2, event1_indexes) & \
+                        np.isin(event1, event2_indexes)
+                    if not (forward.any() or backward.any()):
+                        continue
+                    tt1 = group["tt1"][start:stop]
+                    tt2 = group["tt2"][start:stop]
+                    for mask, first, second, first_tt, second_tt in (
+                            (forward, event1, event2, tt1, tt2),
+                            (backward, event2, event1, tt2, tt1)):
+                        rows = np.flatnonzero(mask)
+                        if len(rows) == 0:
+                            continue
+                        columns["event1"].append(first[rows])
+                        columns["event2"].append(second[rows])
+                        columns["tt1"].append(first_tt[rows])
+                        columns["tt2"].append(second_tt[rows])
+                        columns["weight"].append(weight[rows])
+                        columns["key"].append(
+                            np.full(len(rows), group_index, dtype=np.int32))
+                        columns["row"].append(rows + offset + start)
+                offset += n
+        if len(columns["event1"]) == 0:
+            return None
+        return {name: np.concatenate(values)
+                for name, values in columns.items()}
+
+    def read_columns(self) -> Tuple[Union[Dict[str, np.ndarray], None],
+                                    List[str], List[Tuple[str, str]]]:
+        """
+        Read every stored record as mirrored columns (see _latest_columns),
+        or None if there are none, with the eventids and (station, phase)
+        names that the event and key columns index.
+        """
+        groups = [(s, p) for s in self.stations for p in self.phases]
+        events = np.arange(len(self.eventids), dtype=np.int32)
+        return (self._read_selection(groups, events, events), self.eventids,
+                groups)
+
+    def _iter_pairs(
+        self,
+        groups: List[Tuple[str, str]],
+        event1_indexes: np.ndarray,
+        event2_indexes: np.ndarray,
+        eid_ints: bool,
+    ) -> Iterator[_EventPair]:
+        selection = self._read_selection(
+            groups, event1_indexes, event2_indexes)
+        if selection is None:
+            return
+        yield from _event_pairs_from_columns(
+            selection, eventids=self.eventids, obs_names=groups,
+            eid_ints=eid_ints)
+
+
+SEGMENT_DTYPE = np.dtype([
+    ("event1", "u4"),  # Index into the eventids table
+    ("event2", "u4"),
+    ("station", "u2"),  # Index into the stations table
+    ("phase", "u1"),  # Index into the phases table
+    ("tt1", "f8"),
+    ("tt2", "f8"),
+    ("weight", "f8"),
+])
+
+# Event index of a segment: every record appears under both of its events
+SEGMENT_INDEX_DTYPE = np.dtype([
+    ("event", "u4"),  # Index into the eventids table
+    ("row", "u4"),  # Record number in the segment
+])
+
+
+class SegmentCorrelations:
+    """
+    Holder for correlations in append-only segment files.
+
+    Correlations are stored in a directory of:
+
+    eventids.txt, stations.txt, phases.txt - append-only name tables, the
+        line number is the index used in records
+    segment_000000.seg, ... - SEGMENT_DTYPE records in the order written
+    segment_000000.idx, ... - SEGMENT_INDEX_DTYPE event index of each full
+        segment, sorted by event, so that selecting events reads only their
+        records. The index of the segment being written is kept in memory.
+
+    Records are buffered in memory and written in one call per flush. Each
+    pair is stored once and mirrored on selection, later records for a
+    pair, station and phase replace earlier ones. Once there are more than
+    max_segments segments they are compacted into one.
+
+    :param correlation_directory: Directory to store correlations in.
+    :param buffer_size: Number of records to buffer before writing.
+    :param segment_size: Number of records after which a new segment starts.
+    :param max_segments: Number of segments that triggers compaction.
+    """
+    _tables = ("eventids", "stations", "phases")
+    # Number of names each table can hold, set by the record field width
+    _table_limits = {
+        "eventids": np.iinfo(SEGMENT_DTYPE["event1"]).max + 1,
+        "stations": np.iinfo(SEGMENT_DTYPE["station"]).max + 1,
+        "phases": np.iinfo(SEGMENT_DTYPE["phase"]).max + 1,
+    }
+
+    def __init__(
+        self,
+        correlation_directory: str = None,
+        buffer_size: int = 100000,
+        segment_size: int = 2 ** 22,
+        max_segments: int = 16,
+    ):
+        if correlation_directory is None:
+            correlation_directory = ".correlations"
+        self._correlation_directory = os.path.abspath(correlation_directory)
+        if not os.path.isdir(self._correlation_directory):
+            os.makedirs(self._correlation_directory)
+        self.buffer_size = buffer_size
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self._names = {name: self._read_table(name) for name in self._tables}
+        self._name_indexes = {
+            name: {value: i for i, value in enumerate(values)}
+            for name, values in self._names.items()}
+        self._new_names = {name: [] for name in self._tables}
+        self._buffer = []
+        self._event_indexes = dict()
+        self._segments = sorted(glob.glob(
+            os.path.join(self._correlation_directory, "segment_*.seg")))
+        if len(self._segments):
+            # Drop a partially written trailing record
+            size = os.path.getsize(self._segments[-1])
+            if size % SEGMENT_DTYPE.itemsize:
+                Logger.warning(f"Truncating partial record in "
+                               f"{self._segments[-1]}")
+                os.truncate(self._segments[-1],
+                            size - size % SEGMENT_DTYPE.itemsize)
+
+    def __repr__(self):
+        return (f"SegmentCorrelations(correlation_directory="
+                f"{self.correlation_directory})")
+
+    def _get_correlation_directory(self):
+        return self._correlation_directory
+
+    correlation_directory = property(fget=_get_correlation_directory)
+
+    eventids = property(fget=lambda self: self._names["eventids"])
+    stations = property(fget=lambda self: self._names["stations"])
+    phases = property(fget=lambda self: self._names["phases"])
+
+    def _table_file(self, name: str) -> str:
+        return os.path.join(self.correlation_directory, f"{name}.txt")
+
+    def _read_table(self, name: str) -> List[str]:
+        if not os.path.isfile(self._table_file(name)):
+            return []
+        with open(self._table_file(name), "r") as f:
+            # Anything after the last newline was not completely written
+            return f.read().split("\n")[:-1]
+
+    def _index(self, name: str, value: str) -> int:
+        """ Get the index of a name, adding it to its table if new. """
+        index = self._name_indexes[name].get(value)
+        if index is None:
+            index = len(self._names[name])
+            if index >= self._table_limits[name]:
+                raise ValueError(
+                    f"Cannot add {value} to {name}: segment records hold at "
+                    f"most {self._table_limits[name]} {name}")
+            self._names[name].append(value)
+            self._name_indexes[name][value] = index
+            self._new_names[name].append(value)
+        return index
+
+    def _read_segment(self, segment: str) -> Union[np.ndarray, None]:
+        if os.path.getsize(segment) < SEGMENT_DTYPE.itemsize:
+            return None
+        return np.memmap(segment, dtype=SEGMENT_DTYPE, mode="r")
+
+    @staticmethod
+    def _index_file(segment: str) -> str:
+        return f"{segment[:-len('.seg')]}.idx"
+
+    def _segment_full(self, segment: str) -> bool:
+        return (segment != self._segments[-1] or os.path.getsize(segment)
+                >= self.segment_size * SEGMENT_DTYPE.itemsize)
+
+    def _event_index(self, segment: str, records: np.ndarray) -> np.ndarray:
+        """
+        Get the event index of a segment, from memory, its index file or
+        by building it. Indexes not covering every record are rebuilt.
+        """
+        index = self._event_indexes.get(segment)
+        if index is not None and len(index) == 2 * len(records):
+            return index
+        index_file = self._index_file(segment)
+        if os.path.isfile(index_file) and (os.path.getsize(index_file)
+                                           == 2 * len(records) * SEGMENT_INDEX_DTYPE.itemsize):
+            index = np.fromfile(index_file, dtype=SEGMENT_INDEX_DTYPE)
         else:
-            event2_indexes = [
-                (s, self.eventids.index(s)) for s in event2_ids]
-        out = []
-        for event1_id in event1_ids:
-            if event1_id == '':
+            rows = np.arange(len(records), dtype=np.uint32)
+            events = np.concatenate((records["event1"], records["event2"]))
+            order = np.argsort(events, kind="stable")
+            index = np.empty(len(events), dtype=SEGMENT_INDEX_DTYPE)
+            index["event"] = events[order]
+            index["row"] = np.concatenate((rows, rows))[order]
+            if self._segment_full(segment):
+                # Full segments no longer change, keep their index
+                tmp_file = f"{index_file}.tmp"
+                index.tofile(tmp_file)
+                os.replace(tmp_file, index_file)
+        self._event_indexes[segment] = index
+        return index
+
+    def _event_rows(self, segment: str, records: np.ndarray,
+                    events: np.ndarray) -> np.ndarray:
+        """ Record numbers of a segment involving any of events, in order. """
+        index = self._event_index(segment, records)
+        starts = np.searchsorted(index["event"], events, side="left")
+        ends = np.searchsorted(index["event"], events, side="right")
+        rows = [index["row"][start:end] for start, end in zip(starts, ends)
+                if end > start]
+        if len(rows) == 0:
+            return np.array([], dtype=np.int64)
+        return np.unique(np.concatenate(rows)).astype(np.int64)
+
+    def _next_segment(self) -> str:
+        if len(self._segments):
+            number = int(os.path.basename(
+                self._segments[-1])[len("segment_"):-len(".seg")]) + 1
+        else:
+            number = 0
+        return os.path.join(self.correlation_directory,
+                            f"segment_{number:06d}.seg")
+
+    def update(self, other: List[_EventPair]):
+        """
+        Add correlations for event pairs, written once buffer_size records
+        are buffered or on flush.
+        """
+        for event_pair in tqdm.tqdm(other):
+            event1 = self._index("eventids", str(event_pair.event_id_1))
+            event2 = self._index("eventids", str(event_pair.event_id_2))
+            for obs in event_pair.obs:
+                self._buffer.append((
+                    event1, event2, self._index("stations", obs.station),
+                    self._index("phases", obs.phase), obs.tt1, obs.tt2,
+                    obs.weight))
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+        return
+
+    def flush(self):
+        """ Write buffered records, compacting if there are too many segments. """
+        if len(self._buffer) == 0:
+            return
+        # Names must be on disk before records refer to them
+        for name, values in self._new_names.items():
+            if len(values) == 0:
                 continue
-            if eid_ints:
-                event1_id_out = int(event1_id)
+            with open(self._table_file(name), "a") as f:
+                f.write("".join(f"{value}\n" for value in values))
+            values.clear()
+        records = np.array(self._buffer, dtype=SEGMENT_DTYPE)
+        self._buffer = []
+        if (len(self._segments) == 0 or os.path.getsize(self._segments[-1])
+                >= self.segment_size * SEGMENT_DTYPE.itemsize):
+            self._segments.append(self._next_segment())
+        with open(self._segments[-1], "ab") as f:
+            records.tofile(f)
+        Logger.debug(f"Wrote {len(records)} records to {self._segments[-1]}")
+        if len(self._segments) > self.max_segments:
+            self.compact()
+        return
+
+    def compact(self):
+        """ Rewrite all segments as one, keeping only the latest records. """
+        self.flush()
+        segments = [self._read_segment(segment) for segment in self._segments]
+        segments = [segment for segment in segments if segment is not None]
+        if len(segments) == 0:
+            return
+        records = np.concatenate(segments)
+        first = np.minimum(records["event1"], records["event2"])
+        second = np.maximum(records["event1"], records["event2"])
+        order = np.lexsort((np.arange(len(records)), records["phase"],
+                            records["station"], second, first))
+        last = np.ones(len(order), dtype=bool)
+        last[:-1] = (
+            (first[order][1:] != first[order][:-1])
+            | (second[order][1:] != second[order][:-1])
+            | (records["station"][order][1:] != records["station"][order][:-1])
+            | (records["phase"][order][1:] != records["phase"][order][:-1]))
+        # Keep write order so that later segments still win
+        records = records[np.sort(order[last])]
+        compacted = self._next_segment()
+        tmp_file = f"{compacted}.tmp"
+        records.tofile(tmp_file)
+        os.replace(tmp_file, compacted)
+        del segments
+        for segment in self._segments:
+            os.remove(segment)
+            if os.path.isfile(self._index_file(segment)):
+                os.remove(self._index_file(segment))
+        self._event_indexes = dict()
+        Logger.info(f"Compacted {len(self._segments)} segments into "
+                    f"{len(records)} records")
+        self._segments = [compacted]
+        return
+
+    def select(
+        self,
+        station: str = None,
+        phase: str = None,
+        eventid_1: Union[str, int] = None,
+        eventid_2: Union[str, int] = None,
+    ) -> Iterator[_EventPair]:
+        """
+        Supports glob patterns
+
+        Selections naming events only read the records of those events,
+        found through the segment event indexes; otherwise every segment is
+        scanned.
+        """
+        self.flush()
+        station = station or "*"
+        phase = phase or "*"
+        eid_ints = True  # Should be ints by default because that is what we expect
+        if isinstance(eventid_1, int):
+            eventid_1 = str(eventid_1)
+        elif isinstance(eventid_1, str):
+            eid_ints = False
+
+        if isinstance(eventid_2, int):
+            eventid_2 = str(eventid_2)
+        elif isinstance(eventid_2, str):
+            eid_ints = False
+
+        eventid_1 = eventid_1 or "*"
+        eventid_2 = eventid_2 or "*"
+
+        if not eid_ints:
+            _warn_string_event_ids()
+
+        indexes = dict()
+        for key, name, pattern in (("station", "stations", station),
+                                   ("phase", "phases", phase),
+                                   ("event1", "eventids", eventid_1),
+                                   ("event2", "eventids", eventid_2)):
+            matched = fnmatch.filter(self._names[name], pattern)
+            if len(matched) == 0:
+                raise NotImplementedError(
+                    f"{pattern} not found in correlations")
+            indexes[key] = np.array(
+                [self._name_indexes[name][m] for m in matched])
+        # Look up records by the narrower of the event selections
+        events = None
+        for key, pattern in (("event1", eventid_1), ("event2", eventid_2)):
+            if pattern != "*" and (events is None
+                                   or len(indexes[key]) < len(events)):
+                events = np.sort(indexes[key])
+        # Validate eagerly, read lazily
+        return self._iter_pairs(indexes, eid_ints, events)
+
+    def read_columns(self) -> Tuple[Union[Dict[str, np.ndarray], None],
+                                    List[str], Dict[int, Tuple[str, str]]]:
+        """
+        Read every stored record as mirrored columns (see _latest_columns),
+        or None if there are none, with the eventids and (station, phase)
+        names that the event and key columns index.
+        """
+        self.flush()
+        indexes = {
+            "station": np.arange(len(self.stations)),
+            "phase": np.arange(len(self.phases)),
+            "event1": np.arange(len(self.eventids)),
+            "event2": np.arange(len(self.eventids))}
+        columns, obs_names = self._read_columns(indexes)
+        return columns, self.eventids, obs_names
+
+    def _read_columns(
+        self,
+        indexes: Dict[str, np.ndarray],
+        events: np.ndarray = None,
+    ) -> Tuple[Union[Dict[str, np.ndarray], None],
+               Dict[int, Tuple[str, str]]]:
+        """
+        Read the mirrored records matching indexes, looking them up by
+        events if given. Returns the columns, or None, and the (station,
+        phase) names of their keys.
+        """
+        columns = {name: [] for name in (
+            "event1", "event2", "tt1", "tt2", "weight", "key", "row")}
+        offset = 0
+        for segment in self._segments:
+            segment_records = self._read_segment(segment)
+            if segment_records is None:
+                continue
+            if events is None:
+                records, record_rows = segment_records, None
             else:
-                event1_id_out = event1_id
-            for event2_id, event2_index in event2_indexes:
-                if event2_id == '':
+                record_rows = self._event_rows(
+                    segment, segment_records, events)
+                records = segment_records[record_rows]
+            valid = (np.isin(records["station"], indexes["station"])
+                     & np.isin(records["phase"], indexes["phase"])
+                     & ~np.isnan(records["weight"]))
+            # Mirror the pairs, the second orientation swaps the events
+            for first, second, tt1, tt2 in (
+                    ("event1", "event2", "tt1", "tt2"),
+                    ("event2", "event1", "tt2", "tt1")):
+                rows = np.flatnonzero(
+                    valid & np.isin(records[first], indexes["event1"])
+                    & np.isin(records[second], indexes["event2"]))
+                if len(rows) == 0:
                     continue
-                if eid_ints:
-                    event2_id_out = int(event2_id)
-                else:
-                    event2_id_out = event2_id
-                event_pair = _EventPair(
-                    event_id_1=event1_id_out, event_id_2=event2_id_out, obs=[])
-                for station in sids:
-                    if station == '':
-                        continue
-                    for phase in pids:
-                        if phase == '':
-                            continue
-                        obs = self._get_correlation(
-                            station=station, phase=phase, event1_id=event1_id,
-                            event2_index=event2_index)
-                        if not np.isnan(obs.weight):
-                            event_pair.obs.append(obs)
-                if len(event_pair.obs) > 0:
-                    out.append(event_pair)
+                columns["event1"].append(np.array(records[first][rows]))
+                columns["event2"].append(np.array(records[second][rows]))
+                columns["tt1"].append(np.array(records[tt1][rows]))
+                columns["tt2"].append(np.array(records[tt2][rows]))
+                columns["weight"].append(np.array(records["weight"][rows]))
+                columns["key"].append(
+                    records["station"][rows].astype(np.int64) * 256
+                    + records["phase"][rows])
+                if record_rows is not None:
+                    rows = record_rows[rows]
+                columns["row"].append(rows + offset)
+            offset += len(segment_records)
+            del records, segment_records
+        if len(columns["event1"]) == 0:
+            return None, dict()
+        columns = {name: np.concatenate(values)
+                   for name, values in columns.items()}
+        obs_names = {
+            key: (self.stations[key // 256], self.phases[key % 256])
+            for key in np.unique(columns["key"])}
+        return columns, obs_names
+
+    def _iter_pairs(
+        self,
+        indexes: Dict[str, np.ndarray],
+        eid_ints: bool,
+        events: np.ndarray = None,
+    ) -> Iterator[_EventPair]:
+        columns, obs_names = self._read_columns(indexes, events)
+        if columns is None:
+            return
+        yield from _event_pairs_from_columns(
+            columns, eventids=self.eventids, obs_names=obs_names,
+            eid_ints=eid_ints)
+
+
+CORRELATION_STORES = {
+    "h5": H5Correlations,
+    "hdf5": H5Correlations,
+    "seg": SegmentCorrelations,
+    "csv": Correlations,
+}
+
+
+def open_correlations(
+    path: str,
+    store: str = None,
+) -> Union[Correlations, H5Correlations, SegmentCorrelations]:
+    """
+    Open a correlation store.
+
+    :param path: File or directory of the store.
+    :param store:
+        Key of CORRELATION_STORES, by default taken from the extension of
+        path. Paths with other extensions are Correlations directories.
+    """
+    if store is None:
+        store = os.path.splitext(path)[1].lstrip(".").lower()
+    return CORRELATION_STORES.get(store, Correlations)(path)
+
+
+EARTH_RADIUS_KM = 6371.009  # Mean radius used by eqcorrscan's dist_calc
+
+
+def _event_location(event: Union[Event, SparseEvent]) -> Tuple[float, float, float]:
+    """ Get (latitude, longitude, depth in km) of the preferred origin. """
+    origin = event.preferred_origin() or event.origins[0]
+    return origin.latitude, origin.longitude, origin.depth / 1000.0
+
+
+def _to_ecef_km(latitude, longitude, depth_km) -> np.ndarray:
+    """ Convert geographic locations to spherical-earth ECEF km. """
+    lat = np.radians(np.atleast_1d(np.asarray(latitude, dtype=float)))
+    lon = np.radians(np.atleast_1d(np.asarray(longitude, dtype=float)))
+    radius = EARTH_RADIUS_KM - np.atleast_1d(np.asarray(depth_km, dtype=float))
+    return np.column_stack((
+        radius * np.cos(lat) * np.cos(lon),
+        radius * np.cos(lat) * np.sin(lon),
+        radius * np.sin(lat)))
+
+
+class _EventSpatialIndex:
+    """
+    Incremental 3-D spatial index of event hypocentres in ECEF km.
+
+    Points live in a static cKDTree plus a small buffer of recent additions
+    that is searched by brute force. The tree is rebuilt once the buffer
+    grows beyond rebuild_fraction of the indexed points, so n insertions
+    cost O(n log n) overall.
+
+    Straight-line ECEF distances differ slightly from the flat-earth
+    distances used by dist_array_km, so query radii should be widened with
+    pad_radius and the candidates filtered on exact distances.
+    """
+    def __init__(self, rebuild_fraction: float = 0.1, min_rebuild: int = 64):
+        self.rebuild_fraction = rebuild_fraction
+        self.min_rebuild = min_rebuild
+        self._tree = None
+        self._tree_points = np.empty((0, 3))
+        self._buffer = []
+
+    def __len__(self):
+        return len(self._tree_points) + len(self._buffer)
+
+    def __repr__(self):
+        return (f"_EventSpatialIndex(indexed={len(self._tree_points)}, "
+                f"buffered={len(self._buffer)})")
+
+    @staticmethod
+    def pad_radius(radius: float) -> float:
+        """ Widen an exact-distance radius to a safe ECEF search radius. """
+        return radius * 1.05 + 0.1
+
+    def add(self, latitude: float, longitude: float, depth_km: float) -> int:
+        """ Add a location, returning its position (insertion order). """
+        self._buffer.append(_to_ecef_km(latitude, longitude, depth_km)[0])
+        if len(self._buffer) > max(
+                self.min_rebuild,
+                self.rebuild_fraction * len(self._tree_points)):
+            self._rebuild()
+        return len(self) - 1
+
+    def _rebuild(self):
+        self._tree_points = np.vstack([self._tree_points] + self._buffer)
+        self._tree = cKDTree(self._tree_points)
+        self._buffer = []
+
+    def _buffer_distances(self, point: np.ndarray) -> np.ndarray:
+        if len(self._buffer) == 0:
+            return np.empty(0)
+        return np.linalg.norm(np.asarray(self._buffer) - point, axis=1)
+
+    def query_radius(
+        self,
+        latitude: float,
+        longitude: float,
+        depth_km: float,
+        radius: float,
+    ) -> np.ndarray:
+        """ Positions of all points within radius km, in insertion order. """
+        point = _to_ecef_km(latitude, longitude, depth_km)[0]
+        positions = []
+        if self._tree is not None:
+            positions.extend(self._tree.query_ball_point(point, r=radius))
+        buffer_dist = self._buffer_distances(point)
+        positions.extend(
+            np.flatnonzero(buffer_dist <= radius) + len(self._tree_points))
+        return np.sort(np.asarray(positions, dtype=int))
+
+    def kth_distance(
+        self,
+        latitude: float,
+        longitude: float,
+        depth_km: float,
+        k: int,
+    ) -> float:
+        """ ECEF distance to the k-th nearest point, inf if fewer points. """
+        if k > len(self):
+            return np.inf
+        point = _to_ecef_km(latitude, longitude, depth_km)[0]
+        distances = [self._buffer_distances(point)]
+        if self._tree is not None:
+            tree_dist, _ = self._tree.query(
+                point, k=min(k, len(self._tree_points)))
+            distances.append(np.atleast_1d(tree_dist))
+        distances = np.sort(np.concatenate(distances))
+        return float(distances[k - 1])
+
+
+def _cache_key(rid: str) -> str:
+    """ Stable key of an event in correlation stores, as for waveform files. """
+    return rid.split('/')[-1]
+
+
+def _pick_fingerprint(event: Union[Event, SparseEvent]) -> str:
+    """ Digest of the picks of an event, changes when any pick changes. """
+    picks = sorted(
+        f"{p.waveform_id.get_seed_string()} {p.phase_hint} {p.time}"
+        for p in event.picks)
+    return hashlib.sha1("\n".join(picks).encode()).hexdigest()
+
+
+class _CorrelationCache:
+    """
+    Store of raw correlations from previous runs for incremental correlation.
+
+    Correlations are kept in any of the CORRELATION_STORES (chosen by the
+    extension of path, see open_correlations), keyed by _cache_key. A
+    <store>.meta.json file beside the store records the parameters the
+    correlations were made with and a pick fingerprint for every event that
+    has been correlated as a master event. Those events are known: pairs
+    between two known events are read back rather than recomputed.
+
+    The known events are fixed for a run. Events correlated during the run
+    are kept as pending in the metadata at each checkpoint and only become
+    known once the run completes, so that a re-picked event does not read
+    back pairs that were made with its old picks.
+
+    Stores with read_columns (hdf5 and segment stores) are read once, on
+    the first get, into columns sorted by master event; get then slices
+    them. Other stores are selected from per master event.
+
+    A store made with different parameters, or in a layout it cannot
+    read, is cleared.
+    """
+    def __init__(self, path: str, config: dict):
+        self.path = os.path.abspath(path.rstrip(os.sep))
+        self.meta_file = f"{self.path}.meta.json"
+        self.config = config
+        self.known = dict()  # key -> pick fingerprint
+        meta = None
+        if os.path.isfile(self.meta_file):
+            with open(self.meta_file, "r") as f:
+                meta = json.load(f)
+        if meta is not None and meta["config"] != config:
+            Logger.warning(
+                f"Correlations in {self.path} were made with different "
+                f"parameters ({meta['config']}), clearing them")
+            self._clear()
+            meta = None
+        self._new = dict()  # Events correlated in this run
+        if meta is not None:
+            self.known = meta["events"]
+            # Correlated by an interrupted run
+            self._new = meta.get("pending", dict())
+        elif os.path.exists(self.path):
+            Logger.warning(f"No metadata for {self.path}, clearing it")
+            self._clear()
+        self._pairs = None  # Stored records, read on the first get
+        try:
+            self.store = open_correlations(self.path)
+        except ValueError as e:
+            Logger.warning(f"Cannot use {self.path} ({e}), clearing it")
+            self._clear()
+            self.known, self._new = dict(), dict()
+            self.store = open_correlations(self.path)
+        Logger.info(f"Correlation cache {self.path} knows "
+                    f"{len(self.known)} events")
+
+    def __repr__(self):
+        return f"_CorrelationCache(path={self.path}, known={len(self.known)})"
+
+    def _clear(self):
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        elif os.path.isfile(self.path):
+            os.remove(self.path)
+        if os.path.isfile(self.meta_file):
+            os.remove(self.meta_file)
+
+    def is_known(self, event: Union[Event, SparseEvent]) -> bool:
+        key = _cache_key(event.resource_id.id)
+        return self.known.get(key) == _pick_fingerprint(event)
+
+    def mark(self, event: Union[Event, SparseEvent]):
+        """ Record that event has been correlated as a master event. """
+        self._new[_cache_key(event.resource_id.id)] = _pick_fingerprint(event)
+
+    def get(
+        self,
+        master_key: str,
+        other_keys: Iterable[str],
+    ) -> Dict[str, List[_DTObs]]:
+        """ Stored observations of master_key with each of other_keys. """
+        wanted = set(other_keys)
+        if not hasattr(self.store, "read_columns"):
+            return self._select(master_key, wanted)
+        if self._pairs is None:
+            self._load()
+        columns, eventids, eventid_index, obs_names = self._pairs
+        master = eventid_index.get(master_key)
+        if columns is None or master is None:
+            return dict()
+        # Rows are sorted by event1, so the master's rows are contiguous
+        start, end = np.searchsorted(columns["event1"], [master, master + 1])
+        others = [eventid_index[key] for key in wanted if key in eventid_index]
+        rows = start + np.flatnonzero(
+            np.isin(columns["event2"][start:end], others))
+        out = dict()
+        for i in rows:
+            station, phase = obs_names[columns["key"][i]]
+            out.setdefault(eventids[columns["event2"][i]], []).append(_DTObs(
+                station=station, tt1=float(columns["tt1"][i]),
+                tt2=float(columns["tt2"][i]),
+                weight=float(columns["weight"][i]), phase=phase))
+        return out
+
+    def _select(
+        self,
+        master_key: str,
+        wanted: set,
+    ) -> Dict[str, List[_DTObs]]:
+        """
+        Stored observations of master_key with wanted, selected from the
+        store in both orientations. Updates keep one orientation per pair
+        and station, so the two selections do not overlap.
+        """
+        out = dict()
+        for reverse, pattern in ((False, dict(eventid_1=master_key)),
+                                 (True, dict(eventid_2=master_key))):
+            try:
+                event_pairs = self.store.select(**pattern)
+            except NotImplementedError:
+                continue
+            for event_pair in event_pairs:
+                other_key = str(event_pair.event_id_1 if reverse
+                                else event_pair.event_id_2)
+                if other_key not in wanted:
+                    continue
+                obs = event_pair.obs
+                if reverse:
+                    # Stored from the other event, swap the travel-times
+                    obs = [_DTObs(station=o.station, tt1=o.tt2, tt2=o.tt1,
+                                  weight=o.weight, phase=o.phase) for o in obs]
+                out.setdefault(other_key, []).extend(obs)
         return out
 
+    def _load(self):
+        """ Read the latest stored records, sorted by master event. """
+        columns, eventids, obs_names = self.store.read_columns()
+        if columns is not None:
+            columns = _latest_columns(columns)
+            del columns["row"]
+        eventids = list(eventids)
+        self._pairs = (columns, eventids,
+                       {eid: i for i, eid in enumerate(eventids)}, obs_names)
+        Logger.info(f"Read {0 if columns is None else len(columns['event1'])} "
+                    f"records from the correlation cache {self.path}")
+
+    def unload(self):
+        """ Drop the records read by get, they are read again when needed. """
+        self._pairs = None
+
+    def update(self, event_pairs: List[_EventPair]):
+        """
+        Add event pairs keyed by _cache_key to the store, replacing any
+        stored pairs of the same events and station.
+        """
+        if len(event_pairs) == 0:
+            return
+        if isinstance(self.store, Correlations):
+            # Otherwise existing files are kept
+            self.store.update(event_pairs, update=True)
+        else:
+            self.store.update(event_pairs)
+
+    def write_meta(self, final: bool = False):
+        """
+        Record the events correlated in this run as pending, or, if final,
+        make them known to later runs.
+        """
+        # Their correlations must be stored before they are known
+        self.store.flush()
+        if final:
+            self.known.update(self._new)
+            self._new = dict()
+        tmp_file = f"{self.meta_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump({"config": self.config, "events": self.known,
+                       "pending": self._new}, f)
+        os.replace(tmp_file, self.meta_file)
+
+
+class _BackgroundWriter:
+    """
+    Write text to a file, and run other output tasks, on a background thread.
+
+    Items are queued in order on a bounded queue, so producers only block
+    when the writer falls max_queue items behind. Errors raised on the
+    thread are re-raised on the next call.
+
+    :param filename: File to append text to.
+    :param max_queue: Maximum number of items waiting to be written.
+    :param buffer_size: Size of the file buffer in bytes.
+    """
+    _flush = object()  # Queued to flush the file buffer
+
+    def __init__(self, filename: str, max_queue: int = 256,
+                 buffer_size: int = 16 * 1024 ** 2):
+        self.filename = filename
+        self._file = open(filename, "a", buffering=buffer_size)
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._error = None
+        self.nbytes, self.write_time, self.wait_time = 0, 0.0, 0.0
+        self._started = time.perf_counter()
+        self._thread = threading.Thread(
+            target=self._run, name=f"writer-{os.path.basename(filename)}",
+            daemon=True)
+        self._thread.start()
+
+    def __repr__(self):
+        return (f"_BackgroundWriter(filename={self.filename}, "
+                f"queued={self._queue.qsize()})")
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                if self._error is not None:
+                    continue  # Drain the queue without writing
+                tic = time.perf_counter()
+                if item is self._flush:
+                    self._file.flush()
+                elif isinstance(item, str):
+                    self._file.write(item)
+                    self.nbytes += len(item)
+                else:
+                    func, args = item
+                    func(*args)
+                self.write_time += time.perf_counter() - tic
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _put(self, item):
+        if self._error is not None:
+            raise self._error
+        tic = time.perf_counter()
+        self._queue.put(item)
+        self.wait_time += time.perf_counter() - tic
+
+    def write(self, text: str):
+        """ Queue text to be appended to the file. """
+        self._put(text)
+
+    def submit(self, func, *args):
+        """ Queue func(*args) to run in order with the writes. """
+        self._put((func, args))
+
+    def flush(self):
+        """ Block until everything queued is written and on disk. """
+        self._put(self._flush)
+        self._queue.join()
+        if self._error is not None:
+            raise self._error
+
+    def close(self):
+        """ Flush, stop the thread and report throughput. """
+        try:
+            self.flush()
+        finally:
+            self._queue.put(None)
+            self._thread.join()
+            self._file.close()
+        elapsed = time.perf_counter() - self._started
+        Logger.info(
+            f"Wrote {self.nbytes / 1024 ** 2:.1f} MB to {self.filename} in "
+            f"{self.write_time:.1f} s of {elapsed:.1f} s "
+            f"({self.nbytes / 1024 ** 2 / max(self.write_time, 1e-9):.1f} "
+            f"MB/s), producers waited {self.wait_time:.1f} s")
+
+
+def _atomic_pickle(obj, filename: str):
+    """ Pickle obj to filename, replacing any existing file atomically. """
+    tmp_filename = f"{filename}.{os.getpid()}.tmp"
+    with open(tmp_filename, "wb") as f:
+        pickle.dump(obj, f)
+    os.replace(tmp_filename, filename)
+
+
+class _WorkingCatalog:
+    """
+    Working-catalog and event-id bookkeeping for the Correlator.
+
+    Holds a running dt.cc id counter, a persistent set of catalog event ids
+    and origin coordinates in a growable array alongside the spatial index,
+    so adding an event costs amortised O(1) rather than a scan of every
+    event already added.
+    """
+    __slots__ = ("event_mapper", "events", "spatial_index", "_event_ids",
+                 "_last_eid", "_locations")
+
+    def __init__(self):
+        self.event_mapper = dict()  # Key to map event ids to dt.cc ids
+        self.events = []  # Sparse Events in spatial index order
+        self.spatial_index = _EventSpatialIndex()
+        self._event_ids = set()
+        self._last_eid = 0
+        self._locations = np.empty((64, 3))  # latitude, longitude, depth km
+
+    def __repr__(self):
+        return (f"_WorkingCatalog(events={len(self)}, "
+                f"mapped={len(self.event_mapper)})")
+
+    def __len__(self):
+        return len(self.events)
+
+    def __iter__(self):
+        return iter(self.events)
+
+    def __contains__(self, event_id: str):
+        return event_id in self._event_ids
+
+    def __getstate__(self):
+        # The spatial index is rebuilt from the locations on load
+        return {"event_mapper": self.event_mapper, "events": self.events,
+                "last_eid": self._last_eid, "locations": self.locations}
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.event_mapper = state["event_mapper"]
+        self._last_eid = state["last_eid"]
+        for event, location in zip(state["events"], state["locations"]):
+            self._add(event, location)
+
+    @property
+    def event_ids(self) -> set:
+        return self._event_ids
+
+    @property
+    def next_eid(self) -> int:
+        return self._last_eid + 1
+
+    @property
+    def locations(self) -> np.ndarray:
+        """ (latitude, longitude, depth km) of events, in insertion order. """
+        return self._locations[:len(self.events)]
+
+    def assign_id(self, event_id: str) -> int:
+        """ Give an event the next dt.cc id, or return its existing id. """
+        if event_id not in self.event_mapper:
+            self._last_eid += 1
+            self.event_mapper[event_id] = self._last_eid
+        return self.event_mapper[event_id]
+
+    def add(self, event: SparseEvent) -> bool:
+        """ Add an event, returns False if its id is already included. """
+        if event.resource_id.id in self._event_ids:
+            return False
+        self._add(event, _event_location(event))
+        return True
+
+    def _add(self, event: SparseEvent, location: Tuple[float, float, float]):
+        n = len(self.events)
+        if n == len(self._locations):
+            self._locations = np.concatenate(
+                [self._locations, np.empty_like(self._locations)])
+        self._locations[n] = location
+        self.spatial_index.add(*location)
+        self.events.append(event)
+        self._event_ids.add(event.resource_id.id)
+
+    def save(self, filename: str):
+        """ Pickle the state to filename, replacing it atomically. """
+        _atomic_pickle(self, filename)
+
+    @classmethod
+    def load(cls, filename: str) -> "_WorkingCatalog":
+        with open(filename, "rb") as f:
+            state = pickle.load(f)
+        if not isinstance(state, cls):
+            raise TypeError(f"{filename} does not hold a {cls.__name__}")
+        return state
+
+
+def _group_bank_requests(
+    bank: WaveBank,
+    requests: Dict[str, List[tuple]],
+) -> Dict[str, List[Tuple[str, tuple]]]:
+    """
+    Map each WaveBank file to the (event id, bulk request) pairs it serves.
+
+    The bank index is read once for the whole time span of the requests.
+    """
+    flat = [(rid, request) for rid, event_requests in requests.items()
+            for request in event_requests]
+    if len(flat) == 0:
+        return dict()
+    index = bank.read_index(
+        starttime=min(request[4] for _, request in flat),
+        endtime=max(request[5] for _, request in flat))
+    if len(index) == 0:
+        return dict()
+    index["location"] = index["location"].fillna("")
+    index["network"] = index["network"].fillna("")
+    starts = index["starttime"].values.astype("datetime64[ns]").astype(
+        np.int64) / 1e9
+    ends = index["endtime"].values.astype("datetime64[ns]").astype(
+        np.int64) / 1e9
+    paths = (str(bank.bank_path) + index["path"]).values
+    rows_by_channel = index.groupby(
+        ["network", "station", "location", "channel"]).indices
+    files = dict()
+    for rid, request in flat:
+        net, sta, loc, chan, t1, t2 = request
+        rows = rows_by_channel.get((net or "", sta, loc or "", chan))
+        if rows is None:
+            continue
+        rows = rows[(starts[rows] <= t2.timestamp) &
+                    (ends[rows] >= t1.timestamp)]
+        for path in set(paths[rows]):
+            files.setdefault(path, []).append((rid, request))
+    return files
+
+
+_WORKER_CORRELATOR = None  # Per-process correlator used by pool workers
+
+
+def _init_correlation_worker(correlator: "Correlator"):
+    global _WORKER_CORRELATOR
+    _WORKER_CORRELATOR = correlator
+
+
+def _correlation_worker(
+    master: Union[Event, SparseEvent],
+    events_to_correlate: Catalog,
+    event_id_mapper: Dict[str, int],
+    max_workers: int = 1,
+    waveform_handles: Dict[str, list] = None,
+) -> List[_EventPair]:
+    if waveform_handles is None:
+        return _WORKER_CORRELATOR._correlate(
+            master, events_to_correlate, event_id_mapper=event_id_mapper,
+            max_workers=max_workers)
+    stream_dict, segments = attach_streams(waveform_handles)
+    try:
+        return _WORKER_CORRELATOR._correlate(
+            master, events_to_correlate, event_id_mapper=event_id_mapper,
+            max_workers=max_workers, stream_dict=stream_dict)
+    finally:
+        detach_streams(stream_dict, segments)
+
 
 class Correlator:
     def __init__(
@@ -590,7 +1719,16 @@ class Correlator:
         max_event_links: int = None,
         outfile: str = "dt.cc",
         weight_by_square: bool = False,
-        # correlation_cache: str = None
+        waveform_cache_bytes: int = 2 * 1024 ** 3,
+        use_shared_memory: bool = False,
+        waveform_archive: str = None,
+        checkpoint: str = None,
+        checkpoint_interval: int = 500,
+        resume: bool = False,
+        correlation_cache: str = None,
+        depurate: bool = False,
+        dtcc_sidecar: bool = False,
+        background_write: bool = False,
     ):
         self.minlink = minlink
         self.maxsep = maxsep
@@ -602,19 +1740,159 @@ class Correlator:
         self.highcut = highcut
         self.interpolate = interpolate
         self.client = client
-        if os.path.isfile(outfile):
-            Logger.warning(f"{outfile} exists, removing.")
-            os.remove(outfile)
         self.outfile = outfile
         self.min_cc = min_cc
         self.weight_by_square = weight_by_square
-        # self.correlation_cache = Correlations(
-        #     correlation_directory=correlation_cache)
-        self._catalog = set()  # List of Sparse Events
-        self._pairs_run = set()  # Cache of what work has already been done
-        self.event_mapper = dict()  # Key to map event ids to dt.cc ids
+        # Apply the dt.cc depuration rules while writing
+        self.depurate = depurate
+        self.depuration_rejections = dict(
+            min_cc=0, shift_len=0, duplicate=0, min_link=0)
+        # Unfiltered correlations beside dt.cc for re-filtering later
+        self._dtcc_sidecar = None
+        if dtcc_sidecar:
+            self._dtcc_sidecar = DtccSidecar(outfile)
+        # Write dt.cc on a background thread, opened on the first write
+        self.background_write = background_write
+        self._dtcc_writer = None
+        self._working = _WorkingCatalog()  # Sparse Events and id mapping
         self._wf_cache_dir = os.path.abspath(("./.dt_waveforms"))
         self._wf_naming = "{cache_dir}/{event_id}.ms"
+        # Filtered waveforms held in memory, optionally in shared memory
+        # for process-pool workers
+        self._waveform_store = WaveformStore(
+            max_bytes=waveform_cache_bytes,
+            use_shared_memory=use_shared_memory)
+        # Packed on-disk snippets replace the per-event MiniSEED files
+        self._waveform_archive = None
+        if waveform_archive:
+            self._waveform_archive = WaveformArchive(waveform_archive)
+        # Raw correlations kept between runs, pairs between events that
+        # are unchanged since the last run are read back, not recomputed
+        self.correlation_cache = None
+        if correlation_cache:
+            self.correlation_cache = _CorrelationCache(
+                correlation_cache, config=self._correlation_config)
+        self.checkpoint_file = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self._since_checkpoint = 0  # Master events since the last checkpoint
+        resumed = resume and self._load_checkpoint()
+        if not resumed and os.path.isfile(outfile):
+            Logger.warning(f"{outfile} exists, removing.")
+            os.remove(outfile)
+        if not resumed and self._dtcc_sidecar is not None:
+            self._dtcc_sidecar.remove()
+
+    @property
+    def _correlation_config(self) -> dict:
+        """ Parameters that change the raw correlations """
+        return dict(
+            maxsep=self.maxsep, max_event_links=self.max_event_links,
+            shift_len=self.shift_len, pre_pick=self.pre_pick,
+            length=self.length, lowcut=self.lowcut, highcut=self.highcut,
+            interpolate=self.interpolate)
+
+    @property
+    def _config(self) -> dict:
+        """ Parameters that change the content of dt.cc """
+        return dict(
+            minlink=self.minlink, min_cc=self.min_cc, maxsep=self.maxsep,
+            max_event_links=self.max_event_links, shift_len=self.shift_len,
+            pre_pick=self.pre_pick, length=self.length, lowcut=self.lowcut,
+            highcut=self.highcut, interpolate=self.interpolate,
+            weight_by_square=self.weight_by_square, depurate=self.depurate,
+            dtcc_sidecar=self._dtcc_sidecar is not None)
+
+    def checkpoint(self, final: bool = False):
+        """
+        Save everything needed to resume: the working catalog and event id
+        mapping, the dt.cc byte offset and the waveform archive in use. Must only be called between master events.
+
+        final marks the checkpoint at the end of add_events, when events
+        correlated in the run become known to the correlation cache.
+        """
+        if not self.checkpoint_file:
+            # Nothing to resume from, but keep the correlation cache usable
+            if self.correlation_cache is not None:
+                self.correlation_cache.write_meta(final=final)
+            return
+        # Offsets must include everything queued for writing
+        self.flush()
+        outfile_offset = 0
+        if os.path.isfile(self.outfile):
+            outfile_offset = os.path.getsize(self.outfile)
+        waveform_archive = None
+        if self._waveform_archive is not None:
+            waveform_archive = self._waveform_archive.archive
+        state = dict(
+            config=self._config,
+            working=self._working,
+            outfile_offset=outfile_offset,
+            waveform_archive=waveform_archive,
+            depuration_rejections=self.depuration_rejections,
+            dtcc_sidecar_offsets=(self._dtcc_sidecar.offsets()
+                                  if self._dtcc_sidecar is not None else None))
+        _atomic_pickle(state, self.checkpoint_file)
+        if self.correlation_cache is not None:
+            self.correlation_cache.write_meta(final=final)
+        self._since_checkpoint = 0
+        Logger.info(
+            f"Checkpointed {len(self._working)} events and "
+            f"{outfile_offset} bytes of {self.outfile} to "
+            f"{self.checkpoint_file}")
+
+    def flush(self):
+        """ Wait for queued dt.cc output to be written. """
+        if self._dtcc_writer is not None:
+            self._dtcc_writer.flush()
+
+    def close(self):
+        """ Write queued dt.cc output and stop the background writer. """
+        if self._dtcc_writer is not None:
+            writer, self._dtcc_writer = self._dtcc_writer, None
+            writer.close()
+
+    def _checkpoint_due(self) -> bool:
+        return bool(self.checkpoint_file and
+                    self._since_checkpoint >= self.checkpoint_interval)
+
+    def _load_checkpoint(self) -> bool:
+        """ Restore state from the checkpoint file, returns True on success. """
+        if not self.checkpoint_file or not os.path.isfile(self.checkpoint_file):
+            return False
+        with open(self.checkpoint_file, "rb") as f:
+            state = pickle.load(f)
+        if state["config"] != self._config:
+            Logger.warning(
+                f"{self.checkpoint_file} was made with different parameters "
+                f"({state['config']}), starting again")
+            return False
+        outfile_offset = state["outfile_offset"]
+        if outfile_offset and (not os.path.isfile(self.outfile) or
+                               os.path.getsize(self.outfile) < outfile_offset):
+            Logger.warning(
+                f"{self.outfile} is shorter than checkpointed, starting again")
+            return False
+        if os.path.isfile(self.outfile):
+            # Drop anything written after the checkpoint
+            with open(self.outfile, "r+b") as f:
+                f.truncate(outfile_offset)
+        if state["waveform_archive"] and self._waveform_archive is None:
+            Logger.info(f"Checkpoint used waveform archive "
+                        f"{state['waveform_archive']}, reusing it")
+            self._waveform_archive = WaveformArchive(state["waveform_archive"])
+        self._working = state["working"]
+        self.depuration_rejections = state["depuration_rejections"]
+        if self._dtcc_sidecar is not None:
+            self._dtcc_sidecar.truncate(state["dtcc_sidecar_offsets"])
+        Logger.info(
+            f"Resuming from {self.checkpoint_file}: {len(self._working)} "
+            f"events processed")
+        return True
+
+    def clear_checkpoint(self):
+        """ Remove the checkpoint file once the run is complete. """
+        if self.checkpoint_file and os.path.isfile(self.checkpoint_file):
+            os.remove(self.checkpoint_file)
 
     def _get_waveforms(
         self,
@@ -624,25 +1902,15 @@ class Correlator:
         Get and process stream - look in database first, get from client second
         """
         rid = event.resource_id.id
-        if not os.path.isdir(self._wf_cache_dir):
-            os.makedirs(self._wf_cache_dir)
-        waveform_filename = self._wf_naming.format(
-            cache_dir=self._wf_cache_dir,
-            event_id=rid.split('/')[-1])
-        if os.path.isfile(waveform_filename):
-            Logger.debug(f"Reading cached waveforms from {waveform_filename}")
-            st = read(waveform_filename)
-            Logger.debug(f"Read in {len(st)} traces")
+        st = self._waveform_store.get(rid)
+        if st is not None:
+            Logger.debug(f"Using {len(st)} stored traces for {rid}")
             return {rid: st}
+        st = self._read_cached_waveforms(event)
+        if st is not None:
+            return {rid: self._store_waveforms(rid, st)}
         # Get from the client and process - get an excess of data
-        bulk = [(p.waveform_id.network_code,
-                 p.waveform_id.station_code,
-                 p.waveform_id.location_code,
-                 p.waveform_id.channel_code,
-                 p.time - self.pre_pick * 4,
-                 p.time + 4 * (self.length - self.pre_pick))
-                for p in event.picks
-                if p.phase_hint.upper().startswith(("P", "S"))]
+        bulk = self._waveform_requests(event)
         Logger.debug(f"Trying to get data from {self.client} using bulk: {bulk}")
         try:
             st = self.client.get_waveforms_bulk(bulk)
@@ -657,97 +1925,243 @@ class Correlator:
                     Logger.error(e)
                     Logger.info(f"Skipping {_b}")
                     continue
+        return self._process_waveforms(event, st)
+
+    def _waveform_requests(self, event: Union[Event, SparseEvent]) -> List[tuple]:
+        """ Bulk requests covering an excess of data around P and S picks. """
+        return [(p.waveform_id.network_code,
+                 p.waveform_id.station_code,
+                 p.waveform_id.location_code,
+                 p.waveform_id.channel_code,
+                 p.time - self.pre_pick * 4,
+                 p.time + 4 * (self.length - self.pre_pick))
+                for p in event.picks
+                if p.phase_hint.upper().startswith(("P", "S"))]
+
+    def _process_waveforms(
+        self,
+        event: Union[Event, SparseEvent],
+        st: Stream,
+    ) -> Dict[str, Stream]:
+        """ Filter raw waveforms for an event and keep them cached. """
+        rid = event.resource_id.id
         st = st.merge()
         Logger.debug(f"Read in {len(st)} traces")
         if len(st) == 0:
-            return {rid: Stream()}
+            # Remember that there is no data so we do not ask again
+            self._archive_waveforms(event, Stream())
+            return {rid: self._store_waveforms(rid, Stream())}
         st_dict = _filter_stream(
             rid, st.split(), self.lowcut, self.highcut)
+        self._write_cached_waveforms(event, st_dict[rid])
+        st_dict[rid] = self._store_waveforms(rid, st_dict[rid])
+        return st_dict
+
+    def _has_cached_waveforms(self, event: Union[Event, SparseEvent]) -> bool:
+        rid = event.resource_id.id
+        if rid in self._waveform_store:
+            return True
+        if self._waveform_archive is not None:
+            # Snippets cut around other picks are fetched again
+            return (self._waveform_archive.fingerprint(rid)
+                    == _pick_fingerprint(event))
+        return os.path.isfile(self._waveform_filename(rid))
+
+    def prefetch_waveforms(
+        self,
+        catalog: Union[Catalog, Iterable[SparseEvent]],
+    ) -> int:
+        """
+        Fill the waveform cache for all events in catalog before correlating.
+
+        For WaveBank clients the bank index is queried once, requests are
+        grouped by the file that holds them and every file is read once,
+        cutting out the snippets of all events that need it. Events are
+        processed and cached as soon as all of their files have been read.
+        Other clients fall back to fetching event by event.
+
+        Returns the number of events fetched.
+        """
+        events = dict()
+        for ev in catalog:
+            rid = ev.resource_id.id
+            if rid not in events and not self._has_cached_waveforms(ev):
+                events[rid] = ev
+        Logger.info(f"Pre-fetching waveforms for {len(events)} events")
+        if not hasattr(self.client, "read_index"):
+            for ev in tqdm.tqdm(events.values()):
+                self._get_waveforms(event=ev)
+            return len(events)
+        requests = {
+            rid: self._waveform_requests(ev) for rid, ev in events.items()}
+        file_requests = _group_bank_requests(self.client, requests)
+        remaining = dict.fromkeys(events.keys(), 0)
+        for requested in file_requests.values():
+            for rid in {rid for rid, _ in requested}:
+                remaining[rid] += 1
+        raw = {rid: Stream() for rid in events.keys()}
+        for rid, n_files in remaining.items():
+            if n_files == 0:
+                self._process_waveforms(events[rid], raw.pop(rid))
+        Logger.info(f"Reading {len(file_requests)} files")
+        for path in tqdm.tqdm(sorted(file_requests.keys())):
+            try:
+                st = read(path)
+            except Exception as e:
+                Logger.error(f"Could not read {path} due to {e}")
+                st = Stream()
+            traces = dict()
+            for tr in st:
+                traces.setdefault(tr.id, []).append(tr)
+            requested = file_requests[path]
+            for rid, (net, sta, loc, chan, t1, t2) in requested:
+                seed_id = ".".join([net or "", sta, loc or "", chan])
+                for tr in traces.get(seed_id, []):
+                    cut = tr.slice(t1, t2)
+                    if cut.stats.npts:
+                        # Copy so the day-long array can be released
+                        raw[rid] += cut.copy()
+            for rid in {rid for rid, _ in requested}:
+                remaining[rid] -= 1
+                if remaining[rid] == 0:
+                    self._process_waveforms(events[rid], raw.pop(rid))
+        return len(events)
+
+    def _waveform_filename(self, rid: str) -> str:
+        return self._wf_naming.format(
+            cache_dir=self._wf_cache_dir, event_id=rid.split('/')[-1])
+
+    def _read_cached_waveforms(
+        self,
+        event: Union[Event, SparseEvent],
+    ) -> Union[Stream, None]:
+        """ Read processed waveforms from the archive or MiniSEED cache. """
+        rid = event.resource_id.id
+        if self._waveform_archive is not None:
+            return self._waveform_archive.get(
+                rid, fingerprint=_pick_fingerprint(event))
+        waveform_filename = self._waveform_filename(rid)
+        if not os.path.isfile(waveform_filename):
+            return None
+        Logger.debug(f"Reading cached waveforms from {waveform_filename}")
+        st = read(waveform_filename)
+        Logger.debug(f"Read in {len(st)} traces")
+        return st
+
+    def _archive_waveforms(self, event: Union[Event, SparseEvent], st: Stream):
+        if self._waveform_archive is None or self._waveform_archive.read_only:
+            return
+        self._waveform_archive.append(
+            event.resource_id.id, st, phases=pick_phases(event.picks),
+            fingerprint=_pick_fingerprint(event))
+
+    def _write_cached_waveforms(
+        self,
+        event: Union[Event, SparseEvent],
+        st: Stream,
+    ):
+        """ Keep processed waveforms on disk for later events and reruns. """
+        if self._waveform_archive is not None:
+            self._archive_waveforms(event, st)
+            return
+        if not os.path.isdir(self._wf_cache_dir):
+            os.makedirs(self._wf_cache_dir)
+        waveform_filename = self._waveform_filename(event.resource_id.id)
         Logger.debug(f"Writing waveform to {waveform_filename}")
         # Catch and ignore warnings
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
             try:
-                st_dict[rid].write(
-                    waveform_filename, format="MSEED")
+                # Write then rename so concurrent workers never read a
+                # partially written file
+                tmp_filename = f"{waveform_filename}.{os.getpid()}.tmp"
+                st.write(tmp_filename, format="MSEED")
+                os.replace(tmp_filename, waveform_filename)
             except Exception as e:
-                Logger.error(f"Could not write {st_dict[rid]} to "
+                Logger.error(f"Could not write {st} to "
                              f"{waveform_filename} due to {e}")
-        return st_dict
+        return
+
+    def _store_waveforms(self, rid: str, st: Stream) -> Stream:
+        """ Keep waveforms in the store and return the stored copy. """
+        self._waveform_store.put(rid, st)
+        stored = self._waveform_store.get(rid)
+        return st if stored is None else stored
+
+    @property
+    def event_mapper(self) -> Dict[str, int]:
+        """ Key to map event ids to dt.cc ids """
+        return self._working.event_mapper
 
     @property
     def _nexteid(self):
-        last_eid = 0
-        for eid in self.event_mapper.values():
-            if eid > last_eid:
-                last_eid = eid
-        return last_eid + 1
+        return self._working.next_eid
 
     @property
     def _catalog_event_ids(self):
-        return {ev.resource_id.id for ev in self._catalog}
+        return self._working.event_ids
 
     def _append_event(self, event: Union[Event, SparseEvent]):
-        if event.resource_id.id in self._catalog_event_ids:
+        if event.resource_id.id in self._working:
             Logger.info(f"Not adding {event.resource_id.id} to working catalog: "
                         f"event id is already in catalog")
+            return
         if isinstance(event, Event):
-            self._catalog.add(SparseEvent.from_event(event))
-        else:
-            self._catalog.add(event)
+            event = SparseEvent.from_event(event)
+        self._working.add(event)
         return
 
-    def add_event(
+    def save_state(self, filename: str):
+        """ Save the working catalog and event id mapping. """
+        self._working.save(filename)
+
+    def load_state(self, filename: str):
+        """ Restore the working catalog and event id mapping saved by save_state. """
+        self._working = _WorkingCatalog.load(filename)
+        Logger.info(f"Loaded {len(self._working)} events from {filename}")
+
+    def _neighbours(
         self,
         event: Union[Event, SparseEvent],
-        max_workers: int = 1,
-    ) -> int:
-        if event.resource_id.id in self.event_mapper.keys():
-            Logger.info(f"Event {event.resource_id.id} already included, skipping")
-            self._append_event(event)
-            return 0
-        
-        # # If the catalog is empty, add the first event without distance calculations
-        # if len(self._catalog) == 0:
-        #     Logger.info("Catalog is empty. Adding the first event without distance comparison.")
-        #     self._append_event(event)
-        #     return 1  # Return a positive number to indicate successful addition
-
-        self.event_mapper.update({event.resource_id.id: self._nexteid})
-        Logger.info("Getting waveforms")
-        st_dict = self._get_waveforms(event=event)
-        if len(st_dict[event.resource_id.id]) == 0:
-            Logger.warning(
-                f"No waveforms for event {event.resource_id.id}: skipping")
-            self._append_event(event)
-            return 0
-        Logger.info("Computing distance array")
-        ordered_catalog = list(self._catalog)
-        distance_array = dist_array_km(
-            master=event, catalog=ordered_catalog)
-        
-        # We need to retain the distances used for max_event_link #THIS CANNOT HANDLE AN EMPTY ORDERED_CATALOG
-        # events_to_correlate, distance_array = zip(*[
-        #     (ev, dist) for ev, dist in zip(ordered_catalog, distance_array)
-        #     if dist <= self.maxsep])
-        # THIS PART OF THE CODE LEADS TO AN ERROR IF ordered_catalog IS EMPTY. WHICH IT ALWAYS IS BECAUSE WE CONSTRUCT THE CORRELATOR WITHOUT A CATALOG.
-        # A SOLUTION WOULD BE TO CHECK FOR EMPTY LIST BEFORE UNPACKING
-
-        filtered_events = [ (ev, dist) for ev, dist in zip(ordered_catalog, distance_array) if dist <= self.maxsep]
-
-        if filtered_events:
-            events_to_correlate, distance_array = zip(*filtered_events) # IF THERE ARE EVENTS, WE UNPACK THEM
-        else:
-            events_to_correlate, distance_array = [], [] # IF THERE ARE NO EVENTS, WE OUTPUT SOME EMPTY LISTS 
+    ) -> Tuple[List[SparseEvent], np.ndarray]:
+        """
+        Find working-catalog events within maxsep of event.
 
-        # Convert from tuple to Catalog
+        Candidates come from the spatial index, exact distances are then
+        computed with dist_array_km so the result matches a full scan.
+        """
+        spatial_index = self._working.spatial_index
+        if len(spatial_index) == 0:
+            return [], np.array([])
+        location = _event_location(event)
+        radius = spatial_index.pad_radius(self.maxsep)
+        if self.max_event_links:
+            # Every exact k-nearest event lies within this ECEF radius
+            kth_distance = spatial_index.kth_distance(
+                *location, k=self.max_event_links)
+            radius = min(radius, spatial_index.pad_radius(
+                spatial_index.pad_radius(kth_distance)))
+        positions = spatial_index.query_radius(*location, radius=radius)
+        if len(positions) == 0:
+            return [], np.array([])
+        candidates = [self._working.events[i] for i in positions]
+        distance_array = np.asarray(
+            dist_array_km(master=event, catalog=candidates))
+        keep = np.flatnonzero(distance_array <= self.maxsep)
+        return [candidates[i] for i in keep], distance_array[keep]
+
+    def _select_neighbours(
+        self,
+        event: Union[Event, SparseEvent],
+    ) -> Catalog:
+        """ Get the working-catalog events that event should be correlated with. """
+        Logger.info("Querying spatial index for neighbouring events")
+        events_to_correlate, distance_array = self._neighbours(event)
+
+        # Convert to Catalog
         events_to_correlate = Catalog(events=list(events_to_correlate))
         Logger.info(
             f"There are {len(events_to_correlate)} events to correlate")
-        if len(events_to_correlate) == 0:
-            # We don't need to do anymore work
-            self._append_event(event)
-            return 0
         if self.max_event_links and len(events_to_correlate) > self.max_event_links:
             # We just want the n closest events
             order = np.argsort(distance_array)
@@ -759,6 +2173,74 @@ class Correlator:
             Logger.info(
                 f"Maximum inter-event distance: "
                 f"{distance_array[order[self.max_event_links]]}")
+        return events_to_correlate
+
+    def _split_cached(
+        self,
+        event: Union[Event, SparseEvent],
+        events_to_correlate: Catalog,
+    ) -> Tuple[List[_EventPair], Catalog]:
+        """
+        Split the pairs of a master event into those read from the
+        correlation cache and the events that still need correlating.
+
+        Only pairs between two known events are read back; pairs involving
+        a new event, or missing from the cache, are correlated.
+        """
+        cache = self.correlation_cache
+        if (cache is None or len(events_to_correlate) == 0
+                or not cache.is_known(event)):
+            return [], events_to_correlate
+        known = [ev for ev in events_to_correlate if cache.is_known(ev)]
+        stored = cache.get(
+            _cache_key(event.resource_id.id),
+            [_cache_key(ev.resource_id.id) for ev in known])
+        master_eid = self.event_mapper[event.resource_id.id]
+        cached_pairs, to_correlate = [], Catalog()
+        for ev in events_to_correlate:
+            obs = stored.get(_cache_key(ev.resource_id.id))
+            if obs is None:
+                to_correlate.append(ev)
+                continue
+            cached_pairs.append(_EventPair(
+                event_id_1=master_eid,
+                event_id_2=self.event_mapper[ev.resource_id.id],
+                obs=[_DTObs(station=o.station, tt1=o.tt1, tt2=o.tt2,
+                            weight=o.weight, phase=o.phase) for o in obs]))
+        Logger.info(
+            f"Read {len(cached_pairs)} pairs from the correlation cache, "
+            f"{len(to_correlate)} to correlate")
+        return cached_pairs, to_correlate
+
+    def _mark_correlated(self, event: Union[Event, SparseEvent]):
+        """ Record a master event as correlated in the correlation cache. """
+        if self.correlation_cache is not None:
+            self.correlation_cache.mark(event)
+
+    def _cache_correlations(
+        self,
+        differential_times: List[_EventPair],
+        event_id_mapper: Dict[str, int],
+    ):
+        """ Store newly computed (unfiltered) correlations in the cache. """
+        if self.correlation_cache is None or len(differential_times) == 0:
+            return
+        keys = {eid: _cache_key(rid) for rid, eid in event_id_mapper.items()}
+        self.correlation_cache.update([
+            _EventPair(event_id_1=keys[dt.event_id_1],
+                       event_id_2=keys[dt.event_id_2], obs=list(dt.obs))
+            for dt in differential_times])
+
+    def _get_unit_waveforms(
+        self,
+        event: Union[Event, SparseEvent],
+        events_to_correlate: Catalog,
+    ) -> Dict[str, Stream]:
+        """ Get waveforms for a master event and the events to correlate. """
+        Logger.info("Getting waveforms")
+        st_dict = self._get_waveforms(event=event)
+        if len(st_dict[event.resource_id.id]) == 0:
+            return st_dict
         # Get waveforms for all events in events to correlate
         Logger.info("Getting waveforms for other events")
         for ev in tqdm.tqdm(events_to_correlate):
@@ -768,11 +2250,55 @@ class Correlator:
             else:
                 Logger.warning(
                     f"Could not get waveforms for {ev.resource_id.id}")
+        return st_dict
+
+    def _share_unit_waveforms(
+        self,
+        event: Union[Event, SparseEvent],
+        events_to_correlate: Catalog,
+    ) -> Dict[str, list]:
+        """
+        Load waveforms for a work unit into the store and pin them.
+
+        Returns handles that pool workers can attach to, release the event
+        ids once the unit is done.
+        """
+        handles = dict()
+        for ev in [event] + events_to_correlate.events:
+            self._get_waveforms(event=ev)
+            handles.update(self._waveform_store.handles([ev.resource_id.id]))
+            if ev is event and len(handles[event.resource_id.id]) == 0:
+                # No point loading the others
+                break
+        return handles
+
+    def _correlate(
+        self,
+        event: Union[Event, SparseEvent],
+        events_to_correlate: Catalog,
+        event_id_mapper: Dict[str, int] = None,
+        max_workers: int = 1,
+        stream_dict: Dict[str, Stream] = None,
+    ) -> Union[List[_EventPair], None]:
+        """
+        Get waveforms and compute differential times for one master event.
+        Returns None if the master event has no waveforms.
+        """
+        event_id_mapper = event_id_mapper or self.event_mapper
+        st_dict = stream_dict
+        if st_dict is None:
+            st_dict = self._get_unit_waveforms(event, events_to_correlate)
+        if len(st_dict.get(event.resource_id.id, [])) == 0:
+            Logger.warning(
+                f"No waveforms for event {event.resource_id.id}: skipping")
+            return None
+        # Only pass on events that have data
+        st_dict = {rid: st for rid, st in st_dict.items() if len(st)}
         Logger.info(f"Running correlations for {len(st_dict.keys())} events")
         # Run _compute_dt_correlations
         differential_times = _compute_dt_correlations(
             catalog=events_to_correlate, master=event,
-            min_link=0, event_id_mapper=self.event_mapper,
+            min_link=0, event_id_mapper=event_id_mapper,
             stream_dict=st_dict, min_cc=0.0, extract_len=self.length,
             pre_pick=self.pre_pick, shift_len=self.shift_len,
             interpolate=self.interpolate, max_workers=max_workers,
@@ -782,10 +2308,42 @@ class Correlator:
         for dt in differential_times:
             Logger.info(dt)
         # Differential times is a list of _EventPairs
-        # Logger.info("Updating the cache")
-        # self.correlation_cache.update(differential_times)
+        return differential_times
+
+    def add_event(
+        self,
+        event: Union[Event, SparseEvent],
+        max_workers: int = 1,
+    ) -> int:
+        if event.resource_id.id in self.event_mapper.keys():
+            Logger.info(f"Event {event.resource_id.id} already included, skipping")
+            self._append_event(event)
+            return 0
+
+        self._working.assign_id(event.resource_id.id)
+        events_to_correlate = self._select_neighbours(event)
+        cached_pairs, to_correlate = self._split_cached(
+            event, events_to_correlate)
+        if len(events_to_correlate) == 0:
+            # We don't need to do anymore work
+            self._mark_correlated(event)
+            self._append_event(event)
+            return 0
+        differential_times = []
+        if len(to_correlate):
+            differential_times = self._correlate(
+                event, to_correlate, max_workers=max_workers)
+        if differential_times is None:
+            # Not correlated, later runs must try again
+            differential_times = []
+        else:
+            Logger.info("Updating the cache")
+            self._cache_correlations(
+                differential_times, self._unit_mapper(event, to_correlate))
+            self._mark_correlated(event)
         Logger.info("Writing correlations")
-        written_links = self.write_correlations(differential_times)
+        written_links = self.write_correlations(
+            cached_pairs + differential_times)
         Logger.info(f"Wrote {written_links} event pairs")
         self._append_event(event)
         return written_links
@@ -794,35 +2352,260 @@ class Correlator:
         self,
         catalog: Union[Catalog, Iterable[SparseEvent]],
         max_workers: int = 1,
+        processes: int = 1,
     ) -> int:
-        n, written_links = len(catalog), 0
+        """
+        Correlate each event in catalog with the events added before it.
+
+        With processes > 1 master events are correlated across a process pool
+        while this process assigns event ids and writes dt.cc in catalog
+        order, so the output matches a serial run.
+
+        If a checkpoint file is set, state is checkpointed every
+        checkpoint_interval master events and once all events are added.
+        """
+        try:
+            if processes > 1:
+                written_links = self._add_events_parallel(
+                    catalog, max_workers=max_workers, processes=processes)
+            else:
+                n, written_links = len(catalog), 0
+                for i, event in enumerate(catalog):
+                    Logger.info(f"Adding event {i} for {n}")
+                    written_links += self.add_event(
+                        event, max_workers=max_workers)
+                    self._since_checkpoint += 1
+                    if self._checkpoint_due():
+                        self.checkpoint()
+        finally:
+            self.close()
+            if self.correlation_cache is not None:
+                self.correlation_cache.unload()
+        self.checkpoint(final=True)
+        return written_links
+
+    def _plan_work_units(
+        self,
+        catalog: Union[Catalog, Iterable[SparseEvent]],
+    ) -> Iterator[Tuple[Union[Event, SparseEvent], Catalog, Dict[str, int],
+                        List[_EventPair]]]:
+        """
+        Yield (master, events_to_correlate, event_id_mapper, cached_pairs)
+        work units.
+
+        Event ids are assigned and the working catalog grown in catalog order
+        exactly as add_event does, so each unit only depends on events
+        before it and units can be correlated independently. Pairs read
+        from the correlation cache are returned in cached_pairs and left out
+        of events_to_correlate.
+        """
+        n = len(catalog)
         for i, event in enumerate(catalog):
-            Logger.info(f"Adding event {i} for {n}")
-            written_links += self.add_event(event, max_workers=max_workers)
+            Logger.info(f"Planning event {i} for {n}")
+            if event.resource_id.id in self.event_mapper.keys():
+                Logger.info(f"Event {event.resource_id.id} already included, skipping")
+                self._append_event(event)
+                continue
+            self._working.assign_id(event.resource_id.id)
+            events_to_correlate = self._select_neighbours(event)
+            cached_pairs, to_correlate = self._split_cached(
+                event, events_to_correlate)
+            self._append_event(event)
+            if len(events_to_correlate) == 0:
+                self._mark_correlated(event)
+                continue
+            event_id_mapper = self._unit_mapper(event, events_to_correlate)
+            yield event, to_correlate, event_id_mapper, cached_pairs
+
+    def _unit_mapper(
+        self,
+        event: Union[Event, SparseEvent],
+        events_to_correlate: Catalog,
+    ) -> Dict[str, int]:
+        """ The part of event_mapper needed for one master event. """
+        return {ev.resource_id.id: self.event_mapper[ev.resource_id.id]
+                for ev in [event] + events_to_correlate.events}
+
+    def _worker_copy(self, processes: int = 1):
+        """
+        Copy of the correlator without working-catalog state for workers.
+
+        Each of the processes workers gets an equal share of the waveform
+        store budget, so memory does not grow with the number of workers.
+        """
+        worker = copy.copy(self)
+        worker._working = _WorkingCatalog()
+        # Only this process reads and writes the correlation cache
+        worker.correlation_cache = None
+        worker._dtcc_writer = None
+        # Workers keep their own, private, waveform store
+        worker._waveform_store = WaveformStore(
+            max_bytes=self._waveform_store.max_bytes // max(processes, 1))
+        if self._waveform_archive is not None:
+            # Only this process appends to the archive
+            worker._waveform_archive = WaveformArchive(
+                self._waveform_archive.archive, read_only=True)
+        return worker
+
+    def _add_events_parallel(
+        self,
+        catalog: Union[Catalog, Iterable[SparseEvent]],
+        max_workers: int = 1,
+        processes: int = 2,
+    ) -> int:
+        written_links = 0
+        max_pending = 4 * processes  # Bound the results held in memory
+        pending = deque()
+        share_waveforms = self._waveform_store.use_shared_memory
+        # Workers only read the archive, so the parent fills it
+        fill_archive = (not share_waveforms and
+                        self._waveform_archive is not None)
+
+        def _write_oldest():
+            (future, shared_ids, master, event_id_mapper,
+             cached_pairs) = pending.popleft()
+            differential_times = future.result()
+            if differential_times is None:
+                # Not correlated, later runs must try again
+                differential_times = []
+            else:
+                self._cache_correlations(differential_times, event_id_mapper)
+                self._mark_correlated(master)
+            links = self.write_correlations(cached_pairs + differential_times)
+            self._waveform_store.release(shared_ids)
+            return links
+
+        with ProcessPoolExecutor(
+                max_workers=processes,
+                initializer=_init_correlation_worker,
+                initargs=(self._worker_copy(processes), )) as executor:
+            for master, events_to_correlate, event_id_mapper, cached_pairs \
+                    in self._plan_work_units(catalog):
+                handles = None
+                if len(events_to_correlate) == 0:
+                    # Everything came from the correlation cache
+                    future = Future()
+                    future.set_result([])
+                else:
+                    if share_waveforms:
+                        handles = self._share_unit_waveforms(
+                            master, events_to_correlate)
+                    elif fill_archive:
+                        self._get_unit_waveforms(master, events_to_correlate)
+                    future = executor.submit(
+                        _correlation_worker, master, events_to_correlate,
+                        event_id_mapper, max_workers, handles)
+                pending.append((
+                    future, list(handles or []), master, event_id_mapper,
+                    cached_pairs))
+                self._since_checkpoint += 1
+                if self._checkpoint_due():
+                    # Everything planned must be written before checkpointing
+                    while pending:
+                        written_links += _write_oldest()
+                    self.checkpoint()
+                while len(pending) >= max_pending:
+                    written_links += _write_oldest()
+            while pending:
+                written_links += _write_oldest()
+        Logger.info(f"Wrote {written_links} event pairs")
         return written_links
 
+    def _depurated_lines(
+        self,
+        differential_times: List[_EventPair]
+    ) -> Tuple[List[str], int]:
+        """
+        Depurate event pairs as depurate_dtcc would depurate their dt.cc
+        lines, returning the lines to write and the number of pairs.
+        """
+        pair, station, phase, time_lag, corr = [], [], [], [], []
+        for i, event_pair in enumerate(differential_times):
+            for o in event_pair.obs:
+                if o.weight < self.min_cc:
+                    self.depuration_rejections["min_cc"] += 1
+                    continue
+                weight = o.weight ** 2 if self.weight_by_square else o.weight
+                pair.append(i)
+                station.append(o.station)
+                phase.append(o.phase)
+                # Values as rounded in dt.cc
+                time_lag.append(float(f"{o.tt1 - o.tt2:.3f}"))
+                corr.append(float(f"{weight:.4f}"))
+        if len(pair) == 0:
+            return [], 0
+        kept = depurate_observations(
+            pair=np.array(pair), station=np.array(station),
+            phase=np.array(phase), time_lag=np.array(time_lag),
+            corr=np.array(corr), dt_min_cc_sq=self.min_cc ** 2,
+            min_link=self.minlink, shift_len=self.shift_len,
+            rejections=self.depuration_rejections)
+        lines, last_pair, written_links = [], None, 0
+        for i in kept.tolist():
+            if pair[i] != last_pair:
+                event_pair = differential_times[pair[i]]
+                lines.append(_EventPair(
+                    event_id_1=event_pair.event_id_1,
+                    event_id_2=event_pair.event_id_2,
+                    obs=[]).cc_string.strip())
+                last_pair = pair[i]
+                written_links += 1
+            lines.append(
+                f"{station[i]} {time_lag[i]:.3f} {corr[i]:.4f} {phase[i]}")
+        return lines, written_links
+
+    def _write_output(self, text: str, sidecar_pairs: List[_EventPair]):
+        """ Append to dt.cc and its sidecar, in the background if enabled. """
+        if self.background_write:
+            if self._dtcc_writer is None:
+                self._dtcc_writer = _BackgroundWriter(self.outfile)
+            if self._dtcc_sidecar is not None:
+                self._dtcc_writer.submit(
+                    self._dtcc_sidecar.append, sidecar_pairs)
+            if len(text):
+                self._dtcc_writer.write(text)
+            return
+        if self._dtcc_sidecar is not None:
+            self._dtcc_sidecar.append(sidecar_pairs)
+        if len(text):
+            with open(self.outfile, "a") as f:
+                f.write(text)
+
     def write_correlations(
         self,
         differential_times: List[_EventPair]
     ) -> int:
         """ Write the correlations to a dt.cc file """
-        written_links = 0
-        with open(self.outfile, "a") as f:
-            for event_pair in tqdm.tqdm(differential_times):
-                obs = [o for o in event_pair.obs if o.weight >= self.min_cc]
-                if len(obs) == 0 or len(obs)<self.minlink:
-                    continue
-                if self.weight_by_square:
-                    sq_obs = []
-                    for o in obs:
-                        sq_obs.append(_DTObs(
-                            station=o.station, tt1=o.tt1, tt2=o.tt2,
-                            weight=o.weight ** 2, phase=o.phase))
-                    obs = sq_obs
-                event_pair.obs = obs
-                f.write(event_pair.cc_string)
-                f.write("\n")
-                written_links += 1
+        # The sidecar keeps the unfiltered pairs
+        sidecar_pairs = None
+        if self._dtcc_sidecar is not None:
+            sidecar_pairs = [
+                _EventPair(event_id_1=event_pair.event_id_1,
+                           event_id_2=event_pair.event_id_2,
+                           obs=list(event_pair.obs))
+                for event_pair in differential_times]
+        if self.depurate:
+            lines, written_links = self._depurated_lines(differential_times)
+            self._write_output(
+                "".join(f"{line}\n" for line in lines), sidecar_pairs)
+            return written_links
+        written_links, parts = 0, []
+        for event_pair in tqdm.tqdm(differential_times):
+            obs = [o for o in event_pair.obs if o.weight >= self.min_cc]
+            if len(obs) == 0 or len(obs)<self.minlink:
+                continue
+            if self.weight_by_square:
+                sq_obs = []
+                for o in obs:
+                    sq_obs.append(_DTObs(
+                        station=o.station, tt1=o.tt1, tt2=o.tt2,
+                        weight=o.weight ** 2, phase=o.phase))
+                obs = sq_obs
+            event_pair.obs = obs
+            parts.append(event_pair.cc_string)
+            parts.append("\n")
+            written_links += 1
+        self._write_output("".join(parts), sidecar_pairs)
         return written_links
 
         # Write links for correlation cache.
@@ -0,0 +1,254 @@
+"""
+Packed, memory-mapped archive of waveform snippets for the correlator.
+
+All snippets live in one append-only file of float32 samples, with a
+second append-only file of fixed-width index records:
+
+    <archive>.f32 - samples of every snippet, back to back
+    <archive>.idx - (event_id, seed_id, phase, starttime, sampling_rate,
+                     offset, npts, fingerprint) records, offset and npts in
+                     samples
+
+Samples are read through numpy.memmap so fetching any event does not open
+files. Events without data are recorded with a single npts=0 record so
+that they are not requested from the client again.
+
+Snippets are cut around picks, so each append records a fingerprint of the
+picks used. An event appended again with a different fingerprint replaces
+its earlier snippets.
+"""
+
+import os
+import logging
+
+import numpy as np
+
+from typing import Dict, Iterable
+
+from obspy import Stream, Trace, UTCDateTime
+
+Logger = logging.getLogger(__name__)
+
+INDEX_DTYPE = np.dtype([
+    ("event_id", "U128"),
+    ("seed_id", "U32"),
+    ("phase", "U8"),
+    ("starttime", "f8"),  # POSIX timestamp
+    ("sampling_rate", "f8"),
+    ("offset", "i8"),
+    ("npts", "i8"),
+    ("fingerprint", "U40"),  # Of the picks the snippets were cut around
+])
+
+SAMPLE_DTYPE = np.dtype("float32")
+
+MAX_EVENT_ID_LENGTH = INDEX_DTYPE["event_id"].itemsize // np.dtype("U1").itemsize
+
+
+class WaveformArchive:
+    """
+    Single-file, appendable archive of float32 waveform snippets.
+
+    Only one process should append to an archive, other processes can open
+    it with read_only=True and call refresh to see new snippets.
+
+    :param archive: Path of the archive without extension.
+    :param read_only: Open the archive for reading only.
+    """
+    def __init__(self, archive: str, read_only: bool = False):
+        self.archive = os.path.abspath(archive)
+        self.read_only = read_only
+        self._index = dict()  # event_id -> list of index records
+        self._index_position = 0  # Bytes of the index file already read
+        self._memmap = None
+        self._data_handle, self._index_handle = None, None
+        directory = os.path.dirname(self.archive)
+        if not read_only and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.refresh()
+
+    def __repr__(self):
+        return (f"WaveformArchive(archive={self.archive}, "
+                f"events={len(self)}, read_only={self.read_only})")
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, event_id: str):
+        return event_id in self._index
+
+    def fingerprint(self, event_id: str) -> str:
+        """ Pick fingerprint the snippets of an event were cut with, or None. """
+        records = self._index.get(event_id)
+        if records is None and self.read_only:
+            self.refresh()
+            records = self._index.get(event_id)
+        if records is None:
+            return None
+        return str(records[0]["fingerprint"])
+
+    def __getstate__(self):
+        # Other processes only ever read, appends stay with the owner
+        return {"archive": self.archive, "read_only": True}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @property
+    def data_file(self):
+        return f"{self.archive}.f32"
+
+    @property
+    def index_file(self):
+        return f"{self.archive}.idx"
+
+    def _n_samples_on_disk(self) -> int:
+        if not os.path.isfile(self.data_file):
+            return 0
+        return os.path.getsize(self.data_file) // SAMPLE_DTYPE.itemsize
+
+    def refresh(self):
+        """ Read index records appended since the last refresh. """
+        if not os.path.isfile(self.index_file):
+            return
+        n_samples = self._n_samples_on_disk()
+        with open(self.index_file, "rb") as f:
+            f.seek(self._index_position)
+            raw = f.read()
+        # Ignore a partially written trailing record
+        n_records = len(raw) // INDEX_DTYPE.itemsize
+        records = np.frombuffer(
+            raw[:n_records * INDEX_DTYPE.itemsize], dtype=INDEX_DTYPE)
+        for record in records:
+            if record["offset"] + record["npts"] > n_samples:
+                Logger.warning(
+                    f"Index record for {record['event_id']} "
+                    f"{record['seed_id']} points past the end of "
+                    f"{self.data_file}, ignoring it and later records")
+                break
+            event_id = str(record["event_id"])
+            records_held = self._index.get(event_id)
+            if (records_held is None or
+                    records_held[0]["fingerprint"] != record["fingerprint"]):
+                # First or re-picked snippets of the event
+                records_held = self._index[event_id] = []
+            records_held.append(record)
+            self._index_position += INDEX_DTYPE.itemsize
+        return
+
+    def _samples(self, offset: int, npts: int) -> np.ndarray:
+        if self._memmap is None or offset + npts > len(self._memmap):
+            # The file has grown (or was empty) - remap it
+            self._memmap = np.memmap(
+                self.data_file, dtype=SAMPLE_DTYPE, mode="r")
+        return self._memmap[offset:offset + npts]
+
+    def get(self, event_id: str, fingerprint: str = None) -> Stream:
+        """
+        Get the snippets of an event, or None if it is not archived, or if
+        fingerprint is given and they were cut with other picks.
+
+        Trace data are read-only views of the memory-mapped archive.
+        """
+        records = self._index.get(event_id)
+        if self.read_only and (records is None or (
+                fingerprint is not None
+                and records[0]["fingerprint"] != fingerprint)):
+            # The owner may have archived (new) snippets since
+            self.refresh()
+            records = self._index.get(event_id)
+        if records is None:
+            return None
+        if fingerprint is not None and records[0]["fingerprint"] != fingerprint:
+            return None
+        st = Stream()
+        for record in records:
+            if record["npts"] == 0:
+                continue
+            network, station, location, channel = \
+                str(record["seed_id"]).split('.')
+            st += Trace(
+                data=self._samples(int(record["offset"]),
+                                   int(record["npts"])),
+                header=dict(
+                    network=network, station=station, location=location,
+                    channel=channel,
+                    starttime=UTCDateTime(float(record["starttime"])),
+                    sampling_rate=float(record["sampling_rate"])))
+        return st
+
+    def append(
+        self,
+        event_id: str,
+        stream: Stream,
+        phases: Dict[str, str] = None,
+        fingerprint: str = "",
+    ):
+        """
+        Append the snippets of an event to the archive.
+
+        :param event_id: Event the snippets belong to.
+        :param stream: Snippets to archive, an empty stream records no data.
+        :param phases: Optional mapping of seed id to the phases picked on it.
+        :param fingerprint:
+            Fingerprint of the picks the snippets were cut around. Snippets
+            already archived with another fingerprint are replaced.
+        """
+        if self.read_only:
+            raise IOError(f"{self.archive} was opened read-only")
+        # Longer ids would be cut short in the index and never found again
+        if len(event_id) > MAX_EVENT_ID_LENGTH:
+            raise ValueError(
+                f"Event id {event_id} is longer than the "
+                f"{MAX_EVENT_ID_LENGTH} characters the archive index holds")
+        if (event_id in self._index and
+                self._index[event_id][0]["fingerprint"] == fingerprint):
+            Logger.debug(f"{event_id} already archived, not appending")
+            return
+        phases = phases or dict()
+        if self._data_handle is None:
+            self._data_handle = open(self.data_file, "ab")
+            self._index_handle = open(self.index_file, "ab")
+        offset = self._n_samples_on_disk()
+        records = np.zeros(max(len(stream), 1), dtype=INDEX_DTYPE)
+        records["event_id"] = event_id
+        records["fingerprint"] = fingerprint
+        for i, tr in enumerate(stream):
+            data = np.ascontiguousarray(tr.data, dtype=SAMPLE_DTYPE)
+            self._data_handle.write(data.tobytes())
+            records[i] = (
+                event_id, tr.id, phases.get(tr.id, ""),
+                tr.stats.starttime.timestamp, tr.stats.sampling_rate,
+                offset, len(data), fingerprint)
+            offset += len(data)
+        # Data must be on disk before the index points at it
+        self._data_handle.flush()
+        records.tofile(self._index_handle)
+        self._index_handle.flush()
+        self._index_position += records.nbytes
+        self._index[event_id] = list(records)
+        return
+
+    def close(self):
+        """ Close append handles and the memory map. """
+        for handle in (self._data_handle, self._index_handle):
+            if handle is not None:
+                handle.close()
+        self._data_handle, self._index_handle = None, None
+        self._memmap = None
+        return
+
+
+def pick_phases(picks: Iterable) -> Dict[str, str]:
+    """ Map seed ids to the (sorted, first letter) phases picked on them. """
+    phases = dict()
+    for pick in picks:
+        seed_id = pick.waveform_id.get_seed_string()
+        phases.setdefault(seed_id, set()).add((pick.phase_hint or "?")[0])
+    return {seed_id: "".join(sorted(p)) for seed_id, p in phases.items()}
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod()
@@ -0,0 +1,265 @@
+"""
+In-process store of pre-filtered waveforms for the correlator.
+
+Waveforms are held as numpy arrays keyed by event id and seed id in a
+bounded least-recently-used cache. Arrays can optionally live in shared
+memory segments so that process-pool workers can attach to them by name
+rather than re-reading or copying the data.
+"""
+
+import logging
+
+import numpy as np
+
+from collections import OrderedDict
+from multiprocessing import shared_memory
+from typing import Dict, Iterable, List, Tuple
+
+from obspy import Stream, Trace
+
+Logger = logging.getLogger(__name__)
+
+
+class _TraceHandle:
+    """
+    Picklable description of one stored trace.
+
+    Holds either the data array itself or the name of the shared memory
+    segment that backs it.
+    """
+    __slots__ = ("header", "shape", "dtype", "shm_name", "data")
+
+    def __init__(self, header, shape, dtype, shm_name=None, data=None):
+        self.header = header
+        self.shape = shape
+        self.dtype = dtype
+        self.shm_name = shm_name
+        self.data = data
+
+    def __repr__(self):
+        return (f"_TraceHandle(id={self.header.get('network')}."
+                f"{self.header.get('station')}.{self.header.get('location')}."
+                f"{self.header.get('channel')}, shape={self.shape}, "
+                f"shm_name={self.shm_name})")
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+
+
+def _read_only(data: np.ndarray) -> np.ndarray:
+    data = data.view()
+    data.flags.writeable = False
+    return data
+
+
+class WaveformStore:
+    """
+    Bounded LRU store of pre-filtered waveforms keyed by event and seed id.
+
+    Entries that are pinned (handed out to pool workers) are never evicted,
+    so the store may temporarily exceed max_bytes while work is in flight.
+
+    :param max_bytes: Maximum number of bytes of waveform data to keep.
+    :param use_shared_memory:
+        Whether to back arrays with shared memory segments that other
+        processes can attach to with attach_streams.
+    """
+    def __init__(self, max_bytes: int = 2 * 1024 ** 3,
+                 use_shared_memory: bool = False):
+        self.max_bytes = max_bytes
+        self.use_shared_memory = use_shared_memory
+        # event_id -> {seed_id: [_TraceHandle]}
+        self._entries = OrderedDict()
+        self._segments = dict()  # shm name -> SharedMemory owned by us
+        self._pins = dict()  # event_id -> pin count
+        self.nbytes = 0
+        self.hits, self.misses = 0, 0
+
+    def __repr__(self):
+        return (f"WaveformStore(events={len(self)}, nbytes={self.nbytes}, "
+                f"max_bytes={self.max_bytes}, "
+                f"use_shared_memory={self.use_shared_memory})")
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, event_id: str):
+        return event_id in self._entries
+
+    def __getstate__(self):
+        # Only settings travel between processes, data are shared by handles
+        return {"max_bytes": self.max_bytes, "use_shared_memory": False}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _make_handle(self, tr: Trace) -> _TraceHandle:
+        data = np.ascontiguousarray(tr.data)
+        header = dict(tr.stats)
+        # Derived from the data and start time when traces are rebuilt
+        for key in ("npts", "endtime"):
+            header.pop(key, None)
+        if not self.use_shared_memory or data.nbytes == 0:
+            return _TraceHandle(header=header, shape=data.shape,
+                                dtype=data.dtype.str, data=_read_only(data))
+        shm = shared_memory.SharedMemory(create=True, size=data.nbytes)
+        shared = np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)
+        shared[:] = data[:]
+        self._segments[shm.name] = shm
+        return _TraceHandle(header=header, shape=data.shape,
+                            dtype=data.dtype.str, shm_name=shm.name,
+                            data=_read_only(shared))
+
+    def _release_handle(self, handle: _TraceHandle):
+        handle.data = None
+        if handle.shm_name is None:
+            return
+        shm = self._segments.pop(handle.shm_name, None)
+        if shm is None:
+            return
+        try:
+            shm.close()
+        except BufferError:
+            Logger.warning(f"Views of {handle.shm_name} still exist")
+        shm.unlink()
+
+    def put(self, event_id: str, stream: Stream):
+        """ Add or replace the waveforms for an event. """
+        if event_id in self._entries:
+            self._drop(event_id)
+        entry = dict()
+        for tr in stream:
+            entry.setdefault(tr.id, []).append(self._make_handle(tr))
+        self._entries[event_id] = entry
+        self.nbytes += sum(h.nbytes for hs in entry.values() for h in hs)
+        self._evict(keep=event_id)
+        return
+
+    def get(self, event_id: str) -> Stream:
+        """
+        Get the waveforms for an event, or None if they are not stored.
+
+        Trace data are read-only views of the stored arrays, or copies when
+        backed by shared memory so that segments can be unlinked on eviction.
+        """
+        entry = self._entries.get(event_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(event_id)
+        return Stream([
+            Trace(data=(handle.data if handle.shm_name is None
+                        else handle.data.copy()),
+                  header=dict(handle.header))
+            for handles in entry.values() for handle in handles])
+
+    def _drop(self, event_id: str):
+        entry = self._entries.pop(event_id)
+        for handles in entry.values():
+            for handle in handles:
+                self.nbytes -= handle.nbytes
+                self._release_handle(handle)
+        return
+
+    def _evict(self, keep: str = None):
+        for event_id in list(self._entries.keys()):
+            if self.nbytes <= self.max_bytes:
+                break
+            if self._pins.get(event_id, 0) or event_id == keep:
+                continue
+            Logger.debug(f"Evicting waveforms for {event_id}")
+            self._drop(event_id)
+        return
+
+    def handles(
+        self,
+        event_ids: Iterable[str],
+    ) -> Dict[str, List[_TraceHandle]]:
+        """
+        Pin events and get picklable handles to their waveforms.
+
+        Events that are not stored are left out. Handles backed by shared
+        memory do not carry data. Call release with the same event ids once
+        the handles are no longer needed.
+        """
+        out = dict()
+        for event_id in event_ids:
+            entry = self._entries.get(event_id)
+            if entry is None:
+                continue
+            self._pins[event_id] = self._pins.get(event_id, 0) + 1
+            out[event_id] = [
+                _TraceHandle(
+                    header=h.header, shape=h.shape, dtype=h.dtype,
+                    shm_name=h.shm_name,
+                    data=h.data if h.shm_name is None else None)
+                for hs in entry.values() for h in hs]
+        return out
+
+    def release(self, event_ids: Iterable[str]):
+        """ Unpin events handed out by handles. """
+        for event_id in event_ids:
+            count = self._pins.get(event_id, 0) - 1
+            if count > 0:
+                self._pins[event_id] = count
+            else:
+                self._pins.pop(event_id, None)
+        self._evict()
+        return
+
+    def close(self):
+        """ Drop all waveforms and unlink any shared memory segments. """
+        for event_id in list(self._entries.keys()):
+            self._drop(event_id)
+        self._pins.clear()
+        return
+
+
+def attach_streams(
+    handles: Dict[str, List[_TraceHandle]],
+) -> Tuple[Dict[str, Stream], List[shared_memory.SharedMemory]]:
+    """
+    Rebuild streams from handles produced by WaveformStore.handles.
+
+    Shared-memory backed traces are read-only views of the segments, so
+    nothing is copied. The returned segments must be closed by the caller
+    once the streams are no longer needed.
+    """
+    stream_dict, segments = dict(), []
+    for event_id, event_handles in handles.items():
+        st = Stream()
+        for handle in event_handles:
+            if handle.shm_name is None:
+                data = handle.data
+            else:
+                shm = shared_memory.SharedMemory(name=handle.shm_name)
+                segments.append(shm)
+                data = _read_only(np.ndarray(
+                    handle.shape, dtype=np.dtype(handle.dtype),
+                    buffer=shm.buf))
+            st += Trace(data=data, header=dict(handle.header))
+        stream_dict[event_id] = st
+    return stream_dict, segments
+
+
+def detach_streams(
+    stream_dict: Dict[str, Stream],
+    segments: List[shared_memory.SharedMemory],
+):
+    """ Drop streams from attach_streams and close their segments. """
+    stream_dict.clear()
+    for shm in segments:
+        try:
+            shm.close()
+        except BufferError:
+            # Views are still referenced somewhere, gc will close it
+            Logger.debug(f"Could not close {shm.name} yet")
+    return
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod()
@@ -5,11 +5,13 @@ import sys
 from eqcorrscan.core.match_filter import Tribe
 import matplotlib.pyplot as plt
 from obsplus import WaveBank
+from obspy import UTCDateTime
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 pipeline_root = os.path.abspath(os.path.join(current_dir, ".."))
 sys.path.append(pipeline_root)
 from utils.loader import read_catalog_from_csv, check_picks
+from utils.catalog_cache import CatalogCache, catalog_fingerprint
 
 
 swarm_dir = "/hpceliasrafn/haa53/EQcorrscan_pipeline/Swarm_data/swarms"
@@ -35,36 +37,34 @@ for swarm_name in os.listdir(swarm_dir):
             print(f"⚠️ Missing catalog file for {swarm_name}, skipping...")
             continue
 
-        cat = read_catalog_from_csv(parameters.get('catalog_csv'))
+        # Skip parsing and pick checking if this swarm was checked before
+        catalog_cache = CatalogCache.for_csv(catalog_path, parameters.get('catalog_cache_dir'))
+        catalog_key = catalog_fingerprint(catalog_path, bank)
+        cat = catalog_cache.get(catalog_key)
 
-        if cat is None or len(cat) == 0:
-            print(f"⚠️ Empty or unreadable catalog for {swarm_name}, skipping...")
-            continue
-        
-        stations = {pick.waveform_id.station_code for event in cat for pick in event.picks}
-        event_times = [event.preferred_origin().time for event in cat if event.preferred_origin()]
-        
-        if not cat or len(cat) == 0:
-            print(f"⚠️ Empty catalog for {swarm_name}, skipping...")
-            continue
-            
-        
-        if not event_times:
-            print(f"⚠️ No valid origins found for {swarm_name}, skipping...")
-            continue
+        if cat is None:
+            cat = read_catalog_from_csv(catalog_path, columnar=True)
+
+            if cat is None or len(cat) == 0:
+                print(f"⚠️ Empty or unreadable catalog for {swarm_name}, skipping...")
+                continue
+
+            stations = cat.stations
+            event_times = cat.events["time"]
 
-        start_time = min(event_times)
-        end_time = max(event_times)
+            start_time = UTCDateTime(ns=int(event_times.min()))
+            end_time = UTCDateTime(ns=int(event_times.max()))
 
-        av = bank.get_availability_df(station=stations, starttime= start_time, endtime = end_time)
+            av = bank.get_availability_df(station=stations, starttime= start_time, endtime = end_time)
 
-        cat = check_picks(cat, av, send_warning=False)
+            cat = check_picks(cat, av, send_warning=False)
+            catalog_cache.put(catalog_key, cat)
 
         print(f"🛠 Constructing Tribe for {swarm_name} (No SNR Filtering)...")
         tribe = Tribe().construct(
             method="from_client",
             client_id=bank,
-            catalog=cat,
+            catalog=cat.to_obspy(),
             lowcut=float(parameters.get('lowcut')),
             highcut=float(parameters.get('highcut')),
             samp_rate=int(parameters.get('samp_rate')),
@@ -0,0 +1,68 @@
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("obspy")
+pytest.importorskip("eqcorrscan")
+pytest.importorskip("obsplus")
+pytest.importorskip("h5py")
+
+from obspy import UTCDateTime
+from obspy.core.event import (
+    Event, Pick, ResourceIdentifier, WaveformStreamID)
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+pipeline_root = os.path.abspath(os.path.join(current_dir, ".."))
+sys.path.append(pipeline_root)
+from modules.correlator import _CorrelationCache, _DTObs, _EventPair
+
+CONFIG = {"shift_len": 0.2}
+
+
+def _event(name, pick_time):
+    return Event(
+        resource_id=ResourceIdentifier(f"smi:local/{name}"),
+        picks=[Pick(waveform_id=WaveformStreamID(seed_string="NZ.WEL.10.HHZ"),
+                    phase_hint="P", time=UTCDateTime(pick_time))])
+
+
+def _run(path, master, other, tt1, tt2):
+    """ One run correlating master with other and storing the pair. """
+    cache = _CorrelationCache(path, config=CONFIG)
+    cache.update([_EventPair(
+        event_id_1=master.resource_id.id.split("/")[-1],
+        event_id_2=other.resource_id.id.split("/")[-1],
+        obs=[_DTObs(station="WEL", tt1=tt1, tt2=tt2, weight=0.9, phase="P")])])
+    cache.mark(master)
+    cache.mark(other)
+    cache.write_meta(final=True)
+    return cache
+
+
+def test_repicked_event_replaces_csv_correlations(tmp_path):
+    path = str(tmp_path / "correlations")
+    event_a, event_b = _event("A", 0), _event("B", 10)
+    _run(path, event_a, event_b, tt1=1.0, tt2=2.0)
+
+    # A is re-picked, so its pair is recomputed, here with B as master
+    repicked_a = _event("A", 0.5)
+    cache = _CorrelationCache(path, config=CONFIG)
+    assert cache.is_known(event_b)
+    assert not cache.is_known(repicked_a)
+    _run(path, event_b, repicked_a, tt1=5.0, tt2=6.0)
+
+    cache = _CorrelationCache(path, config=CONFIG)
+    assert cache.is_known(repicked_a)
+    obs = cache.get("B", ["A"])["A"]
+    assert [(o.tt1, o.tt2) for o in obs] == [(5.0, 6.0)]
+
+
+def test_csv_pairs_are_read_in_both_orientations(tmp_path):
+    path = str(tmp_path / "correlations")
+    event_a, event_b = _event("A", 0), _event("B", 10)
+    _run(path, event_b, event_a, tt1=5.0, tt2=6.0)
+
+    cache = _CorrelationCache(path, config=CONFIG)
+    obs = cache.get("A", ["B"])["B"]
+    assert [(o.tt1, o.tt2) for o in obs] == [(6.0, 5.0)]
@@ -0,0 +1,134 @@
+"""
+Persistent cache of parsed, pick-checked swarm catalogs.
+
+Catalogs are stored as ColumnarCatalog arrays in .npz files named by a
+fingerprint of everything they were derived from: the swarm CSV and pick
+files (path, size and modification time), the WaveBank index the picks
+were checked against, and any options. Changing any of them gives a new
+fingerprint, so stale entries are never read, only left behind.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import pathlib
+
+import numpy as np
+
+from utils.columnar_catalog import ColumnarCatalog
+
+Logger = logging.getLogger(__name__)
+
+# Bump when the stored layout or the loading rules change
+CACHE_VERSION = 1
+
+
+def _stat_fingerprint(path):
+    stat = os.stat(path)
+    return [os.path.basename(path), stat.st_size, stat.st_mtime_ns]
+
+
+def availability_fingerprint(bank):
+    """
+    Fingerprint of the availability of a WaveBank, from its index file, or
+    None if the bank has no index file on disk.
+    """
+    index_path = getattr(bank, "index_path", None)
+    if index_path is None or not os.path.isfile(index_path):
+        return None
+    return [str(pathlib.Path(index_path).resolve())] + _stat_fingerprint(index_path)
+
+
+def catalog_fingerprint(csv_filename, bank=None, **options):
+    """
+    Fingerprint of a swarm CSV, its picks directory, the availability of
+    bank (if given) and options.
+
+    :return: Hex digest, or None if the availability cannot be fingerprinted.
+    """
+    csv_path = pathlib.Path(csv_filename).resolve()
+    picks_dir = csv_path.parent / "picks"
+    description = {
+        "version": CACHE_VERSION,
+        "csv": [str(csv_path)] + _stat_fingerprint(csv_path),
+        "options": {key: str(value) for key, value in sorted(options.items())},
+    }
+    if bank is not None:
+        description["availability"] = availability_fingerprint(bank)
+        if description["availability"] is None:
+            return None
+    digest = hashlib.sha256(json.dumps(description).encode())
+    if picks_dir.is_dir():
+        entries = sorted(
+            (entry.name, entry.stat().st_size, entry.stat().st_mtime_ns)
+            for entry in os.scandir(picks_dir) if entry.is_file())
+        for entry in entries:
+            digest.update(json.dumps(entry).encode())
+    return digest.hexdigest()
+
+
+class CatalogCache:
+    """
+    Directory of ColumnarCatalogs keyed by fingerprint.
+
+    :param cache_dir: Directory holding <fingerprint>.npz files.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.abspath(cache_dir)
+
+    def __repr__(self):
+        return f"CatalogCache(cache_dir={self.cache_dir})"
+
+    @classmethod
+    def for_csv(cls, csv_filename, cache_dir=None):
+        """ Cache in cache_dir, or beside the swarm CSV by default. """
+        if cache_dir is None:
+            cache_dir = pathlib.Path(csv_filename).resolve().parent / ".catalog_cache"
+        return cls(cache_dir)
+
+    def filename(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npz")
+
+    def get(self, key):
+        """ The catalog stored under key, or None. """
+        if key is None or not os.path.isfile(self.filename(key)):
+            return None
+        try:
+            with np.load(self.filename(key), allow_pickle=False) as f:
+                meta = json.loads(str(f["meta"]))
+                catalog = ColumnarCatalog(
+                    event_ids=f["event_ids"], events=f["events"],
+                    picks=f["picks"], codes=meta["codes"],
+                    factor=meta["factor"], gau=meta["gau"])
+        except Exception as e:
+            Logger.warning(f"Could not read cached catalog {key}: {e}")
+            return None
+        Logger.info(f"Loaded {len(catalog)} events from {self.filename(key)}")
+        return catalog
+
+    def put(self, key, catalog):
+        """ Store a catalog under key, replacing any previous entry. """
+        if key is None:
+            return
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        meta = dict(codes=catalog.codes, factor=catalog.factor, gau=catalog.gau)
+        # Keep only the picks of the catalog's events
+        positions = catalog.pick_positions()
+        events = catalog.events.copy()
+        events["pick_start"] = np.cumsum(events["n_picks"]) - events["n_picks"]
+        # Write then rename, so readers never see a partial file
+        partial = self.filename(key) + ".part"
+        with open(partial, "wb") as f:
+            np.savez(f, event_ids=catalog.event_ids, events=events,
+                     picks=catalog.picks[positions], meta=np.array(json.dumps(meta)))
+        os.replace(partial, self.filename(key))
+        Logger.info(f"Cached {len(catalog)} events in {self.filename(key)}")
+        return
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod()
@@ -0,0 +1,371 @@
+"""
+Compact, array-backed catalog of swarm events.
+
+Events and picks are kept in numpy structured arrays, with pick network,
+station, location, channel and phase codes stored as integers into code
+tables. Events are only built as obspy objects when they are asked for,
+so large catalogs can be filtered, pick-checked and pickled cheaply and
+converted where eqcorrscan needs obspy.
+
+    events - time (ns) and the swarm CSV fields of each event, with the
+             range of its picks in the pick table
+    picks - PICK_DTYPE records, codes index codes[<name>], -1 for None
+"""
+
+import logging
+
+import numpy as np
+
+from typing import Dict, List
+
+from obspy import Catalog, UTCDateTime
+from obspy.geodetics import degrees2kilometers, kilometer2degrees
+from obspy.core import AttribDict
+from obspy.core.event import (
+    Event,
+    Origin,
+    OriginUncertainty,
+    ConfidenceEllipsoid,
+    Pick,
+    WaveformStreamID,
+    CreationInfo,
+    Magnitude,
+)
+
+Logger = logging.getLogger(__name__)
+
+# Swarm CSV columns kept for each event
+EVENT_FIELDS = [
+    "X", "Y", "Z", "COA", "COA_NORM", "GAU_X", "GAU_Y", "GAU_Z",
+    "GAU_ErrX", "GAU_ErrY", "GAU_ErrZ", "COV_ErrX", "COV_ErrY", "COV_ErrZ",
+    "TRIG_COA", "DEC_COA", "DEC_COA_NORM", "ML", "ML_Err", "ML_r2",
+]
+
+PICK_DTYPE = np.dtype([
+    ("network", "i4"),
+    ("station", "i4"),
+    ("location", "i4"),
+    ("channel", "i4"),
+    ("phase", "i4"),
+    ("time", "i8"),  # ns since epoch
+    ("time_error", "f8"),
+    ("snr", "f8"),
+])
+
+CODE_NAMES = ("network", "station", "location", "channel", "phase")
+
+
+def event_dtype(field_dtypes: Dict[str, np.dtype] = None) -> np.dtype:
+    """
+    Event record dtype, fields keep the dtypes they were read with (float64
+    by default) so values convert back to obspy unchanged.
+    """
+    field_dtypes = field_dtypes or dict()
+    return np.dtype(
+        [("time", "i8")]
+        + [(field, field_dtypes.get(field, "f8")) for field in EVENT_FIELDS]
+        + [("pick_start", "i8"), ("n_picks", "i8")])
+
+
+class ColumnarCatalog:
+    """
+    Array-backed catalog of swarm events with lazy conversion to obspy.
+
+    Events built from it are the events read_catalog_from_csv builds, with
+    the event id as resource id.
+
+    :param event_ids: Event id of each event.
+    :param events: event_dtype records.
+    :param picks: PICK_DTYPE records, events index ranges of it.
+    :param codes: Code tables, name -> list of codes.
+    :param factor: Factor from CSV depth units to m.
+    :param gau: Whether events have the gaussian origin too.
+    """
+    def __init__(
+        self,
+        event_ids: np.ndarray,
+        events: np.ndarray,
+        picks: np.ndarray,
+        codes: Dict[str, List[str]],
+        factor: float = 1,
+        gau: bool = True,
+    ):
+        self.event_ids = np.asarray(event_ids)
+        self.events = events
+        self.picks = picks
+        self.codes = {name: list(codes.get(name, [])) for name in CODE_NAMES}
+        self.factor = factor
+        self.gau = gau
+
+    def __repr__(self):
+        return (f"ColumnarCatalog(events={len(self)}, "
+                f"picks={int(self.events['n_picks'].sum())})")
+
+    def __len__(self):
+        return len(self.events)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._event(i)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return self._event(index)
+        return self.select(index)
+
+    def select(self, index) -> "ColumnarCatalog":
+        """
+        Sub-catalog of the events at index (slice, mask or positions).
+
+        The pick table and code tables are shared with this catalog, so
+        codes added by either stay valid for both.
+        """
+        catalog = ColumnarCatalog(
+            event_ids=self.event_ids[index], events=self.events[index],
+            picks=self.picks, codes=dict(), factor=self.factor,
+            gau=self.gau)
+        catalog.codes = self.codes
+        return catalog
+
+    def filter_time(
+        self,
+        starttime: UTCDateTime = None,
+        endtime: UTCDateTime = None,
+    ) -> "ColumnarCatalog":
+        """ Events with starttime <= origin time <= endtime. """
+        keep = np.ones(len(self), dtype=bool)
+        if starttime is not None:
+            keep &= self.events["time"] >= UTCDateTime(starttime).ns
+        if endtime is not None:
+            keep &= self.events["time"] <= UTCDateTime(endtime).ns
+        return self.select(keep)
+
+    def pick_positions(self) -> np.ndarray:
+        """ Positions in the pick table of the picks of every event, in order. """
+        starts, counts = self.events["pick_start"], self.events["n_picks"]
+        if counts.sum() == 0:
+            return np.zeros(0, dtype=np.int64)
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+        return offsets + np.arange(counts.sum())
+
+    @property
+    def stations(self) -> set:
+        """ Station codes of the picks of the catalog. """
+        used = np.unique(self.picks["station"][self.pick_positions()])
+        return {self.codes["station"][i] for i in used if i >= 0}
+
+    def decode(self, name: str, values: np.ndarray) -> np.ndarray:
+        """ Codes for integer values, None for -1. """
+        table = np.array(self.codes[name] + [None], dtype=object)
+        return table[values]
+
+    def encode(self, name: str, values) -> np.ndarray:
+        """ Integer values for codes, adding new codes to the table. """
+        table = self.codes[name]
+        lookup = {code: i for i, code in enumerate(table)}
+        out = np.empty(len(values), dtype=np.int32)
+        for i, code in enumerate(values):
+            if code is None:
+                out[i] = -1
+                continue
+            if code not in lookup:
+                lookup[code] = len(table)
+                table.append(code)
+            out[i] = lookup[code]
+        return out
+
+    def _event(self, i: int) -> Event:
+        """ Build the obspy Event of the i-th event. """
+        record, factor = self.events[i], self.factor
+        event_info = {field: record[field].item() for field in EVENT_FIELDS}
+        origin_time = int(record["time"])
+        event_uid = str(self.event_ids[i])
+        ns = event_uid
+
+        event = Event()
+        event.resource_id = event_uid
+        event.creation_info = CreationInfo(
+            author="Hugo", date=str(UTCDateTime()))
+
+        # Add COA info to extra
+        event.extra = AttribDict()
+        event.extra.coa = {"value": event_info["COA"], "namespace": ns}
+        event.extra.coa_norm = {"value": event_info["COA_NORM"], "namespace": ns}
+        event.extra.trig_coa = {"value": event_info["TRIG_COA"], "namespace": ns}
+        event.extra.dec_coa = {"value": event_info["DEC_COA"], "namespace": ns}
+        event.extra.dec_coa_norm = {"value": event_info["DEC_COA_NORM"], "namespace": ns}
+
+        # Spline location as the preferred origin
+        origin = Origin()
+        origin.method_id = "spline"
+        origin.longitude = event_info["X"]
+        origin.latitude = event_info["Y"]
+        origin.depth = event_info["Z"] * factor
+        origin.time = UTCDateTime(ns=origin_time)
+        event.origins = [origin]
+        event.preferred_origin_id = origin.resource_id
+
+        if self.gau:
+            origin = Origin()
+            origin.method_id = "gaussian"
+            origin.longitude = event_info["GAU_X"]
+            origin.latitude = event_info["GAU_Y"]
+            origin.depth = event_info["GAU_Z"] * factor
+            origin.time = UTCDateTime(ns=origin_time)
+            event.origins.append(origin)
+
+        # Gaussian uncertainties for every origin
+        ouc = OriginUncertainty()
+        ce = ConfidenceEllipsoid()
+        ce.semi_major_axis_length = event_info["COV_ErrY"] * factor
+        ce.semi_intermediate_axis_length = event_info["COV_ErrX"] * factor
+        ce.semi_minor_axis_length = event_info["COV_ErrZ"] * factor
+        ce.major_axis_plunge = 0
+        ce.major_axis_azimuth = 0
+        ce.major_axis_rotation = 0
+        ouc.confidence_ellipsoid = ce
+        ouc.preferred_description = "confidence ellipsoid"
+        for origin in event.origins:
+            origin.longitude_errors.uncertainty = kilometer2degrees(event_info["GAU_ErrX"] * factor / 1e3)
+            origin.latitude_errors.uncertainty = kilometer2degrees(event_info["GAU_ErrY"] * factor / 1e3)
+            origin.depth_errors.uncertainty = event_info["GAU_ErrZ"] * factor
+            origin.origin_uncertainty = ouc
+            origin.origin_type = "hypocenter"
+            origin.evaluation_mode = "automatic"
+
+        mag = Magnitude()
+        mag.extra = AttribDict()
+        mag.mag = event_info["ML"]
+        mag.mag_errors.uncertainty = event_info["ML_Err"]
+        mag.magnitude_type = "ML"
+        mag.evaluation_mode = "automatic"
+        mag.extra.r2 = {"value": event_info["ML_r2"], "namespace": ns}
+        event.magnitudes = [mag]
+        event.preferred_magnitude_id = mag.resource_id
+
+        start = int(record["pick_start"])
+        picks = self.picks[start:start + int(record["n_picks"])]
+        codes = {name: self.decode(name, picks[name]) for name in CODE_NAMES}
+        for j, pick_record in enumerate(picks):
+            if codes["location"][j] is None:
+                wid = WaveformStreamID(
+                    network_code=codes["network"][j],
+                    station_code=codes["station"][j],
+                    channel_code=codes["channel"][j])
+            else:
+                wid = WaveformStreamID(
+                    network_code=codes["network"][j],
+                    station_code=codes["station"][j],
+                    location_code=codes["location"][j],
+                    channel_code=codes["channel"][j])
+            pick = Pick()
+            pick.extra = AttribDict()
+            pick.waveform_id = wid
+            pick.method_id = "automatic"
+            pick.phase_hint = codes["phase"][j]
+            pick.time = UTCDateTime(ns=int(pick_record["time"]))
+            pick.time_errors.uncertainty = pick_record["time_error"].item()
+            pick.extra.snr = {"value": pick_record["snr"].item(), "namespace": ns}
+            event.picks.append(pick)
+        return event
+
+    def to_obspy(self) -> Catalog:
+        """ Build the obspy Catalog of every event. """
+        return Catalog(events=list(self))
+
+    @classmethod
+    def from_obspy(
+        cls,
+        catalog: Catalog,
+        factor: float = 1,
+        gau: bool = True,
+    ) -> "ColumnarCatalog":
+        """
+        Pack an obspy Catalog of swarm events.
+
+        Origins, magnitudes, picks and extras laid out as
+        read_catalog_from_csv builds them are kept, missing values are NaN
+        and anything else is dropped.
+        """
+        events = np.zeros(len(catalog), dtype=event_dtype())
+        events[EVENT_FIELDS] = tuple(np.nan for _ in EVENT_FIELDS)
+        event_ids, pick_rows, pick_codes = [], [], {name: [] for name in CODE_NAMES}
+        for i, event in enumerate(catalog):
+            event_ids.append(str(event.resource_id))
+            record = events[i]
+            origin = event.preferred_origin() or (event.origins or [None])[0]
+            if origin is not None:
+                record["time"] = origin.time.ns
+                record["X"], record["Y"] = origin.longitude, origin.latitude
+                if origin.depth is not None:
+                    record["Z"] = origin.depth / factor
+                _origin_errors(record, origin, factor)
+            for _origin in event.origins:
+                if _origin.method_id and str(_origin.method_id) == "gaussian":
+                    record["GAU_X"], record["GAU_Y"] = _origin.longitude, _origin.latitude
+                    if _origin.depth is not None:
+                        record["GAU_Z"] = _origin.depth / factor
+            extra = getattr(event, "extra", None) or dict()
+            for field, key in (("COA", "coa"), ("COA_NORM", "coa_norm"),
+                               ("TRIG_COA", "trig_coa"), ("DEC_COA", "dec_coa"),
+                               ("DEC_COA_NORM", "dec_coa_norm")):
+                if key in extra:
+                    record[field] = extra[key]["value"]
+            magnitude = event.preferred_magnitude() or (event.magnitudes or [None])[0]
+            if magnitude is not None:
+                record["ML"] = magnitude.mag
+                if magnitude.mag_errors.uncertainty is not None:
+                    record["ML_Err"] = magnitude.mag_errors.uncertainty
+                mag_extra = getattr(magnitude, "extra", None) or dict()
+                if "r2" in mag_extra:
+                    record["ML_r2"] = mag_extra["r2"]["value"]
+            record["pick_start"] = len(pick_rows)
+            record["n_picks"] = len(event.picks)
+            for pick in event.picks:
+                pick_codes["network"].append(pick.waveform_id.network_code)
+                pick_codes["station"].append(pick.waveform_id.station_code)
+                pick_codes["location"].append(pick.waveform_id.location_code)
+                pick_codes["channel"].append(pick.waveform_id.channel_code)
+                pick_codes["phase"].append(pick.phase_hint)
+                snr = (getattr(pick, "extra", None) or dict()).get("snr")
+                pick_rows.append((
+                    pick.time.ns,
+                    np.nan if pick.time_errors.uncertainty is None
+                    else pick.time_errors.uncertainty,
+                    np.nan if snr is None else snr["value"]))
+        columnar = cls(event_ids=np.array(event_ids, dtype=str), events=events,
+                       picks=np.zeros(len(pick_rows), dtype=PICK_DTYPE),
+                       codes=dict(), factor=factor, gau=gau)
+        for name in CODE_NAMES:
+            columnar.picks[name] = columnar.encode(name, pick_codes[name])
+        if len(pick_rows):
+            columnar.picks["time"], columnar.picks["time_error"], \
+                columnar.picks["snr"] = zip(*pick_rows)
+        return columnar
+
+
+def _origin_errors(record, origin, factor):
+    """ Fill the uncertainty fields of record from origin. """
+    uncertainty = origin.origin_uncertainty
+    ellipsoid = uncertainty and uncertainty.confidence_ellipsoid
+    if ellipsoid:
+        for field, attribute in (("COV_ErrY", "semi_major_axis_length"),
+                                 ("COV_ErrX", "semi_intermediate_axis_length"),
+                                 ("COV_ErrZ", "semi_minor_axis_length")):
+            value = getattr(ellipsoid, attribute)
+            if value is not None:
+                record[field] = value / factor
+    # Stored as degrees, recorded in km (times factor / 1e3)
+    for field, errors in (("GAU_ErrX", origin.longitude_errors),
+                          ("GAU_ErrY", origin.latitude_errors)):
+        if errors.uncertainty is not None:
+            record[field] = degrees2kilometers(errors.uncertainty) * 1e3 / factor
+    if origin.depth_errors.uncertainty is not None:
+        record["GAU_ErrZ"] = origin.depth_errors.uncertainty / factor
+    return
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod()
@@ -0,0 +1,327 @@
+"""
+Depuration of GrowClust dt.cc differential time files.
+
+An event pair in dt.cc is a header line starting with '#' followed by
+"station time_lag corr phase" observation lines. Depuration keeps
+observations with corr >= dt_min_cc ** 2 and time_lag <= shift_len, keeps
+only the best correlated observation per station and phase, and drops
+pairs left with fewer than min_link observations.
+
+A DtccSidecar keeps the unfiltered correlations behind a dt.cc in binary
+pair and observation tables, so that dt.cc can be regenerated for new
+thresholds with refilter_dtcc without correlating again.
+"""
+
+import os
+import logging
+
+import numpy as np
+
+from typing import Dict, List, Tuple
+
+from eqcorrscan.utils.catalog_to_dd import _EventPair
+
+Logger = logging.getLogger(__name__)
+
+
+def depurate_observations(
+    pair: np.ndarray,
+    station: np.ndarray,
+    phase: np.ndarray,
+    time_lag: np.ndarray,
+    corr: np.ndarray,
+    dt_min_cc_sq: float,
+    min_link: float,
+    shift_len: float,
+    rejections: Dict[str, int] = None,
+) -> np.ndarray:
+    """
+    Depurate the observations of many event pairs at once.
+
+    :param pair: Index of the event pair of each observation.
+    :param station: Station of each observation.
+    :param phase: Phase of each observation.
+    :param time_lag: Differential time of each observation.
+    :param corr: Correlation of each observation.
+    :param rejections:
+        Optional counts of observations rejected by each rule (min_cc,
+        shift_len, duplicate and min_link) to add to.
+    :return:
+        Indexes of the observations kept, ordered by pair, station, phase
+        and descending correlation. Ties keep the first observation.
+    """
+    passed_cc = corr >= dt_min_cc_sq
+    passed = np.flatnonzero(passed_cc & (time_lag <= shift_len))
+    # Stable sort, last key is the primary one
+    kept = passed[np.lexsort((
+        passed, -corr[passed], phase[passed], station[passed], pair[passed]))]
+    _pair, _station, _phase = pair[kept], station[kept], phase[kept]
+    first = np.ones(len(kept), dtype=bool)
+    first[1:] = ((_pair[1:] != _pair[:-1]) | (_station[1:] != _station[:-1])
+                 | (_phase[1:] != _phase[:-1]))
+    kept = kept[first]
+    n_links = np.bincount(pair[kept], minlength=len(pair) and pair.max() + 1)
+    # Pairs without observations are dropped whatever min_link is
+    linked = (n_links >= min_link) & (n_links > 0)
+    linked_kept = kept[linked[pair[kept]]]
+    if rejections is not None:
+        for rule, n_rejected in (
+                ("min_cc", len(pair) - np.count_nonzero(passed_cc)),
+                ("shift_len", np.count_nonzero(passed_cc) - len(passed)),
+                ("duplicate", len(passed) - len(kept)),
+                ("min_link", len(kept) - len(linked_kept))):
+            rejections[rule] = rejections.get(rule, 0) + int(n_rejected)
+    return linked_kept
+
+
+def _parse_pairs(lines: List[str]) -> Tuple[List[str], tuple]:
+    """
+    Parse dt.cc lines into headers and observation columns.
+
+    Lines before the first header and malformed observation lines are
+    skipped.
+    """
+    headers = []
+    pair, station, time_lag, corr, phase = [], [], [], [], []
+    for line in lines:
+        if line.startswith('#'):
+            headers.append(line.strip())
+            continue
+        if len(headers) == 0:
+            continue
+        parts = line.split()
+        if len(parts) != 4:
+            continue  # Skip malformed lines
+        try:
+            _time_lag, _corr = float(parts[1]), float(parts[2])
+        except ValueError:
+            continue  # Skip lines with invalid numeric values
+        pair.append(len(headers) - 1)
+        station.append(parts[0])
+        time_lag.append(_time_lag)
+        corr.append(_corr)
+        phase.append(parts[3])
+    return headers, (pair, station, time_lag, corr, phase)
+
+
+def _depurate_lines(
+    lines: List[str],
+    dt_min_cc_sq: float,
+    min_link: float,
+    shift_len: float,
+) -> Tuple[List[str], int, int]:
+    """ Depurate complete event pairs, returning output lines and counts. """
+    headers, (pair, station, time_lag, corr, phase) = _parse_pairs(lines)
+    if len(pair) == 0:
+        return [], len(headers), 0
+    kept = depurate_observations(
+        pair=np.array(pair), station=np.array(station),
+        phase=np.array(phase), time_lag=np.array(time_lag),
+        corr=np.array(corr), dt_min_cc_sq=dt_min_cc_sq,
+        min_link=min_link, shift_len=shift_len)
+    out, last_pair, n_pairs = [], None, 0
+    for i in kept.tolist():
+        if pair[i] != last_pair:
+            out.append(headers[pair[i]])
+            last_pair = pair[i]
+            n_pairs += 1
+        out.append(f"{station[i]} {time_lag[i]:.3f} {corr[i]:.4f} {phase[i]}")
+    return out, len(headers), n_pairs
+
+
+def depurate_dtcc_file(
+    infile: str,
+    outfile: str,
+    dt_min_cc_sq: float,
+    min_link: float,
+    shift_len: float,
+    chunk_size: int = 64 * 1024 ** 2,
+) -> Tuple[int, int]:
+    """
+    Depurate a dt.cc file in chunks of about chunk_size bytes.
+
+    Only one chunk is held in memory at a time, event pairs that span
+    chunks are carried over to the next one.
+
+    :return: Number of event pairs read and written.
+    """
+    n_read, n_written = 0, 0
+    pending = []
+    with open(infile, 'r') as fin, open(outfile, 'w') as fout:
+        while True:
+            lines = fin.readlines(chunk_size)
+            lines = pending + lines
+            if len(lines) == 0:
+                break
+            if len(lines) == len(pending):
+                # End of file, the last pair is complete
+                complete, pending = lines, []
+            else:
+                # The last pair may continue in the next chunk
+                last_header = len(lines) - 1
+                while last_header > 0 and not lines[last_header].startswith('#'):
+                    last_header -= 1
+                complete, pending = lines[:last_header], lines[last_header:]
+            out, _read, _written = _depurate_lines(
+                complete, dt_min_cc_sq=dt_min_cc_sq, min_link=min_link,
+                shift_len=shift_len)
+            n_read += _read
+            n_written += _written
+            if len(out):
+                fout.write("\n".join(out) + "\n")
+        if n_written == 0:
+            fout.write("\n")
+    Logger.info(f"Kept {n_written} of {n_read} event pairs from {infile}")
+    return n_read, n_written
+
+
+DTCC_PAIR_DTYPE = np.dtype([
+    ("event_id_1", "i8"),
+    ("event_id_2", "i8"),
+    ("n_obs", "i4"),  # Observations of the pair in the observation table
+])
+
+DTCC_OBS_DTYPE = np.dtype([
+    ("station", "S16"),
+    ("phase", "S8"),
+    ("time_lag", "f8"),  # tt1 - tt2
+    ("weight", "f8"),  # Correlation, not squared
+])
+
+
+class DtccSidecar:
+    """
+    Columnar, append-only record of every correlation offered to a dt.cc.
+
+    <dtcc>.pairs - DTCC_PAIR_DTYPE records, one per event pair
+    <dtcc>.obs - DTCC_OBS_DTYPE records, the observations of each pair
+
+    Observations are kept before any filtering so that dt.cc can be
+    regenerated for other thresholds with refilter_dtcc.
+
+    :param dtcc_file: The dt.cc file the sidecar sits beside.
+    """
+    def __init__(self, dtcc_file: str):
+        self.dtcc_file = os.path.abspath(dtcc_file)
+
+    def __repr__(self):
+        return f"DtccSidecar(dtcc_file={self.dtcc_file})"
+
+    @property
+    def pairs_file(self):
+        return f"{self.dtcc_file}.pairs"
+
+    @property
+    def obs_file(self):
+        return f"{self.dtcc_file}.obs"
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.pairs_file) and os.path.isfile(self.obs_file)
+
+    def append(self, event_pairs: List[_EventPair]):
+        """ Append event pairs, observations are written before their pairs. """
+        pairs = np.zeros(len(event_pairs), dtype=DTCC_PAIR_DTYPE)
+        obs = []
+        for i, event_pair in enumerate(event_pairs):
+            pairs[i] = (event_pair.event_id_1, event_pair.event_id_2,
+                        len(event_pair.obs))
+            obs.extend((o.station, o.phase, o.tt1 - o.tt2, o.weight)
+                       for o in event_pair.obs)
+        if len(pairs) == 0:
+            return
+        with open(self.obs_file, "ab") as f:
+            np.array(obs, dtype=DTCC_OBS_DTYPE).tofile(f)
+        with open(self.pairs_file, "ab") as f:
+            pairs.tofile(f)
+        return
+
+    def offsets(self) -> Tuple[int, int]:
+        """ Current sizes of the pair and observation files in bytes. """
+        return tuple(os.path.getsize(f) if os.path.isfile(f) else 0
+                     for f in (self.pairs_file, self.obs_file))
+
+    def truncate(self, offsets: Tuple[int, int]):
+        """ Drop anything written after offsets were taken. """
+        for filename, offset in zip((self.pairs_file, self.obs_file), offsets):
+            if os.path.isfile(filename):
+                with open(filename, "r+b") as f:
+                    f.truncate(offset)
+        return
+
+    def remove(self):
+        for filename in (self.pairs_file, self.obs_file):
+            if os.path.isfile(filename):
+                os.remove(filename)
+        return
+
+    def load(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Read the pair and observation tables, ignoring partially written
+        trailing records.
+        """
+        pairs = np.fromfile(self.pairs_file, dtype=DTCC_PAIR_DTYPE)
+        obs = np.fromfile(self.obs_file, dtype=DTCC_OBS_DTYPE)
+        n_obs = np.cumsum(pairs["n_obs"])
+        complete = n_obs <= len(obs)
+        pairs = pairs[complete]
+        return pairs, obs[:n_obs[complete][-1] if len(pairs) else 0]
+
+
+def refilter_dtcc(
+    dtcc_file: str,
+    outfile: str,
+    dt_min_cc: float,
+    min_link: float,
+    shift_len: float,
+    weight_by_square: bool = True,
+    chunk_pairs: int = 1000000,
+) -> Tuple[int, int]:
+    """
+    Regenerate a depurated dt.cc from the sidecar of dtcc_file.
+
+    Applies the Correlator's weight >= dt_min_cc filter (and weight
+    squaring) followed by the depuration rules, giving the file a
+    correlation and depuration with these parameters would have written.
+
+    :return: Number of event pairs read and written.
+    """
+    pairs, obs = DtccSidecar(dtcc_file).load()
+    obs_starts = np.concatenate(([0], np.cumsum(pairs["n_obs"])))
+    n_written = 0
+    with open(outfile, "w") as f:
+        for start in range(0, len(pairs), chunk_pairs):
+            end = min(start + chunk_pairs, len(pairs))
+            _obs = obs[obs_starts[start]:obs_starts[end]]
+            pair = np.repeat(np.arange(end - start), pairs["n_obs"][start:end])
+            weight = _obs["weight"]
+            if weight_by_square:
+                weight = weight ** 2
+            # Values as rounded in dt.cc, formatting rounds correctly
+            time_lag = np.char.mod("%.3f", _obs["time_lag"]).astype(float)
+            corr = np.char.mod("%.4f", weight).astype(float)
+            passed = np.flatnonzero(_obs["weight"] >= dt_min_cc)
+            kept = passed[depurate_observations(
+                pair=pair[passed], station=_obs["station"][passed],
+                phase=_obs["phase"][passed], time_lag=time_lag[passed],
+                corr=corr[passed], dt_min_cc_sq=dt_min_cc ** 2,
+                min_link=min_link, shift_len=shift_len)]
+            out, last_pair = [], None
+            for i in kept.tolist():
+                if pair[i] != last_pair:
+                    last_pair = pair[i]
+                    event_pair = pairs[start + last_pair]
+                    out.append(_EventPair(
+                        event_id_1=int(event_pair["event_id_1"]),
+                        event_id_2=int(event_pair["event_id_2"]),
+                        obs=[]).cc_string.strip())
+                    n_written += 1
+                out.append(
+                    f"{_obs['station'][i].decode()} {time_lag[i]:.3f} "
+                    f"{corr[i]:.4f} {_obs['phase'][i].decode()}")
+            if len(out):
+                f.write("\n".join(out) + "\n")
+        if n_written == 0:
+            f.write("\n")
+    Logger.info(f"Kept {n_written} of {len(pairs)} event pairs from the "
+                f"sidecar of {dtcc_file}")
+    return len(pairs), n_written
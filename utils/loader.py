@@ -1,28 +1,67 @@
 import os
 import pathlib
 import logging
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 from obspy import Catalog, UTCDateTime, read, __version__
-from obspy.geodetics import kilometer2degrees
-from obspy.core import AttribDict
 from obspy.core.stream import Stream
-from obspy.core.event import (
-    Event,
-    Origin,
-    OriginUncertainty,
-    ConfidenceEllipsoid,
-    Pick,
-    WaveformStreamID,
-    CreationInfo,
-    Magnitude,
-)
-
-
-def read_catalog_from_csv(csv_filename, units='m', GAU=True):
+
+from utils.columnar_catalog import (
+    ColumnarCatalog, CODE_NAMES, EVENT_FIELDS, PICK_DTYPE, event_dtype)
+
+
+PICK_COLUMNS_AS_STR = ["Station", "Phase", "SEED_ids", "PickTime"]
+
+
+def _to_timestamps(values):
+    """
+    Convert times to nanosecond timestamps, parsing them all at once when
+    they are ISO8601 strings and one UTCDateTime at a time otherwise.
+    """
+    if len(values) and all(isinstance(v, str) for v in values):
+        try:
+            ns = pd.to_datetime(pd.Series(values), utc=True, format='ISO8601')
+        except (ValueError, TypeError):
+            ns = None
+        if ns is not None and not ns.isna().any():
+            return ns.to_numpy(dtype='datetime64[ns]').astype(np.int64).tolist()
+    return [UTCDateTime(v).ns for v in values]
+
+
+def _read_pick_file(pick_file):
+    """ Read a pick file, with the text columns as they would print. """
+    picks = pd.read_csv(pick_file)
+    # Convert per file, concatenation could upcast mixed columns
+    for column in PICK_COLUMNS_AS_STR:
+        picks[column] = [str(v) for v in picks[column].tolist()]
+    return picks
+
+
+def read_pick_files(pick_files, max_workers=8):
+    """
+    Read pick files concurrently into one DataFrame with a 'file' column
+    giving the position of each pick's file in pick_files.
+    """
+    if len(pick_files) == 0:
+        return pd.DataFrame(columns=PICK_COLUMNS_AS_STR + ["PickError", "SNR", "file"])
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        frames = list(executor.map(_read_pick_file, pick_files))
+    picks = pd.concat(frames, ignore_index=True)
+    picks["file"] = np.repeat(np.arange(len(frames)), [len(f) for f in frames])
+    return picks
+
+
+def read_catalog_from_csv(csv_filename, units='m', GAU=True, max_workers=8,
+                          columnar=False):
     """
     Reads a CSV file and gathers the picks from a 'picks' directory in the same location.
     Automatically detects if the CSV file has a header.
     It requires a directory called 'picks' in the same location as csv to read the picks files
+
+    Pick files are read concurrently by max_workers threads and parsed
+    together before the events are built. With columnar=True the catalog is
+    returned as a ColumnarCatalog and no obspy events are built.
     """
 
     column_names = [
@@ -47,8 +86,6 @@ def read_catalog_from_csv(csv_filename, units='m', GAU=True):
         print("The CSV file doesn't have a header. Impossing header")
         swarm_table = pd.read_csv(csv_path, header=None, names=column_names)
 
-    cat = Catalog()
-    
     # Check if it can find picks directory
 
     if not picks_dir.is_dir():
@@ -63,135 +100,220 @@ def read_catalog_from_csv(csv_filename, units='m', GAU=True):
         factor = 1
     else:
         raise AttributeError(f"units must be 'km' or 'm'; not {units}")
-    
-    # Iterate on each line of the CSV and creates an event for each row
-    n = 0 
-    for _, event_info in swarm_table.iterrows():
-        # Create event origin
-        event = Event()
-        event_uid = str(event_info["EventID"])
-        ns = event_uid
-
-        # Add Basic info
-        event.resource_id = str(event_uid)
-        event.creation_info = CreationInfo(
-        author = "Hugo",
-        date =  str(UTCDateTime()))
-        
-        # Add COA info to extra
-        event.extra = AttribDict()
-        event.extra.coa = {"value": event_info["COA"], "namespace": ns}
-        event.extra.coa_norm = {"value": event_info["COA_NORM"], "namespace": ns}
-        event.extra.trig_coa = {"value": event_info["TRIG_COA"], "namespace": ns}
-        event.extra.dec_coa = {"value": event_info["DEC_COA"], "namespace": ns}
-        event.extra.dec_coa_norm = {"value": event_info["DEC_COA_NORM"], "namespace": ns}
-
-        # Create origin with spline location and set to preferred event origin.
-        origin = Origin()
-        origin.method_id = "spline"
-        origin.longitude = event_info["X"]
-        origin.latitude = event_info["Y"]
-        origin.depth = event_info["Z"] * factor
-        origin.time = UTCDateTime(event_info["DT"])
-        event.origins = [origin]
-        event.preferred_origin_id = origin.resource_id
-
-        # Create origin with gaussian location and associate with event
-        if GAU:
-            origin = Origin()
-            origin.method_id = "gaussian"
-            origin.longitude = event_info["GAU_X"]
-            origin.latitude = event_info["GAU_Y"]
-            origin.depth = event_info["GAU_Z"] * factor
-            origin.time = UTCDateTime(event_info["DT"])
-            event.origins.append(origin)
-
-        # Set confidence ellipsoid and uncertainties for both as the gaussian uncertainties 
-        ouc = OriginUncertainty()
-        ce = ConfidenceEllipsoid()
-        ce.semi_major_axis_length = event_info["COV_ErrY"] * factor
-        ce.semi_intermediate_axis_length = event_info["COV_ErrX"] * factor
-        ce.semi_minor_axis_length = event_info["COV_ErrZ"] * factor
-        ce.major_axis_plunge = 0
-        ce.major_axis_azimuth = 0
-        ce.major_axis_rotation = 0
-        ouc.confidence_ellipsoid = ce
-        ouc.preferred_description = "confidence ellipsoid"
-
-        # Set uncertainties for both as the gaussian uncertainties
-        for origin in event.origins:
-            origin.longitude_errors.uncertainty = kilometer2degrees( event_info["GAU_ErrX"] * factor / 1e3 )
-            origin.latitude_errors.uncertainty = kilometer2degrees( event_info["GAU_ErrY"] * factor / 1e3  )
-            origin.depth_errors.uncertainty = event_info["GAU_ErrZ"] * factor
-            origin.origin_uncertainty = ouc
-        
-        # Add OriginQuality info to each origin
-        for origin in event.origins:
-            origin.origin_type = "hypocenter"
-            origin.evaluation_mode = "automatic"
-        
-        # Add Magnitude to event
-        mag = Magnitude()
-        mag.extra = AttribDict()
-        mag.mag = event_info["ML"]
-        mag.mag_errors.uncertainty = event_info["ML_Err"]
-        mag.magnitude_type = "ML"
-        mag.evaluation_mode = "automatic"
-        mag.extra.r2 = {"value": event_info["ML_r2"], "namespace": ns}
-
-        event.magnitudes = [mag]
-        event.preferred_magnitude_id = mag.resource_id
-
-        # Handle Picks
-        pick_file = picks_dir / event_uid
-        if pick_file.with_suffix(".picks").is_file():
-            picks = pd.read_csv(pick_file.with_suffix(".picks"))
-            n += 1
+
+    event_uids = [str(event_uid) for event_uid in swarm_table["EventID"].tolist()]
+
+    # Read all pick files at once
+    available = {entry.name for entry in os.scandir(picks_dir) if entry.is_file()}
+    pick_files = dict()  # Pick file -> position in pick_files
+    event_files = []
+    for event_uid in event_uids:
+        pick_file = (picks_dir / event_uid).with_suffix(".picks")
+        if pick_file.name in available:
+            event_files.append(pick_files.setdefault(pick_file, len(pick_files)))
         else:
-            print("No pick file found for the event: " + ns)
+            event_files.append(None)
+            print("No pick file found for the event: " + event_uid)
+    picks = read_pick_files(list(pick_files), max_workers=max_workers)
+
+    # Parse pick times and SEED ids together
+    has_time = (picks["PickTime"] != "-1").to_numpy()
+    pick_times = np.zeros(len(picks), dtype=np.int64)
+    pick_times[has_time] = _to_timestamps(picks["PickTime"][has_time].tolist())
+    pick_channels = picks["SEED_ids"].str.strip("[]").str.replace("'", "").str.split(",").tolist()
+    stations, phases = picks["Station"].tolist(), picks["Phase"].tolist()
+    pick_errors, snrs = picks["PickError"].tolist(), picks["SNR"].tolist()
+    pick_file_positions = picks["file"].tolist()
+
+    # One row per pick and channel, S picks on several channels keep the location
+    rows, codes = [], {name: [] for name in CODE_NAMES}
+    for i, channels in enumerate(pick_channels):
+        if (len(channels) > 1 and phases[i] == "S"):
+            seed_ids = []
+            for chanal in channels:
+                network, _station, _loc, ch = chanal.split(".")
+                seed_ids.append((network, _loc, ch))
+        else:
+            network, _station, _loc, ch = channels[0].split(".")
+            seed_ids = [(network, None, ch)]
+        # Picks without time are skipped
+        if not has_time[i]:
             continue
-        
-        for _, pickline in picks.iterrows():
-            station = str(pickline["Station"])
-            phase = str(pickline["Phase"])
-            channels = str(pickline["SEED_ids"]).strip("[]").replace("'", "").split(",")
-
-            if (len(channels) > 1 and phase =="S"):
-                for chanal in channels:
-                    network, _station, _loc, ch = chanal.split(".")
-                    wid = WaveformStreamID(network_code=network, station_code=station, location_code=_loc, channel_code=ch)
-                    pick = Pick()
-                    pick.extra = AttribDict()
-                    pick.waveform_id = wid
-                    pick.method_id = "automatic"
-                    pick.phase_hint = phase
-                    if str(pickline["PickTime"]) != "-1":
-                        pick.time = UTCDateTime(pickline["PickTime"])
-                        pick.time_errors.uncertainty = float(pickline["PickError"])
-                        pick.extra.snr = {"value": float(pickline["SNR"]), "namespace": ns}
-                    else:
-                        continue
-                    event.picks.append(pick)
-            else:
-                chanel = channels[0]
-                network, _station, _loc, ch = chanel.split(".")
-                wid = WaveformStreamID(network_code=network, station_code=station, channel_code=ch)
-                pick = Pick()
-                pick.extra = AttribDict()
-                pick.waveform_id = wid
-                pick.method_id = "automatic"
-                pick.phase_hint = phase
-                if str(pickline["PickTime"]) != "-1":
-                    pick.time = UTCDateTime(pickline["PickTime"])
-                    pick.time_errors.uncertainty = float(pickline["PickError"])
-                    pick.extra.snr = {"value": float(pickline["SNR"]), "namespace": ns}
-                else:
-                    continue
-                event.picks.append(pick)
-        cat.append(event)
-    
-    print("Succesfully loaded " + str(n) + " events to catalog")
-    return cat    
+        for network, location, channel in seed_ids:
+            rows.append((pick_file_positions[i], pick_times[i],
+                         float(pick_errors[i]), float(snrs[i])))
+            codes["network"].append(network)
+            codes["station"].append(stations[i])
+            codes["location"].append(location)
+            codes["channel"].append(channel)
+            codes["phase"].append(phases[i])
+    pick_table = np.zeros(len(rows), dtype=PICK_DTYPE)
+    row_files = np.zeros(len(rows), dtype=np.int64)
+    if len(rows):
+        row_files[:], pick_table["time"], pick_table["time_error"], \
+            pick_table["snr"] = zip(*rows)
+    file_counts = np.bincount(row_files, minlength=len(pick_files))
+    file_starts = np.cumsum(file_counts) - file_counts
+
+    # One event for each row of the CSV that has a pick file
+    has_picks = np.array([f is not None for f in event_files], dtype=bool)
+    files = np.array([f for f in event_files if f is not None], dtype=np.int64)
+    field_dtypes = {
+        field: swarm_table[field].dtype if swarm_table[field].dtype.kind in "if" else "f8"
+        for field in EVENT_FIELDS}
+    events = np.zeros(len(files), dtype=event_dtype(field_dtypes))
+    events["time"] = np.array(
+        _to_timestamps(swarm_table["DT"][has_picks].tolist()), dtype=np.int64)
+    for field in EVENT_FIELDS:
+        events[field] = swarm_table[field].to_numpy()[has_picks]
+    events["pick_start"] = file_starts[files]
+    events["n_picks"] = file_counts[files]
+    cat = ColumnarCatalog(
+        event_ids=np.array(event_uids, dtype=str)[has_picks], events=events,
+        picks=pick_table, codes=dict(), factor=factor, gau=GAU)
+    for name in CODE_NAMES:
+        cat.picks[name] = cat.encode(name, codes[name])
+
+    print("Succesfully loaded " + str(len(cat)) + " events to catalog")
+    if columnar:
+        return cat
+    return cat.to_obspy()
+
+class _AvailabilityIndex:
+    """
+    Interval index of a WaveBank availability DataFrame.
+
+    Rows are grouped by station and channel, each group sorted by start
+    time, so the row covering a time is found with numpy.searchsorted. When
+    several rows cover a time the first one in the DataFrame is used, as
+    when filtering the DataFrame.
+    """
+    def __init__(self, av):
+        starts = av['starttime'].to_numpy(dtype='datetime64[ns]').astype(np.int64)
+        ends = av['endtime'].to_numpy(dtype='datetime64[ns]').astype(np.int64)
+        self.network = av['network'].to_numpy()
+        # (station, channel) -> (starts, ends, rows, overlapping)
+        self._groups = dict()
+        keys = pd.DataFrame({'station': av['station'].to_numpy(),
+                             'channel': av['channel'].to_numpy()})
+        for key, rows in keys.groupby(['station', 'channel']).indices.items():
+            rows = rows[np.argsort(starts[rows], kind='stable')]
+            overlapping = bool(np.any(ends[rows[:-1]] >= starts[rows[1:]]))
+            self._groups[key] = (starts[rows], ends[rows], rows, overlapping)
+
+    def lookup(self, stations, channels, times, chunk_size=1000000):
+        """
+        Find the availability row covering each time on each station and
+        channel.
+
+        :param times: Times as datetime64[ns] integers.
+        :return: Row positions in the DataFrame, -1 where none covers a time.
+        """
+        out = np.full(len(times), -1, dtype=np.int64)
+        if len(times) == 0:
+            return out
+        keys = pd.DataFrame({'station': stations, 'channel': channels})
+        for key, positions in keys.groupby(['station', 'channel']).indices.items():
+            group = self._groups.get(key)
+            if group is None:
+                continue
+            starts, ends, rows, overlapping = group
+            t = times[positions]
+            # Rows before hi start at or before t
+            hi = np.searchsorted(starts, t, side='right')
+            if not overlapping:
+                candidate = np.maximum(hi - 1, 0)
+                found = (hi > 0) & (ends[candidate] >= t)
+                out[positions[found]] = rows[candidate[found]]
+                continue
+            # Several rows may cover t, compare against all of them in chunks
+            step = max(chunk_size // len(rows), 1)
+            for i in range(0, len(t), step):
+                _t, _hi = t[i:i + step], hi[i:i + step]
+                covering = ((np.arange(len(rows))[None, :] < _hi[:, None])
+                            & (ends[None, :] >= _t[:, None]))
+                first = np.where(covering, rows[None, :], len(self.network)).min(axis=1)
+                found = first < len(self.network)
+                out[positions[i:i + step][found]] = first[found]
+        return out
+
+
+# Define a mapping for channel homologs (e.g., BHE -> HHE)
+HOMOLOG_CHANNELS = {'BHE': 'HHE', 'BHN': 'HHN', 'BHZ': 'HHZ',
+                    'HHE': 'BHE', 'HHN': 'BHN', 'HHZ': 'BHZ'}
+
+
+def _resolve_picks(av, stations, channels, times):
+    """
+    Find the availability row of picks, trying the homologous channel for
+    picks without one.
+
+    :return:
+        The availability index, the row of each pick (-1 if none) and
+        whether each pick moved to its homologous channel.
+    """
+    index = _AvailabilityIndex(av)
+    rows = index.lookup(stations, channels, times)
+    # If there is no row, try with homologous channel code
+    use_homolog = np.array([row < 0 and channel in HOMOLOG_CHANNELS
+                            for row, channel in zip(rows, channels)], dtype=bool)
+    if use_homolog.any():
+        rows[use_homolog] = index.lookup(
+            stations[use_homolog],
+            np.array([HOMOLOG_CHANNELS[c] for c in channels[use_homolog]], dtype=object),
+            times[use_homolog])
+    return index, rows, use_homolog
+
+
+def _check_columnar_picks(catalog, av, send_warning=False):
+    """ check_picks for a ColumnarCatalog, updating its pick table. """
+    positions = catalog.pick_positions()
+    # Resolve each pick once, events may share picks
+    unique, inverse = np.unique(positions, return_inverse=True)
+    picks = catalog.picks[unique]
+    stations = catalog.decode("station", picks["station"])
+    channels = catalog.decode("channel", picks["channel"])
+    networks = catalog.decode("network", picks["network"])
+    # Microsecond times, as compared for obspy picks
+    times = (picks["time"] + 500) // 1000 * 1000
+    index, rows, use_homolog = _resolve_picks(av, stations, channels, times)
+    found = rows >= 0
+    correct_networks = np.full(len(picks), None, dtype=object)
+    correct_networks[found] = index.network[rows[found]]
+    fix_network = found & (networks != correct_networks)
+
+    # Count discrepancies per event
+    event_of_pick = np.repeat(np.arange(len(catalog)), catalog.events["n_picks"])
+    j = np.bincount(event_of_pick, weights=fix_network[inverse], minlength=len(catalog)).astype(int)
+    k = np.bincount(event_of_pick, weights=use_homolog[inverse], minlength=len(catalog)).astype(int)
+    missing = np.bincount(event_of_pick, weights=~found[inverse], minlength=len(catalog)).astype(int)
+    end = 0
+    for event_id, n_picks, _missing, _j, _k in zip(
+            catalog.event_ids, catalog.events["n_picks"], missing, j, k):
+        start, end = end, end + n_picks
+        if _missing:
+            for i in np.flatnonzero(~found[inverse[start:end]]) + start:
+                pick_time = UTCDateTime(ns=int(catalog.picks["time"][positions[i]])).datetime
+                logging.warning(f"Warning: No valid network/channel found for pick at station {stations[inverse[i]]}, time {pick_time}.")
+        if send_warning and _j > 0:
+            logging.warning(f"Event {event_id} had {_j} discrepancies on the network code")
+        if send_warning and _k > 0:
+            logging.warning(f"Event {event_id} had {_k} discrepancies on the channel code")
+    logging.warning(f"A total of {j.sum()} network codes and {k.sum()} channel codes have been updated")
+
+    picks["channel"][use_homolog] = catalog.encode(
+        "channel", [HOMOLOG_CHANNELS[c] for c in channels[use_homolog]])
+    picks["network"][fix_network] = catalog.encode(
+        "network", correct_networks[fix_network].tolist())
+    catalog.picks[unique] = picks
+
+    # Filter out events with no picks
+    filtered = catalog.select(catalog.events["n_picks"] > 0)
+    if not len(filtered):
+        logging.error("No events with picks found in the catalog.")
+        raise ValueError("No events with picks found in the catalog.")
+    return filtered
+
 
 def check_picks(catalog, av, send_warning=False):
     """
@@ -205,54 +327,42 @@ def check_picks(catalog, av, send_warning=False):
     Returns:
     - A new Obspy Catalog object with updated picks and filtered events.
     """
-    # Define a mapping for channel homologs (e.g., BHE -> HHE)
-    homolog_channels = {'BHE': 'HHE', 'BHN': 'HHN', 'BHZ': 'HHZ',
-                        'HHE': 'BHE', 'HHN': 'BHN', 'HHZ': 'BHZ'}
+    if isinstance(catalog, ColumnarCatalog):
+        return _check_columnar_picks(catalog, av, send_warning=send_warning)
+    homolog_channels = HOMOLOG_CHANNELS
+
+    # Resolve every pick against the availability at once
+    picks = [pick for event in catalog for pick in event.picks]
+    stations = np.array([pick.waveform_id.station_code for pick in picks], dtype=object)
+    channels = np.array([pick.waveform_id.channel_code for pick in picks], dtype=object)
+    pick_times = [pick.time.datetime for pick in picks]
+    times = np.array(pick_times, dtype='datetime64[ns]').astype(np.int64)
+    index, rows, use_homolog = _resolve_picks(av, stations, channels, times)
 
     j_sum = 0 # Total number of network code discrepancies
     k_sum = 0 # Total number of channel code discrepancies
 
+    i = 0 # Position of the pick in the flattened picks
     for event in catalog:
         j = 0 # To count the number of discrepancies in the network code of the event
         k = 0 # To count the number of discrepancies in the channel code of the event
 
         for pick in event.picks:
-            # Extract station, channel, network, and time from the pick
-            station = pick.waveform_id.station_code
-            s_network = pick.waveform_id.network_code
-            s_channel = pick.waveform_id.channel_code
-            pick_time = pick.time.datetime
-
-            # Find the corresponding row in the availability DataFrame based on the station, time, and channel
-            station_info = av[
-                (av['station'] == station) & 
-                (av['channel'] == s_channel) &
-                (av['starttime'] <= pick_time) & 
-                (av['endtime'] >= pick_time)
-            ]
-
-            # If station_info is empty, try with homologous channel code
-            if station_info.empty and s_channel in homolog_channels:
-                homolog_channel = homolog_channels[s_channel]
-                station_info = av[
-                    (av['station'] == station) & 
-                    (av['channel'] == homolog_channel) &
-                    (av['starttime'] <= pick_time) & 
-                    (av['endtime'] >= pick_time)
-                ]
+            row = rows[i]
+            if use_homolog[i]:
                 k += 1
-                pick.waveform_id.channel_code = homolog_channel
+                pick.waveform_id.channel_code = homolog_channels[channels[i]]
+            station, pick_time = stations[i], pick_times[i]
+            i += 1
 
-            # If station_info is still empty, raise a warning (if necessary) and skip
-            if station_info.empty:
+            # If there is still no row, raise a warning (if necessary) and skip
+            if row < 0:
                 logging.warning(f"Warning: No valid network/channel found for pick at station {station}, time {pick_time}.")
                 continue
 
-            # If station_info is not empty, check network and channel codes
-            correct_network = station_info.iloc[0]['network']
-
             # Check if the network code matches and update if necessary
-            if s_network != correct_network:
+            correct_network = index.network[row]
+            if pick.waveform_id.network_code != correct_network:
                 pick.waveform_id.network_code = correct_network
                 j += 1  # Increment for network discrepancy
 